@@ -0,0 +1,867 @@
+from utils import (
+    create_table, create_lake, create_view, create_my_table, calculate_purchases_and_revenue_per_product_week,
+    calculate_conversion_rate_per_step_per_week, calculate_number_of_users_per_step_per_week,
+    calculate_weekly_report, discover_vocabularies, create_session_journeys, legacy_two_b_1, legacy_two_b_2, legacy_two_b_3, refresh_weekly_aggregates)
+from sharded import build_sharded
+from quality import SESSION_RULES, QUALITY_RULES, check_events, check_sessions
+from store import read_session_journey, read_user_journeys
+from generator import FUNNEL, create_synthetic_events, sessions_for_events, write_synthetic_events
+import duckdb
+import pandas as pd
+import argparse
+import datetime
+import json
+import os
+import platform
+import re
+import resource
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+class _ScanCounter:
+    """
+    This class wraps a connection and counts the queries it runs and the scans of the fact tables
+    (events and my_table) in their plans. Small lookup tables like steps_dictionary are not counted.
+    Depending on the DuckDB version, a window query can be planned with more than one scan.
+    """
+    def __init__(self, conn: duckdb.connect, tables: tuple = ("events", "my_table")):
+        self.conn = conn
+        self.tables = tables
+        self.queries = 0
+        self.scans = 0
+
+    def execute(self, query: str, parameters: list = None):
+        plan = self.conn.execute(f"EXPLAIN {query}", parameters).fetchall()
+        self.queries += 1
+        self.scans += sum(
+            len(re.findall(rf"\b{table}\b(?![.\w])", row[1])) for row in plan for table in self.tables)
+        return self.conn.execute(query, parameters)
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+
+def _conversion_rate_per_step_per_week_n_plus_one(conn: duckdb.connect) -> pd.DataFrame:
+    """
+    This function is the previous calculate_conversion_rate_per_step_per_week, which finds the
+    steps in events_unnested and then scans my_table once per step.
+    """
+    return pd.concat(
+    conn.execute(f"""
+        SELECT
+            DISTINCT ON (week)
+            count(*) FILTER (WHERE list_contains(steps, '{i}')) over (PARTITION BY year, week)  as total,
+            count(*) FILTER (WHERE steps[-1] = '{i}') over (PARTITION BY year, week) as dropped,
+            round((total::DOUBLE - dropped::DOUBLE) / total::DOUBLE * 100, 2) as conversion_rate,
+            '{i}' as step,
+            week,
+            year
+        FROM my_table
+        QUALIFY
+            total > 0;
+        """).fetch_df() for i in conn.execute("""
+        select distinct string_value from events_unnested where key = 'step' """).fetch_df()['string_value']
+    )
+
+
+def _window_create_my_table(conn: duckdb.connect) -> None:
+    """
+    This function is the previous create_my_table, which evaluates four window aggregates over
+    every unnested row and then keeps one row per session with DISTINCT ON.
+    """
+    conn.execute("""
+    CREATE OR REPLACE TABLE my_table AS (
+        SELECT DISTINCT ON(session_id) session_id, user_pseudo_id, week(epoch_ms(event_timestamp)) as week,
+        year(epoch_ms(event_timestamp)) as year,
+        list(string_value) FILTER (WHERE key = 'step') over w1 as steps,
+        string_agg(string_value, '') FILTER (WHERE key = 'product') over w1 as product,
+        sum(int_value) FILTER (WHERE key = 'amount') over w1 as amount,
+        string_agg(string_value, '') FILTER (WHERE key = 'currency') over w1 as currency,
+            from events_unnested
+            window w1 as (
+            PARTITION BY session_id, year(epoch_ms(event_timestamp)), week(epoch_ms(event_timestamp))
+        )
+    )"""
+    )
+
+
+def _scan_chunks(conn: duckdb.connect, chunks: int = 1) -> None:
+    """
+    This function only scans and unnests the events of every chunk of sessions, as
+    create_my_table does before aggregating each one, to measure the cost of reading the events
+    once per chunk.
+    """
+    for chunk in range(chunks):
+        conn.execute(f"""
+        SELECT count(*) FROM (
+            SELECT UNNEST(event_params) FROM events WHERE hash(session_id) % {chunks} = {chunk})
+        """).fetchone()
+
+
+_STAGES = {
+    "create_table": create_table,
+    "create_view": create_view,
+    "window_create_my_table": _window_create_my_table,
+    "scan_chunks": _scan_chunks,
+    "create_my_table": create_my_table,
+    "calculate_purchases_and_revenue_per_product_week": calculate_purchases_and_revenue_per_product_week,
+    "calculate_number_of_users_per_step_per_week": calculate_number_of_users_per_step_per_week,
+    "calculate_conversion_rate_per_step_per_week": calculate_conversion_rate_per_step_per_week,
+    "calculate_weekly_report": calculate_weekly_report,
+    "refresh_weekly_aggregates": refresh_weekly_aggregates,
+    "check_events": check_events,
+    "check_sessions": check_sessions,
+    "legacy_two_b_1": legacy_two_b_1,
+    "legacy_two_b_2": legacy_two_b_2,
+    "legacy_two_b_3": legacy_two_b_3,
+}
+
+PIPELINE_STAGES = [
+    "create_table", "create_view", "create_my_table",
+    "calculate_purchases_and_revenue_per_product_week",
+    "calculate_number_of_users_per_step_per_week",
+    "calculate_conversion_rate_per_step_per_week",
+    "calculate_weekly_report",
+    "legacy_two_b_1", "legacy_two_b_2", "legacy_two_b_3",
+]
+
+
+def _run_stage(database: str, stage: str, **kwargs) -> dict:
+    """
+    This function runs one stage on the database and measures it. It is meant to run in a fresh
+    process, so the peak resident memory of the process is the peak of opening the database and
+    running the stage.
+    """
+    conn = duckdb.connect(database)
+    conn.execute("SET enable_progress_bar = false")
+    start = time.perf_counter()
+    result = _STAGES[stage](conn, **kwargs)
+    seconds = time.perf_counter() - start
+    conn.close()
+    measure = {"seconds": seconds, "peak_memory_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+    if isinstance(result, pd.DataFrame):
+        measure["rows"] = len(result)
+    return measure
+
+
+def measure_stage(database: str, stage: str, **kwargs) -> dict:
+    """
+    This function runs one of the stages in _STAGES in a new process.
+
+    Args:
+        database (str): Path to the database
+        stage (str): Name of the stage
+        **kwargs: Arguments of the stage
+
+    Returns:
+        dict: seconds and peak_memory_mb of the stage, and rows when it returns a dataframe
+    """
+    with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as executor:
+        return executor.submit(_run_stage, database, stage, **kwargs).result()
+
+
+def benchmark_session_build(n_sessions: int) -> dict:
+    """
+    This function compares the grouped session build of create_my_table with the previous
+    window and DISTINCT ON build, on the same synthetic events.
+
+    Args:
+        n_sessions (int): Number of synthetic sessions
+
+    Returns:
+        dict: seconds and peak_memory_mb of every implementation
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        database = os.path.join(directory, "benchmark.db")
+        conn = duckdb.connect(database)
+        create_synthetic_events(conn, n_sessions)
+        create_view(conn)
+        conn.close()
+        return {stage: measure_stage(database, stage) for stage in ("window_create_my_table", "create_my_table")}
+
+
+def _list_number_of_users_per_step_per_week(conn: duckdb.connect) -> pd.DataFrame:
+    """
+    This function calculates the users per step and week with list_contains over the steps list,
+    as it was done before steps_mask.
+    """
+    return conn.execute("""
+    SELECT
+        count(*) FILTER (WHERE list_contains(steps, 'landing')) as landing,
+        count(*) FILTER (WHERE list_contains(steps, 'checkout')) as checkout,
+        count(*) FILTER (WHERE list_contains(steps, 'login-options')) as login_options,
+        count(*) FILTER (WHERE list_contains(steps, 'sign-up')) as sign_up,
+        count(*) FILTER (WHERE list_contains(steps, 'purchase')) as purchase,
+        year, week
+        FROM my_table
+        GROUP BY year, week
+    """).fetch_df()
+
+
+def _list_conversion_rate_per_step_per_week(conn: duckdb.connect) -> pd.DataFrame:
+    """
+    This function calculates the conversion rate per step and week by unnesting the steps list,
+    as it was done before steps_mask and last_step.
+    """
+    return conn.execute("""
+        SELECT
+            count(*) as total,
+            count(*) FILTER (WHERE steps[-1] = step) as dropped,
+            round((total::DOUBLE - dropped::DOUBLE) / total::DOUBLE * 100, 2) as conversion_rate,
+            step,
+            week,
+            year
+        FROM (SELECT year, week, steps, UNNEST(list_distinct(steps)) as step FROM my_table)
+        GROUP BY year, week, step
+        ORDER BY year, week, step
+        """).fetch_df()
+
+
+def benchmark_step_encoding(conn: duckdb.connect, repeat: int = 3) -> dict:
+    """
+    This function compares the funnel queries over the steps list with the ones over
+    steps_mask and last_step.
+
+    Args:
+        conn (duckdb.connect): Connection to a database with my_table
+        repeat (int, optional): Number of runs, the fastest one is reported. Defaults to 3.
+
+    Returns:
+        dict: seconds of every query and encoding
+    """
+    results = {}
+    for name, calculate in [
+        ("users_per_step_list", _list_number_of_users_per_step_per_week),
+        ("users_per_step_mask", calculate_number_of_users_per_step_per_week),
+        ("conversion_rate_list", _list_conversion_rate_per_step_per_week),
+        ("conversion_rate_mask", calculate_conversion_rate_per_step_per_week),
+    ]:
+        seconds = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            calculate(conn)
+            seconds.append(time.perf_counter() - start)
+        results[name] = {"seconds": min(seconds)}
+    return results
+
+
+def benchmark_conversion_rate(conn: duckdb.connect, repeat: int = 3) -> dict:
+    """
+    This function compares the single scan conversion rate with the previous one, which
+    needed one scan to find the steps plus one scan per step.
+
+    Args:
+        conn (duckdb.connect): Connection to a database with events_unnested and my_table
+        repeat (int, optional): Number of runs, the fastest one is reported. Defaults to 3.
+
+    Returns:
+        dict: queries, scans and seconds of every implementation
+    """
+    results = {}
+    for name, calculate in [
+        ("n_plus_one", _conversion_rate_per_step_per_week_n_plus_one),
+        ("single_scan", calculate_conversion_rate_per_step_per_week),
+    ]:
+        counter = _ScanCounter(conn)
+        calculate(counter)
+        seconds = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            calculate(conn)
+            seconds.append(time.perf_counter() - start)
+        results[name] = {"queries": counter.queries, "scans": counter.scans, "seconds": min(seconds)}
+    return results
+
+
+def _separate_weekly_report(conn: duckdb.connect) -> dict:
+    """
+    This function calculates the metrics of calculate_weekly_report one after another, each one
+    with its own scan of my_table.
+    """
+    return {
+        "purchases_revenue": calculate_purchases_and_revenue_per_product_week(conn),
+        "users_per_step": calculate_number_of_users_per_step_per_week(conn),
+        "conversion_rate": calculate_conversion_rate_per_step_per_week(conn),
+    }
+
+
+def benchmark_weekly_report(conn: duckdb.connect, repeat: int = 3) -> dict:
+    """
+    This function compares the weekly report calculated in a single scan of my_table with the
+    same metrics calculated one after another.
+
+    Args:
+        conn (duckdb.connect): Connection to a database with my_table
+        repeat (int, optional): Number of runs, the fastest one is reported. Defaults to 3.
+
+    Returns:
+        dict: queries, scans and seconds of every implementation
+    """
+    results = {}
+    for name, calculate in [("separate", _separate_weekly_report), ("single_scan", calculate_weekly_report)]:
+        counter = _ScanCounter(conn)
+        calculate(counter)
+        seconds = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            calculate(conn)
+            seconds.append(time.perf_counter() - start)
+        results[name] = {"queries": counter.queries, "scans": counter.scans, "seconds": min(seconds)}
+    return results
+
+
+def benchmark_pipeline(path: str) -> dict:
+    """
+    This function runs every stage of the pipeline on a parquet file, in order and each one in
+    its own process, from create_table to the calculate_* functions and the legacy_two_b_* variants.
+
+    Args:
+        path (str): Path to the parquet file
+
+    Returns:
+        dict: seconds, peak_memory_mb and rows of every stage in PIPELINE_STAGES
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        database = os.path.join(directory, "benchmark.db")
+        results = {}
+        for stage in PIPELINE_STAGES:
+            kwargs = {"path": path} if stage == "create_table" else {}
+            results[stage] = measure_stage(database, stage, **kwargs)
+            print(f"Stage {stage} took {results[stage]['seconds']:.3f} seconds")
+        return results
+
+
+def _read_bytes() -> int:
+    """
+    This function returns the bytes the process has read from files so far, including the ones
+    served from the page cache. None when the operating system does not report them.
+    """
+    try:
+        with open("/proc/self/io") as f:
+            return next(int(line.split()[1]) for line in f if line.startswith("rchar:"))
+    except (OSError, StopIteration):
+        return None
+
+
+def benchmark_lake(path: str, weeks: int = 1, repeat: int = 3) -> dict:
+    """
+    This function compares the bytes read and the time of a query on the events of the latest
+    weeks, over the events table, the source parquet file and the partitioned lake. Every
+    query runs on a new connection, so nothing is served from the buffers of DuckDB.
+
+    Args:
+        path (str): Path to the parquet file
+        weeks (int, optional): Number of latest weeks queried. Defaults to 1.
+        repeat (int, optional): Number of runs, the fastest one is reported. Defaults to 3.
+
+    Returns:
+        dict: bytes_read and seconds of every layout
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        database, lake = os.path.join(directory, "benchmark.db"), os.path.join(directory, "events")
+        conn = duckdb.connect(database)
+        create_table(conn, path=path)
+        create_lake(conn, path=path, lake=lake, view_name="events_lake")
+        cutoff = conn.execute("SELECT max(event_timestamp) FROM events").fetchone()[0] - weeks * 604800000
+        conn.close()
+        sources = {
+            "table": "events",
+            "parquet": f"read_parquet('{path}')",
+            "lake": "events_lake",
+        }
+        results = {}
+        for layout, source in sources.items():
+            seconds, bytes_read = [], []
+            for _ in range(repeat):
+                conn = duckdb.connect(database, read_only=True)
+                before, start = _read_bytes(), time.perf_counter()
+                conn.execute(
+                    f"SELECT count(*), count(DISTINCT session_id) FROM {source} WHERE event_timestamp > ?",
+                    [cutoff]).fetchall()
+                seconds.append(time.perf_counter() - start)
+                after = _read_bytes()
+                bytes_read.append(None if before is None else after - before)
+                conn.close()
+            results[layout] = {"bytes_read": min(bytes_read) if None not in bytes_read else None,
+                               "seconds": min(seconds)}
+        return results
+
+
+_ENCODING_QUERIES = {
+    "filter": "SELECT count(*) FROM events_unnested WHERE key = 'step'",
+    "group_by": "SELECT string_value, count(*) FROM events_unnested WHERE key = 'product' GROUP BY string_value",
+}
+
+
+def benchmark_encoding(path: str, repeat: int = 3) -> dict:
+    """
+    This function compares the events stored with VARCHAR columns and with the ENUM columns of
+    discover_vocabularies: the size of the database file, the time and peak memory of building
+    events and my_table, each one in its own process, and the time of a filter and a group by
+    over events_unnested. The scan of discover_vocabularies is part of building the ENUM events,
+    so its seconds are added to create_table and to build, the seconds of the whole build.
+
+    Args:
+        path (str): Path to the parquet file
+        repeat (int, optional): Number of runs of the queries, the fastest one is reported. Defaults to 3.
+
+    Returns:
+        dict: measures of every encoding
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        results = {}
+        for encoding in ("varchar", "enum"):
+            database = os.path.join(directory, f"{encoding}.db")
+            conn = duckdb.connect(database)
+            start = time.perf_counter()
+            vocabularies = discover_vocabularies(conn, path) if encoding == "enum" else None
+            discover_seconds = time.perf_counter() - start
+            conn.close()
+            measures = {
+                "discover_vocabularies": {"seconds": discover_seconds},
+                "create_table": measure_stage(database, "create_table", path=path, vocabularies=vocabularies),
+                "create_view": measure_stage(database, "create_view"),
+                "create_my_table": measure_stage(database, "create_my_table"),
+            }
+            measures["create_table"]["seconds"] += discover_seconds
+            measures["build"] = {"seconds": sum(
+                measures[stage]["seconds"] for stage in ("create_table", "create_view", "create_my_table"))}
+            conn = duckdb.connect(database)
+            conn.execute("CHECKPOINT")
+            for name, query in _ENCODING_QUERIES.items():
+                seconds = []
+                for _ in range(repeat):
+                    start = time.perf_counter()
+                    conn.execute(query).fetchall()
+                    seconds.append(time.perf_counter() - start)
+                measures[name] = {"seconds": min(seconds)}
+            conn.close()
+            measures["database_bytes"] = os.path.getsize(database)
+            results[encoding] = measures
+    print(
+        f"The ENUM build took {results['enum']['build']['seconds']:.3f} seconds, "
+        f"{results['enum']['discover_vocabularies']['seconds']:.3f} of them finding the vocabularies, "
+        f"against {results['varchar']['build']['seconds']:.3f} for VARCHAR")
+    return results
+
+
+def benchmark_quality(path: str, repeat: int = 3) -> dict:
+    """
+    This function measures the quality checks against the load they guard, as a full rebuild
+    runs them: create_table, check_events on the events it loaded, create_view, create_my_table
+    and refresh_weekly_aggregates, each one in its own process. The sessions are only flagged
+    when they are checked, by the aggregation of create_my_table, so check_sessions is measured
+    as the time create_my_table with check_sessions takes over create_my_table without a check:
+    the quality_flags and counting them. Both builds are run `repeat` times and the fastest one
+    of each is reported. The checks are also reported as a fraction of the load.
+
+    Args:
+        path (str): Path to the parquet file
+        repeat (int, optional): Number of runs of each build of my_table. Defaults to 3.
+
+    Returns:
+        dict: seconds and peak_memory_mb of every stage and fraction_of_load
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        database = os.path.join(directory, "quality.db")
+        results = {stage: measure_stage(database, stage, **({"path": path} if stage == "create_table" else {}))
+                   for stage in ("create_table", "check_events", "create_view")}
+        for stage, kwargs in (("create_my_table", {}), ("create_my_table_checked", {"check": check_sessions})):
+            results[stage] = min(
+                (measure_stage(database, "create_my_table", **kwargs) for _ in range(repeat)),
+                key=lambda measure: measure["seconds"])
+        results["refresh_weekly_aggregates"] = measure_stage(database, "refresh_weekly_aggregates")
+    results["check_sessions"] = {
+        "seconds": results["create_my_table_checked"]["seconds"] - results["create_my_table"]["seconds"]}
+    check = results["check_events"]["seconds"] + results["check_sessions"]["seconds"]
+    load = sum(results[stage]["seconds"] for stage in (
+        "create_table", "create_view", "create_my_table", "refresh_weekly_aggregates"))
+    results["fraction_of_load"] = round(check / load, 3)
+    print(
+        f"The quality checks took {check:.3f} seconds, {results['fraction_of_load']:.1%} of the load, "
+        f"{results['check_sessions']['seconds']:.3f} of them flagging and checking the sessions")
+    return results
+
+
+def _latencies(lookup, keys: list) -> dict:
+    """
+    This function runs a lookup for every key and returns the percentiles of its latency in milliseconds.
+    """
+    seconds = []
+    for key in keys:
+        start = time.perf_counter()
+        lookup(key)
+        seconds.append(time.perf_counter() - start)
+    seconds.sort()
+    return {
+        "p50_ms": seconds[len(seconds) // 2] * 1000,
+        "p99_ms": seconds[min(int(len(seconds) * 0.99), len(seconds) - 1)] * 1000,
+    }
+
+
+def benchmark_journeys(path: str, lookups: int = 200) -> dict:
+    """
+    This function compares the lookups of one session or one user in the indexed session_journeys
+    table with the same lookups over events_unnested. The events are sorted by event_timestamp
+    first, like the exports of the source, so the sessions are spread over the whole table.
+
+    Args:
+        path (str): Path to the parquet file
+        lookups (int, optional): Number of sessions and users looked up. Defaults to 200.
+
+    Returns:
+        dict: seconds of the build and latency percentiles of every lookup
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        conn = duckdb.connect(os.path.join(directory, "benchmark.db"))
+        conn.execute("SET enable_progress_bar = false")
+        create_table(conn, path=path)
+        conn.execute("CREATE OR REPLACE TABLE events AS SELECT * FROM events ORDER BY event_timestamp")
+        create_view(conn)
+        start = time.perf_counter()
+        create_session_journeys(conn)
+        results = {"create_session_journeys": {"seconds": time.perf_counter() - start}}
+        sessions, users = zip(*conn.execute(f"""
+            SELECT session_id, user_pseudo_id FROM events
+            USING SAMPLE reservoir({int(lookups)} ROWS) REPEATABLE (0)
+            """).fetchall())
+        results["session_journeys"] = _latencies(lambda key: read_session_journey(conn, key), sessions)
+        results["session_events_unnested"] = _latencies(lambda key: conn.execute(
+            "SELECT * FROM events_unnested WHERE session_id = ? ORDER BY event_timestamp", [key]).fetch_df(), sessions)
+        results["user_journeys"] = _latencies(lambda key: read_user_journeys(conn, key), users)
+        results["user_events_unnested"] = _latencies(lambda key: conn.execute(
+            "SELECT * FROM events_unnested WHERE user_pseudo_id = ? ORDER BY event_timestamp", [key]).fetch_df(), users)
+        conn.close()
+        return results
+
+
+def benchmark_sharding(path: str, workers: tuple = (1, 2, 4)) -> dict:
+    """
+    This function measures how the build of my_table and the weekly aggregates scales with the
+    number of worker processes of build_sharded, compared with the build in a single process.
+    Every run starts from the same events table and view.
+
+    Args:
+        path (str): Path to the parquet file
+        workers (tuple, optional): Numbers of workers to measure. Defaults to (1, 2, 4).
+
+    Returns:
+        dict: seconds of the single process build and of every number of workers, and their speedup
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        runs = [("single_process", None)] + [(f"{n}_workers", n) for n in workers]
+        results = {}
+        for name, shards in runs:
+            conn = duckdb.connect(os.path.join(directory, f"{name}.db"))
+            conn.execute("SET enable_progress_bar = false")
+            create_table(conn, path=path)
+            create_view(conn)
+            start = time.perf_counter()
+            if shards is None:
+                create_my_table(conn)
+                refresh_weekly_aggregates(conn)
+            else:
+                build_sharded(conn, path, shards=shards, directory=directory)
+            results[name] = {"seconds": time.perf_counter() - start}
+            conn.close()
+        for measure in results.values():
+            measure["speedup"] = round(results["single_process"]["seconds"] / measure["seconds"], 3)
+        return results
+
+
+def benchmark_chunks(path: str, chunks: tuple = (1, 4, 16)) -> dict:
+    """
+    This function measures create_my_table with every number of chunks, each run in its own
+    process on the same events table and view. Every chunk scans and unnests the events again,
+    so the time of those scans alone is reported too: it grows with the number of chunks, while
+    the peak memory shrinks.
+
+    Args:
+        path (str): Path to the parquet file
+        chunks (tuple, optional): Numbers of chunks to measure. Defaults to (1, 4, 16).
+
+    Returns:
+        dict: seconds, peak_memory_mb and scan_seconds of every number of chunks
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        database = os.path.join(directory, "chunks.db")
+        conn = duckdb.connect(database)
+        conn.execute("SET enable_progress_bar = false")
+        create_table(conn, path=path)
+        create_view(conn)
+        conn.close()
+        results = {}
+        for n in chunks:
+            results[f"{n}_chunks"] = measure_stage(database, "create_my_table", chunks=n)
+            results[f"{n}_chunks"]["scan_seconds"] = measure_stage(database, "scan_chunks", chunks=n)["seconds"]
+    return results
+
+
+def _git_commit() -> str:
+    """
+    This function returns the commit of the working tree, with a -dirty suffix when it has
+    uncommitted changes. None outside of a git repository.
+    """
+    directory = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=directory, capture_output=True, text=True, check=True).stdout.strip()
+        status = subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"],
+            cwd=directory, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ("-dirty" if status else "")
+
+
+def save_results(results: dict, parameters: dict, directory: str = "benchmarks") -> str:
+    """
+    This function saves the results of a benchmark as JSON, together with the commit, the
+    parameters and the environment they were measured in.
+
+    Args:
+        results (dict): Results of the benchmark
+        parameters (dict): Parameters of the benchmark, like the number of events
+        directory (str, optional): Directory of the file. Defaults to "benchmarks".
+
+    Returns:
+        str: Path of the file
+    """
+    now = datetime.datetime.now(datetime.timezone.utc)
+    commit = _git_commit()
+    report = {
+        "commit": commit,
+        "created_at": now.isoformat(),
+        "parameters": parameters,
+        "environment": {
+            "python": platform.python_version(),
+            "duckdb": duckdb.__version__,
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+        },
+        "results": results,
+    }
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{now:%Y%m%dT%H%M%S}-{(commit or 'unknown')[:12]}.json")
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Benchmark results saved to {path}")
+    return path
+
+
+def compare_results(baseline: dict, current: dict) -> dict:
+    """
+    This function compares two saved benchmarks, giving for every measure of every stage the
+    ratio between the current and the baseline value, so above 1 is a regression.
+
+    Args:
+        baseline (dict): Saved benchmark to compare with
+        current (dict): Saved benchmark to compare
+
+    Returns:
+        dict: Ratios keyed by benchmark, stage and measure
+    """
+    ratios = {}
+    for benchmark, stages in current["results"].items():
+        for stage, measures in stages.items():
+            before = baseline["results"].get(benchmark, {}).get(stage, {})
+            for measure in ("seconds", "peak_memory_mb"):
+                if before.get(measure) and measure in measures:
+                    ratios.setdefault(benchmark, {}).setdefault(stage, {})[measure] = round(
+                        measures[measure] / before[measure], 3)
+    return ratios
+
+
+def test_benchmark_session_build():
+    """
+    This function tests that both session builds are measured and give the same sessions.
+    """
+    results = benchmark_session_build(1000)
+    assert set(results) == {"window_create_my_table", "create_my_table"}
+    assert all(r["seconds"] > 0 and r["peak_memory_mb"] > 0 for r in results.values())
+    conn = duckdb.connect()
+    create_synthetic_events(conn, 1000)
+    create_view(conn)
+    _window_create_my_table(conn)
+    window = conn.execute("SELECT * FROM my_table ORDER BY session_id").fetch_df()
+    create_my_table(conn)
+    grouped = conn.execute("SELECT * FROM my_table ORDER BY session_id").fetch_df()
+    pd.testing.assert_frame_equal(grouped[window.columns], window)
+
+
+def test_benchmark_step_encoding():
+    """
+    This function tests that the funnel queries give the same results with both encodings.
+    """
+    conn = duckdb.connect()
+    create_synthetic_events(conn, 1000)
+    create_view(conn)
+    create_my_table(conn)
+    expected = _list_number_of_users_per_step_per_week(conn).sort_values(["year", "week"]).reset_index(drop=True)
+    pd.testing.assert_frame_equal(expected, calculate_number_of_users_per_step_per_week(conn)[expected.columns])
+    pd.testing.assert_frame_equal(
+        _list_conversion_rate_per_step_per_week(conn), calculate_conversion_rate_per_step_per_week(conn))
+    assert set(benchmark_step_encoding(conn, repeat=1)) == {
+        "users_per_step_list", "users_per_step_mask", "conversion_rate_list", "conversion_rate_mask"}
+
+
+def test_benchmark_conversion_rate():
+    """
+    This function tests that the conversion rate scan count drops from N+1 to 1.
+    """
+    conn = duckdb.connect()
+    create_synthetic_events(conn, 1000)
+    create_view(conn)
+    create_my_table(conn)
+    results = benchmark_conversion_rate(conn, repeat=1)
+    assert results["n_plus_one"]["queries"] == len(FUNNEL) + 1
+    assert results["n_plus_one"]["scans"] >= len(FUNNEL) + 1
+    assert results["single_scan"]["queries"] == results["single_scan"]["scans"] == 1
+
+
+def test_benchmark_weekly_report():
+    """
+    This function tests that the weekly report scans my_table once instead of once per metric.
+    """
+    conn = duckdb.connect()
+    create_synthetic_events(conn, 1000)
+    create_view(conn)
+    create_my_table(conn)
+    results = benchmark_weekly_report(conn, repeat=1)
+    assert results["separate"]["scans"] >= 3
+    assert results["single_scan"]["scans"] == 1
+
+
+def test_benchmark_pipeline(tmp_path):
+    """
+    This function tests that every stage is measured, and that saved results can be compared.
+    """
+    path = str(tmp_path / "events.parquet")
+    write_synthetic_events(path, n_events=5000)
+    results = benchmark_pipeline(path)
+    assert list(results) == PIPELINE_STAGES
+    assert all(r["seconds"] > 0 and r["peak_memory_mb"] > 0 for r in results.values())
+    assert results["calculate_conversion_rate_per_step_per_week"]["rows"] > 0
+    saved = save_results({"pipeline": results}, {"events": 5000}, str(tmp_path / "benchmarks"))
+    with open(saved) as f:
+        report = json.load(f)
+    assert report["parameters"] == {"events": 5000}
+    ratios = compare_results(report, report)
+    assert ratios["pipeline"]["create_table"] == {"seconds": 1.0, "peak_memory_mb": 1.0}
+
+
+def test_benchmark_lake(tmp_path):
+    """
+    This function tests that a query on the latest week reads less from the lake than from the source file.
+    """
+    path = str(tmp_path / "events.parquet")
+    write_synthetic_events(path, n_events=200000, row_group_size=10000)
+    results = benchmark_lake(path, repeat=1)
+    assert set(results) == {"table", "parquet", "lake"}
+    if results["lake"]["bytes_read"] is not None:
+        assert results["lake"]["bytes_read"] < results["parquet"]["bytes_read"]
+
+
+def test_benchmark_encoding(tmp_path):
+    """
+    This function tests that both encodings are measured.
+    """
+    path = str(tmp_path / "events.parquet")
+    write_synthetic_events(path, n_sessions=2000)
+    results = benchmark_encoding(path, repeat=1)
+    assert list(results) == ["varchar", "enum"]
+    assert all(r["database_bytes"] > 0 and r["create_my_table"]["peak_memory_mb"] > 0 for r in results.values())
+    assert results["enum"]["create_table"]["seconds"] > results["enum"]["discover_vocabularies"]["seconds"]
+
+
+def test_benchmark_quality(tmp_path):
+    """
+    This function tests that the checks, with the flags of the sessions, are measured against the load.
+    """
+    path = str(tmp_path / "events.parquet")
+    write_synthetic_events(path, n_sessions=2000)
+    results = benchmark_quality(path, repeat=1)
+    assert results["check_events"]["rows"] == len(QUALITY_RULES) - len(SESSION_RULES)
+    assert results["create_my_table_checked"]["seconds"] > 0 and "seconds" in results["check_sessions"]
+    assert results["fraction_of_load"] < 1
+
+
+def test_benchmark_journeys(tmp_path):
+    """
+    This function tests that every lookup is measured.
+    """
+    path = str(tmp_path / "events.parquet")
+    write_synthetic_events(path, n_sessions=2000)
+    results = benchmark_journeys(path, lookups=10)
+    assert all(r["p99_ms"] >= r["p50_ms"] > 0 for name, r in results.items() if name != "create_session_journeys")
+
+
+def test_benchmark_chunks(tmp_path):
+    """
+    This function tests that every number of chunks is measured.
+    """
+    path = str(tmp_path / "events.parquet")
+    write_synthetic_events(path, n_sessions=2000)
+    results = benchmark_chunks(path, chunks=(1, 4))
+    assert list(results) == ["1_chunks", "4_chunks"]
+    assert all(r["seconds"] > 0 and r["scan_seconds"] > 0 for r in results.values())
+
+
+def test_benchmark_sharding(tmp_path):
+    """
+    This function tests that every number of workers is measured.
+    """
+    path = str(tmp_path / "events.parquet")
+    write_synthetic_events(path, n_sessions=2000)
+    results = benchmark_sharding(path, workers=(1, 2))
+    assert list(results) == ["single_process", "1_workers", "2_workers"]
+    assert results["single_process"]["speedup"] == 1
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline on synthetic data")
+    parser.add_argument("--events", type=int, default=1_000_000)
+    parser.add_argument("--sessions", type=int)
+    parser.add_argument("--steps", type=int, default=len(FUNNEL))
+    parser.add_argument("--products", type=int, default=10)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4],
+                        help="Numbers of workers of the sharded build")
+    parser.add_argument("--output", default="benchmarks", help="Directory of the JSON results")
+    parser.add_argument("--compare", nargs=2, metavar=("BASELINE", "CURRENT"),
+                        help="Compare two saved results instead of running the benchmark")
+    args = parser.parse_args()
+    if args.compare:
+        reports = []
+        for path in args.compare:
+            with open(path) as f:
+                reports.append(json.load(f))
+        print(json.dumps(compare_results(*reports), indent=2))
+    else:
+        sessions = args.sessions or sessions_for_events(args.events, args.steps)
+        parameters = {"events": args.events, "sessions": sessions, "steps": args.steps, "products": args.products}
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "events.parquet")
+            parameters.update(write_synthetic_events(
+                path, n_sessions=sessions, n_steps=args.steps, n_products=args.products))
+            results = {
+                "pipeline": benchmark_pipeline(path),
+                "lake": benchmark_lake(path),
+                "sharding": benchmark_sharding(path, tuple(args.workers)),
+                "chunks": benchmark_chunks(path),
+                "encoding": benchmark_encoding(path),
+                "journeys": benchmark_journeys(path),
+                "quality": benchmark_quality(path),
+            }
+        results["session_build"] = benchmark_session_build(sessions)
+        conn = duckdb.connect()
+        create_synthetic_events(conn, sessions)
+        create_view(conn)
+        create_my_table(conn)
+        results["conversion_rate"] = benchmark_conversion_rate(conn)
+        results["step_encoding"] = benchmark_step_encoding(conn)
+        results["weekly_report"] = benchmark_weekly_report(conn)
+        print(json.dumps(results, indent=2))
+        save_results(results, parameters, args.output)
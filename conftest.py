@@ -0,0 +1,31 @@
+import pytest
+from types import SimpleNamespace
+from testing import serve_file, write_fixture_parquet
+
+
+@pytest.fixture
+def service(tmp_path, monkeypatch):
+    """
+    This fixture serves the fixture parquet over HTTP, standing in for the data URL, and points
+    the app of main.py to a database of its own, without the periodic refresh. It yields the
+    server with its url, the source file it serves, the path the data is downloaded to, the
+    database, the app and `set`, which patches other settings of main.py for the test.
+    """
+    import main
+    from fastapi.testclient import TestClient
+    source = str(tmp_path / "source.parquet")
+    write_fixture_parquet(source)
+    server = serve_file(source)
+
+    def set(**settings):
+        for name, value in settings.items():
+            monkeypatch.setattr(main, name, value)
+
+    database = str(tmp_path / "data.db")
+    set(PERSISTENT_STORAGE_PATH=database, REFRESH_INTERVAL_SECONDS=0)
+    try:
+        yield SimpleNamespace(
+            server=server, url=server.url, source=source, path=str(tmp_path / "file.parquet"),
+            database=database, app=main.app, client=lambda: TestClient(main.app), set=set)
+    finally:
+        server.shutdown()
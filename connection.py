@@ -0,0 +1,157 @@
+import duckdb
+import re
+import threading
+from contextlib import contextmanager
+
+
+def connection_config(threads: int = None, memory_limit: str = None, temp_directory: str = None) -> dict:
+    """
+    This function returns the configuration of a connection to DuckDB from the execution profile.
+    With a memory limit, the operators that can spill write to the temporary directory instead of
+    going over it, so datasets larger than the memory can be processed.
+
+    Args:
+        threads (int, optional): Number of threads DuckDB uses. Defaults to DuckDB's default.
+        memory_limit (str, optional): Memory limit of DuckDB, like "4GB". Defaults to DuckDB's default.
+        temp_directory (str, optional): Directory the data spilled to disk is written to. Defaults to DuckDB's default.
+
+    Returns:
+        dict: The configuration for duckdb.connect
+    """
+    config = {"threads": threads, "memory_limit": memory_limit, "temp_directory": temp_directory}
+    return {key: value for key, value in config.items() if value is not None}
+
+
+MEMORY_UNITS = {
+    "b": 1, "kb": 1000, "mb": 1000 ** 2, "gb": 1000 ** 3, "tb": 1000 ** 4,
+    "k": 1000, "m": 1000 ** 2, "g": 1000 ** 3, "t": 1000 ** 4,
+    "kib": 1024, "mib": 1024 ** 2, "gib": 1024 ** 3, "tib": 1024 ** 4,
+}
+
+
+def split_memory_limit(memory_limit: str, parts: int) -> str:
+    """
+    This function divides a memory limit of DuckDB, like "4GB", in equal parts, for processes
+    that share the memory of the limit.
+
+    Args:
+        memory_limit (str): Memory limit of DuckDB, with the units DuckDB accepts
+        parts (int): Number of parts
+
+    Returns:
+        str: The memory limit of every part, in bytes
+    """
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([a-zA-Z]+)\s*", memory_limit)
+    if match is None or match.group(2).lower() not in MEMORY_UNITS:
+        raise ValueError(f"Invalid memory limit {memory_limit!r}, expected a size like '4GB'")
+    size = float(match.group(1)) * MEMORY_UNITS[match.group(2).lower()]
+    return f"{int(size // parts)}B"
+
+
+class ConnectionManager:
+    """
+    This class holds the connection of the application to the database.
+    There is a single writer connection, used by one pipeline run at a time, and every reader
+    gets its own cursor of it. DuckDB gives every cursor its own transaction, so readers keep
+    seeing the last committed data while a rebuild is running.
+
+    Args:
+        database (str): Path to the database
+        threads (int, optional): Number of threads DuckDB uses. Defaults to DuckDB's default.
+        memory_limit (str, optional): Memory limit of DuckDB, like "4GB". Defaults to DuckDB's default.
+        temp_directory (str, optional): Directory the data spilled to disk is written to. Defaults to DuckDB's default.
+    """
+    def __init__(
+        self, database: str, threads: int = None, memory_limit: str = None, temp_directory: str = None):
+        self._conn = duckdb.connect(
+            database=database, read_only=False,
+            config=connection_config(threads, memory_limit, temp_directory))
+        self._write_lock = threading.Lock()
+
+    @contextmanager
+    def writer(self):
+        """
+        This method yields the writer connection, waiting for any other writer to finish. A transaction
+        left open by a failing writer is rolled back, so the next writer gets a usable connection.
+        """
+        with self._write_lock:
+            try:
+                yield self._conn
+            except Exception:
+                try:
+                    self._conn.rollback()
+                except duckdb.TransactionException:
+                    pass
+                raise
+
+    @contextmanager
+    def reader(self):
+        """
+        This method yields a new cursor of the database, closed when the reader is done.
+        """
+        cursor = self._conn.cursor()
+        try:
+            yield cursor
+        finally:
+            cursor.close()
+
+    def close(self) -> None:
+        """
+        This method closes the writer connection, and with it every cursor.
+        """
+        self._conn.close()
+
+
+def test_readers_see_committed_data(tmp_path):
+    """
+    This function tests that a reader does not see the writes of an open transaction.
+    """
+    connections = ConnectionManager(
+        str(tmp_path / "data.db"), threads=2, memory_limit="256MB", temp_directory=str(tmp_path / "spill"))
+    with connections.writer() as conn:
+        conn.execute("CREATE TABLE t AS SELECT 1 AS a")
+        conn.begin()
+        conn.execute("INSERT INTO t VALUES (2)")
+        with connections.reader() as cursor:
+            assert cursor.execute("SELECT count(*) FROM t").fetchone()[0] == 1
+            assert cursor.execute("SELECT current_setting('threads')").fetchone()[0] == 2
+            assert cursor.execute("SELECT current_setting('temp_directory')").fetchone()[0] == str(tmp_path / "spill")
+        conn.commit()
+    with connections.reader() as cursor:
+        assert cursor.execute("SELECT count(*) FROM t").fetchone()[0] == 2
+    connections.close()
+
+
+def test_writer_rolls_back_on_error(tmp_path):
+    """
+    This function tests that a writer failing inside a transaction leaves the connection usable.
+    """
+    import pytest
+    connections = ConnectionManager(str(tmp_path / "data.db"))
+    with connections.writer() as conn:
+        conn.execute("CREATE TABLE t AS SELECT 1 AS a")
+    with pytest.raises(duckdb.ConversionException):
+        with connections.writer() as conn:
+            conn.begin()
+            conn.execute("INSERT INTO t VALUES (2)")
+            conn.execute("INSERT INTO t VALUES ('not a number')")
+    with pytest.raises(ValueError):
+        with connections.writer() as conn:
+            raise ValueError("no transaction open")
+    with connections.writer() as conn:
+        conn.execute("INSERT INTO t VALUES (3)")
+        assert conn.execute("SELECT list(a ORDER BY a) FROM t").fetchone()[0] == [1, 3]
+    connections.close()
+
+
+def test_split_memory_limit():
+    """
+    This function tests that the memory limit is divided in the units DuckDB accepts.
+    """
+    import pytest
+    assert split_memory_limit("4GB", 4) == "1000000000B"
+    assert split_memory_limit("1.5 GiB", 3) == f"{512 * 1024 ** 2}B"
+    conn = duckdb.connect(config={"memory_limit": split_memory_limit("512mb", 2)})
+    assert conn.execute("SELECT current_setting('memory_limit')").fetchone()[0] == "244.1 MiB"
+    with pytest.raises(ValueError):
+        split_memory_limit("80%", 2)
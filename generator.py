@@ -0,0 +1,174 @@
+import duckdb
+import argparse
+import math
+
+FUNNEL = ["landing", "login-options", "sign-up", "checkout", "purchase"]
+
+
+def funnel_steps(n_steps: int = len(FUNNEL)) -> list:
+    """
+    This function returns the steps of a synthetic funnel: the steps of FUNNEL, with extra
+    steps named step-6, step-7... inserted before the purchase step.
+
+    Args:
+        n_steps (int, optional): Number of steps, at least 5. Defaults to 5.
+
+    Returns:
+        list: Names of the steps in funnel order
+    """
+    if n_steps < len(FUNNEL):
+        raise ValueError(f"The funnel must have at least {len(FUNNEL)} steps, not {n_steps}")
+    extra = [f"step-{i + 1}" for i in range(len(FUNNEL), n_steps)]
+    return FUNNEL[:-1] + extra + FUNNEL[-1:]
+
+
+def _synthetic_events_select(
+    n_sessions: int, n_users: int = None, n_weeks: int = 8,
+        n_steps: int = len(FUNNEL), n_products: int = 10, seed: int = 0) -> str:
+    """
+    This function returns the query generating the synthetic events, with the same columns and
+    nested event_params as the source parquet. The arguments are the ones of create_synthetic_events.
+    """
+    n_users = n_users or max(n_sessions // 2, 1)
+    steps = funnel_steps(n_steps)
+    return f"""
+    WITH sessions AS (
+        SELECT
+            i AS session_id,
+            'u' || (hash(i, {seed}, 'user') % {n_users}) AS user_pseudo_id,
+            (1672617600000 + hash(i, {seed}, 'start') % {n_weeks * 604800000})::BIGINT AS start_ts,
+            (1 + hash(i, {seed}, 'depth') % {len(steps)})::BIGINT AS depth,
+            'p' || (hash(i, {seed}, 'product') % {n_products}) AS product,
+            (1 + hash(i, {seed}, 'amount') % 500)::INTEGER AS amount
+        FROM range({n_sessions}::BIGINT) t(i)
+    ), session_events AS (
+        SELECT *, UNNEST(range(depth)) AS position FROM sessions
+    )
+    SELECT
+        start_ts + position * 60000 AS event_timestamp,
+        {steps}[position + 1] AS event_name,
+        (CASE WHEN event_name = 'purchase' THEN [
+            {{'key': 'step', 'value': {{'int_value': NULL, 'string_value': event_name}}}},
+            {{'key': 'product', 'value': {{'int_value': NULL, 'string_value': product}}}},
+            {{'key': 'amount', 'value': {{'int_value': amount, 'string_value': NULL}}}},
+            {{'key': 'currency', 'value': {{'int_value': NULL, 'string_value': 'USD'}}}}
+        ] ELSE [
+            {{'key': 'step', 'value': {{'int_value': NULL, 'string_value': event_name}}}}
+        ] END)::STRUCT(key VARCHAR, value STRUCT(int_value INTEGER, string_value VARCHAR))[] AS event_params,
+        NULL::VARCHAR AS user_id,
+        user_pseudo_id,
+        session_id
+    FROM session_events
+    """
+
+
+def sessions_for_events(n_events: int, n_steps: int = len(FUNNEL)) -> int:
+    """
+    This function returns the number of sessions that give about n_events events, since every
+    session walks a uniformly distributed number of steps of the funnel.
+
+    Args:
+        n_events (int): Number of events wanted
+        n_steps (int, optional): Number of steps of the funnel. Defaults to 5.
+
+    Returns:
+        int: Number of sessions
+    """
+    return max(math.ceil(n_events * 2 / (n_steps + 1)), 1)
+
+
+def create_synthetic_events(
+    conn: duckdb.connect, n_sessions: int, n_users: int = None, n_weeks: int = 8,
+        n_products: int = 10, seed: int = 0, n_steps: int = len(FUNNEL)) -> None:
+    """
+    This function creates the events table with deterministic synthetic sessions.
+    Every session walks the first steps of the funnel, one event per minute, and the
+    sessions that reach the purchase step also carry a product, amount and currency.
+
+    Args:
+        conn (duckdb.connect): Connection to the database
+        n_sessions (int): Number of sessions
+        n_users (int, optional): Number of distinct users. Defaults to n_sessions / 2.
+        n_weeks (int, optional): Number of weeks the sessions are spread over. Defaults to 8.
+        n_products (int, optional): Number of distinct products. Defaults to 10.
+        seed (int, optional): Seed of the generator. Defaults to 0.
+        n_steps (int, optional): Number of steps of the funnel. Defaults to 5.
+    """
+    conn.execute(f"""
+    CREATE OR REPLACE TABLE events AS
+    {_synthetic_events_select(n_sessions, n_users, n_weeks, n_steps, n_products, seed)}
+    """)
+    print(f"Table events created with {n_sessions} synthetic sessions")
+
+
+def write_synthetic_events(
+    path: str, n_events: int = None, n_sessions: int = None, n_users: int = None,
+        n_weeks: int = 8, n_steps: int = len(FUNNEL), n_products: int = 10,
+        seed: int = 0, row_group_size: int = 122880) -> dict:
+    """
+    This function writes a parquet file of deterministic synthetic events, with the schema
+    create_table expects. The events are generated and written in a single streaming query,
+    so files much larger than memory can be written. The same arguments always give the same file.
+
+    Args:
+        path (str): Path of the parquet file
+        n_events (int, optional): Approximate number of events, used when n_sessions is not given.
+        n_sessions (int, optional): Number of sessions. Defaults to the ones giving n_events.
+        n_users (int, optional): Number of distinct users. Defaults to n_sessions / 2.
+        n_weeks (int, optional): Number of weeks the sessions are spread over. Defaults to 8.
+        n_steps (int, optional): Number of steps of the funnel, at least 5. Defaults to 5.
+        n_products (int, optional): Number of distinct products. Defaults to 10.
+        seed (int, optional): Seed of the generator. Defaults to 0.
+        row_group_size (int, optional): Rows per row group of the file. Defaults to 122880.
+
+    Returns:
+        dict: Number of events and sessions written
+    """
+    if n_sessions is None:
+        if n_events is None:
+            raise ValueError("Either n_events or n_sessions must be given")
+        n_sessions = sessions_for_events(n_events, n_steps)
+    conn = duckdb.connect()
+    conn.execute("SET preserve_insertion_order = true")
+    events = conn.execute(f"""
+    COPY ({_synthetic_events_select(n_sessions, n_users, n_weeks, n_steps, n_products, seed)})
+    TO '{path}' (FORMAT PARQUET, ROW_GROUP_SIZE {row_group_size})
+    """).fetchone()[0]
+    conn.close()
+    print(f"{events} synthetic events of {n_sessions} sessions written to {path}")
+    return {"events": events, "sessions": n_sessions}
+
+
+def test_write_synthetic_events(tmp_path):
+    """
+    This function tests that the generated file is deterministic and goes through the pipeline.
+    """
+    from utils import create_table, create_view, create_my_table, file_fingerprint
+    first, second = str(tmp_path / "first.parquet"), str(tmp_path / "second.parquet")
+    counts = write_synthetic_events(first, n_events=10000, n_steps=7, n_products=3)
+    write_synthetic_events(second, n_events=10000, n_steps=7, n_products=3)
+    assert file_fingerprint(first) == file_fingerprint(second)
+    assert counts["sessions"] == 2500 and abs(counts["events"] - 10000) < 1000
+    conn = duckdb.connect()
+    create_table(conn, path=first)
+    create_view(conn)
+    create_my_table(conn)
+    assert conn.execute("SELECT count(*) FROM events").fetchone()[0] == counts["events"]
+    assert conn.execute("SELECT count(*) FROM steps_dictionary").fetchone()[0] == 7
+    assert conn.execute("SELECT count(DISTINCT product) FROM my_table").fetchone()[0] == 3
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write a parquet file of synthetic events")
+    parser.add_argument("path")
+    parser.add_argument("--events", type=int, default=1_000_000)
+    parser.add_argument("--sessions", type=int)
+    parser.add_argument("--users", type=int)
+    parser.add_argument("--weeks", type=int, default=8)
+    parser.add_argument("--steps", type=int, default=len(FUNNEL))
+    parser.add_argument("--products", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    write_synthetic_events(
+        args.path, n_events=args.events, n_sessions=args.sessions, n_users=args.users,
+        n_weeks=args.weeks, n_steps=args.steps, n_products=args.products, seed=args.seed)
@@ -0,0 +1,304 @@
+import duckdb
+import json
+import os
+import resource
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+STAGE_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900)
+ENDPOINT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _labels(labels: dict) -> str:
+    """
+    This function formats labels in the Prometheus text format, like {stage="create_table"}.
+    """
+    if not labels:
+        return ""
+    escaped = [
+        (k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in sorted(labels.items())]
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+class _Metric:
+    """
+    This class holds the series of one metric, keyed by their labels, and renders them in the
+    Prometheus text format.
+    """
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            for labels, value in sorted(self._series.items()):
+                lines += self._render_series(dict(labels), value)
+        return lines
+
+    def _render_series(self, labels: dict, value) -> list:
+        return [f"{self.name}{_labels(labels)} {value}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, value: float = 1, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + value
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels) -> None:
+        with self._lock:
+            self._series[tuple(sorted(labels.items()))] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: tuple):
+        super().__init__(name, help)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            counts, total, count = self._series.get(key, ((0,) * len(self.buckets), 0.0, 0))
+            counts = tuple(c + (value <= bound) for c, bound in zip(counts, self.buckets))
+            self._series[key] = (counts, total + value, count + 1)
+
+    def count(self, **labels) -> int:
+        """
+        This method returns the number of observations of one series.
+        """
+        with self._lock:
+            return self._series.get(tuple(sorted(labels.items())), (None, None, 0))[2]
+
+    def _render_series(self, labels: dict, value) -> list:
+        counts, total, count = value
+        return [
+            f"{self.name}_bucket{_labels({**labels, 'le': bound})} {c}"
+            for bound, c in zip(self.buckets, counts)
+        ] + [
+            f"{self.name}_bucket{_labels({**labels, 'le': '+Inf'})} {count}",
+            f"{self.name}_sum{_labels(labels)} {total}",
+            f"{self.name}_count{_labels(labels)} {count}",
+        ]
+
+
+class Registry:
+    """
+    This class holds the metrics of the application and the profiles of the slowest queries.
+
+    Args:
+        slow_queries (int, optional): Number of query profiles kept. Defaults to 10.
+    """
+    def __init__(self, slow_queries: int = 10):
+        self._metrics = {}
+        self._lock = threading.Lock()
+        self.keep_slow_queries = slow_queries
+        self.slow_queries = []
+
+    def _get(self, cls, name: str, help: str, *args) -> _Metric:
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = cls(name, help, *args)
+            return self._metrics[name]
+
+    def counter(self, name: str, help: str) -> Counter:
+        return self._get(Counter, name, help)
+
+    def gauge(self, name: str, help: str) -> Gauge:
+        return self._get(Gauge, name, help)
+
+    def histogram(self, name: str, help: str, buckets: tuple) -> Histogram:
+        return self._get(Histogram, name, help, buckets)
+
+    def record_query(self, query: str, seconds: float, profile) -> None:
+        """
+        This method keeps the profile of a query if it is among the slowest ones seen so far.
+        """
+        with self._lock:
+            self.slow_queries.append({"query": query, "seconds": seconds, "profile": profile})
+            self.slow_queries.sort(key=lambda q: -q["seconds"])
+            del self.slow_queries[self.keep_slow_queries:]
+
+    def render(self) -> str:
+        """
+        This method renders every metric in the Prometheus text format.
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "\n".join(line for metric in metrics for line in metric.render()) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def _current_rss() -> int:
+    """
+    This function returns the resident memory of the process in bytes, or its peak when the
+    current value is not available.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (OSError, IndexError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class _MemorySampler(threading.Thread):
+    """
+    This class samples the resident memory of the process in the background and keeps its peak.
+    """
+    def __init__(self, interval: float = 0.01):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.peak = _current_rss()
+        self._stop_event = threading.Event()
+
+    def run(self) -> None:
+        while not self._stop_event.wait(self.interval):
+            self.peak = max(self.peak, _current_rss())
+
+    def stop(self) -> int:
+        self._stop_event.set()
+        self.join()
+        return max(self.peak, _current_rss())
+
+
+@contextmanager
+def span(stage: str, registry: Registry = REGISTRY):
+    """
+    This function measures a stage of the pipeline: its duration and the peak resident memory of
+    the process while it runs. The caller can add rows and bytes_read to the yielded record.
+    The record is printed as a JSON line and added to the metrics of the registry.
+
+    Args:
+        stage (str): Name of the stage
+        registry (Registry, optional): Registry of the metrics. Defaults to REGISTRY.
+
+    Returns:
+        dict: The record of the span, filled in when the stage finishes
+    """
+    record = {"stage": stage}
+    sampler = _MemorySampler()
+    sampler.start()
+    start = time.perf_counter()
+    try:
+        yield record
+    except Exception as e:
+        record["error"] = type(e).__name__
+        raise
+    finally:
+        record["seconds"] = round(time.perf_counter() - start, 6)
+        record["peak_memory_bytes"] = sampler.stop()
+        registry.histogram(
+            "pipeline_stage_seconds", "Duration of the pipeline stages", STAGE_BUCKETS).observe(
+            record["seconds"], stage=stage)
+        registry.gauge(
+            "pipeline_stage_peak_memory_bytes", "Peak resident memory during the last run of a stage").set(
+            record["peak_memory_bytes"], stage=stage)
+        if "rows" in record:
+            registry.gauge("pipeline_stage_rows", "Rows produced by the last run of a stage").set(
+                record["rows"], stage=stage)
+        if "bytes_read" in record:
+            registry.counter("pipeline_stage_read_bytes_total", "Bytes read by the pipeline stages").inc(
+                record["bytes_read"], stage=stage)
+        if "error" in record:
+            registry.counter("pipeline_stage_failures_total", "Failed runs of the pipeline stages").inc(
+                stage=stage)
+        print(json.dumps(record))
+
+
+class QueryProfiler:
+    """
+    This class wraps a connection and keeps the DuckDB profile, the one EXPLAIN ANALYZE shows, of
+    the queries taking longer than a threshold. DuckDB writes the profile of every query to a
+    file as it runs, so the slow queries are not run a second time. Everything else is passed
+    through to the connection.
+
+    Args:
+        conn (duckdb.connect): Connection to the database
+        threshold_seconds (float, optional): Minimum duration of a profiled query. Defaults to 1.
+        registry (Registry, optional): Registry keeping the slowest profiles. Defaults to REGISTRY.
+    """
+    def __init__(self, conn: duckdb.connect, threshold_seconds: float = 1.0, registry: Registry = REGISTRY):
+        self.conn = conn
+        self.threshold_seconds = threshold_seconds
+        self.registry = registry
+        descriptor, self._path = tempfile.mkstemp(suffix=".json")
+        os.close(descriptor)
+        conn.execute("PRAGMA enable_profiling='json'")
+        conn.execute(f"PRAGMA profiling_output='{self._path}'")
+
+    def execute(self, query: str, parameters: list = None):
+        start = time.perf_counter()
+        result = self.conn.execute(query, parameters)
+        seconds = time.perf_counter() - start
+        if seconds >= self.threshold_seconds:
+            try:
+                with open(self._path) as f:
+                    profile = json.load(f)
+            except (OSError, ValueError):
+                profile = None
+            self.registry.record_query(" ".join(query.split()), round(seconds, 6), profile)
+        return result
+
+    def close(self) -> None:
+        """
+        This method disables the profiling of the connection, which stays open.
+        """
+        self.conn.execute("PRAGMA disable_profiling")
+        os.remove(self._path)
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+
+def test_span_metrics():
+    """
+    This function tests that a span is rendered as a histogram and gauges, also when it fails.
+    """
+    import pytest
+    registry = Registry()
+    with span("create_table", registry) as record:
+        record["rows"] = 10
+        record["bytes_read"] = 100
+    with pytest.raises(ZeroDivisionError):
+        with span("create_view", registry):
+            1 / 0
+    histogram = registry.histogram("pipeline_stage_seconds", "", STAGE_BUCKETS)
+    assert histogram.count(stage="create_table") == histogram.count(stage="create_view") == 1
+    assert record["peak_memory_bytes"] > 0
+    text = registry.render()
+    assert 'pipeline_stage_seconds_bucket{le="+Inf",stage="create_table"} 1' in text
+    assert 'pipeline_stage_rows{stage="create_table"} 10' in text
+    assert 'pipeline_stage_read_bytes_total{stage="create_table"} 100' in text
+    assert 'pipeline_stage_failures_total{stage="create_view"} 1' in text
+
+
+def test_query_profiler():
+    """
+    This function tests that only the slowest queries are kept, with their profile.
+    """
+    registry = Registry(slow_queries=2)
+    profiler = QueryProfiler(duckdb.connect(), threshold_seconds=0, registry=registry)
+    profiler.execute("CREATE TABLE t AS SELECT range AS i FROM range(1000000)")
+    for _ in range(3):
+        assert profiler.execute("SELECT count(*) FROM t WHERE i % ? = 0", [3]).fetchone()[0] == 333334
+    profiler.close()
+    assert len(registry.slow_queries) == 2
+    assert registry.slow_queries[0]["seconds"] >= registry.slow_queries[1]["seconds"]
+    assert all(q["profile"] is not None for q in registry.slow_queries)
@@ -1,24 +1,315 @@
-from utils import *
+from utils import (
+    VocabularyError, append_events, append_lake, create_lake, create_my_table,
+    create_session_journeys, create_table, create_view, discover_vocabularies, download_data,
+    events_select, events_watermark, get_ingestion_state, read_weekly_aggregates, refresh_weekly_aggregates,
+    save_ingestion_state, table_exists, update_my_table, update_session_journeys)
+from store import (
+    RESULT_TABLES, WEEKLY_REPORT, create_result_store, latest_version, publish_results,
+    read_distinct_users, read_distinct_users_batches, read_results, read_results_batches, read_session_journey,
+    read_user_journeys)
+from connection import ConnectionManager, connection_config
+from sharded import build_sharded
+from quality import DataQualityError, check_events, check_sessions, read_quality_report
+from worker import Overloaded, WorkerPool
+from instrumentation import ENDPOINT_BUCKETS, REGISTRY, QueryProfiler, span
+from serialization import JSON, NotAcceptable, negotiate, serialize_batches
+import asyncio
 import duckdb
-from fastapi import FastAPI
+import functools
+import json
+import os
+import pandas as pd
+import pyarrow as pa
+import time
+from contextlib import asynccontextmanager
+from typing import Literal
+from fastapi import FastAPI, Header, HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 
 PERSISTENT_STORAGE_PATH = "/data/data.db"
+PARQUET_PATH = "/data/file.parquet"
+DATA_URL = "https://sde-test-data-sltezl542q-ew.a.run.app/"
+REFRESH_INTERVAL_SECONDS = int(os.environ.get("REFRESH_INTERVAL_SECONDS", 3600))
+INCREMENTAL = os.environ.get("PIPELINE_MODE", "full") == "incremental"
+LAKE_PATH = os.environ.get("LAKE_PATH")
 
-def main():
-    conn = download_data()
-    conn = duckdb.connect(database=PERSISTENT_STORAGE_PATH, read_only=False)
-    create_table(conn)
-    create_view(conn)
-    create_my_table(conn)
-    calculate_purchases_and_revenue_per_product_week(conn)
-    calculate_number_of_users_per_step_per_week(conn)
-    df = calculate_conversion_rate_per_step_per_week(conn)
-    conn.close()
-    return df.to_json(orient='records')
+DUCKDB_THREADS = int(os.environ["DUCKDB_THREADS"]) if "DUCKDB_THREADS" in os.environ else None
+DUCKDB_MEMORY_LIMIT = os.environ.get("DUCKDB_MEMORY_LIMIT")
+DUCKDB_TEMP_DIRECTORY = os.environ.get("DUCKDB_TEMP_DIRECTORY")
+MY_TABLE_CHUNKS = int(os.environ.get("MY_TABLE_CHUNKS", 1))
+WEEKS_PER_CHUNK = int(os.environ["WEEKS_PER_CHUNK"]) if "WEEKS_PER_CHUNK" in os.environ else None
+SHARDS = int(os.environ.get("SHARDS", 1))
+EVENTS_ENCODING = os.environ.get("EVENTS_ENCODING", "varchar")
+SESSION_JOURNEYS = os.environ.get("SESSION_JOURNEYS", "0") == "1"
+QUALITY_CHECKS = os.environ.get("QUALITY_CHECKS", "1") == "1"
+QUALITY_THRESHOLDS = json.loads(os.environ.get("QUALITY_THRESHOLDS", "{}"))
+API_WORKERS = int(os.environ.get("API_WORKERS", 8))
+API_MAX_PENDING = int(os.environ.get("API_MAX_PENDING", 64))
+READ_TIMEOUT_SECONDS = float(os.environ.get("READ_TIMEOUT_SECONDS", 10))
+REFRESH_TIMEOUT_SECONDS = float(os.environ.get("REFRESH_TIMEOUT_SECONDS", 900))
+STREAM_BATCH_SIZE = int(os.environ.get("STREAM_BATCH_SIZE", 10000))
+PROFILE_SLOW_QUERIES_SECONDS = (
+    float(os.environ["PROFILE_SLOW_QUERIES_SECONDS"]) if "PROFILE_SLOW_QUERIES_SECONDS" in os.environ else None)
+
+connections: ConnectionManager = None
+readers: WorkerPool = None
+pipeline: WorkerPool = None
+
+
+def quality_check(check, source: str = None):
+    """
+    This function returns the check of a load of the pipeline, with QUALITY_THRESHOLDS and its own
+    check_quality span, or None when QUALITY_CHECKS is off.
+
+    Args:
+        check (callable): check_events or check_sessions
+        source (str, optional): Source of the events to check, for check_events. Defaults to the events table.
+
+    Returns:
+        callable: Check called with the connection and the condition of the rows to check
+    """
+    if not QUALITY_CHECKS:
+        return None
+    kwargs = {"source": source} if source is not None else {}
+
+    def run(conn: duckdb.connect, where: str) -> None:
+        with span("check_quality") as record:
+            report = check(conn, where, thresholds=QUALITY_THRESHOLDS, **kwargs)
+            record["rows"] = int(report["checked"].iloc[0])
+    return run
+
+
+def run_pipeline(
+    conn: duckdb.connect, url: str = DATA_URL, path: str = PARQUET_PATH,
+        incremental: bool = INCREMENTAL, lake: str = LAKE_PATH) -> int:
+    """
+    This function runs the whole pipeline and publishes its results as a new version.
+    The source is downloaded with a conditional request, and when neither the server nor
+    the sha256 of the file report a change since the last ingestion the rebuild is skipped.
+    In incremental mode only the events newer than the ones already ingested are appended,
+    and only the sessions and weekly partitions they touch are calculated again. They are the
+    events above the watermark of ingestion_state, saved once the results are published, so the
+    events appended by a run that failed halfway are processed again by the next one.
+    When a lake directory is given the events are kept there as partitioned parquet files
+    instead of being copied into the events table. With more than one of SHARDS, a full
+    rebuild builds my_table and the weekly aggregates with a pool of processes.
+    When EVENTS_ENCODING is enum, the low cardinality columns of the events table are stored as
+    ENUM, and new events holding values they do not know trigger a full rebuild.
+    With SESSION_JOURNEYS, the events are also copied into the indexed session_journeys table,
+    which is off by default since it costs about as much as the rest of the build.
+    With QUALITY_CHECKS, which is on by default, the new events are checked in the transaction
+    that writes them to the events table, and the new sessions in the one that writes my_table.
+    DataQualityError is raised when they breach one of QUALITY_THRESHOLDS, which rolls that
+    transaction back, so nothing is published and the previous version is kept. A breach of the
+    sessions rules keeps the events already written, which are checked again by the next run.
+    The events of the lake are not transactional, so they are checked before they are written.
+
+    Args:
+        conn (duckdb.connect): Connection to the database
+        url (str, optional): URL to the data. Defaults to DATA_URL.
+        path (str, optional): Path to save the data. Defaults to PARQUET_PATH.
+        incremental (bool, optional): Update the tables instead of rebuilding them. Defaults to INCREMENTAL.
+        lake (str, optional): Directory of the events lake, None for the events table. Defaults to LAKE_PATH.
+
+    Returns:
+        int: The latest published version
+    """
+    with span("pipeline"):
+        state = get_ingestion_state(conn, url)
+        watermark = state["watermark"] if state is not None else None
+        if state is None or not os.path.exists(path):
+            state = {"etag": None, "last_modified": None, "sha256": None}
+        with span("download_data") as record:
+            download = download_data(url, path, etag=state["etag"], last_modified=state["last_modified"])
+            record["bytes_read"] = os.path.getsize(path) if download["modified"] else 0
+        fingerprint = download["sha256"] if download["modified"] else state["sha256"]
+        latest = latest_version(conn)
+        if latest is not None and latest["source_fingerprint"] == fingerprint:
+            save_ingestion_state(conn, url, download["etag"], download["last_modified"], fingerprint, watermark)
+            print("Source data unchanged, skipping rebuild")
+            return latest["version"]
+        rebuild = not (
+            incremental and watermark is not None and table_exists(conn, "my_table")
+            and table_exists(conn, "weekly_conversion_rate"))
+        if not rebuild:
+            appended = events_watermark(conn)
+            try:
+                with span("append_events") as record:
+                    if lake is None:
+                        record["rows"] = append_events(conn, appended, path=path, check=quality_check(check_events))
+                    else:
+                        check = quality_check(check_events, source=f"({events_select(path)})")
+                        if check is not None:
+                            check(conn, f"event_timestamp > {int(appended)}")
+                        record["rows"] = append_lake(conn, appended, path=path, lake=lake)
+                    record["bytes_read"] = os.path.getsize(path)
+            except VocabularyError as e:
+                print(f"{e}, rebuilding")
+                rebuild = True
+        if not rebuild:
+            with span("update_my_table") as record:
+                partitions = update_my_table(conn, watermark, check=quality_check(check_sessions))
+                record["rows"] = len(partitions)
+            with span("refresh_weekly_aggregates"):
+                refresh_weekly_aggregates(conn, partitions, weeks_per_chunk=WEEKS_PER_CHUNK)
+        else:
+            partitions = None
+            vocabularies = None
+            if EVENTS_ENCODING == "enum" and lake is None:
+                with span("discover_vocabularies") as record:
+                    vocabularies = discover_vocabularies(conn, path=path)
+                    record["rows"] = sum(len(values or []) for values in vocabularies.values())
+            with span("create_table") as record:
+                if lake is None:
+                    create_table(conn, path=path, vocabularies=vocabularies, check=quality_check(check_events))
+                else:
+                    check = quality_check(check_events, source=f"({events_select(path)})")
+                    if check is not None:
+                        check(conn, "TRUE")
+                    create_lake(conn, path=path, lake=lake)
+                record["rows"] = conn.execute("SELECT count(*) FROM events").fetchone()[0]
+                record["bytes_read"] = os.path.getsize(path)
+            with span("create_view"):
+                create_view(conn)
+            if SHARDS > 1:
+                with span("build_sharded") as record:
+                    build_sharded(
+                        conn, path=path, shards=SHARDS, directory=DUCKDB_TEMP_DIRECTORY,
+                        vocabularies=vocabularies, memory_limit=DUCKDB_MEMORY_LIMIT,
+                        temp_directory=DUCKDB_TEMP_DIRECTORY, check=quality_check(check_sessions))
+                    record["rows"] = conn.execute("SELECT count(*) FROM my_table").fetchone()[0]
+            else:
+                with span("create_my_table") as record:
+                    create_my_table(conn, chunks=MY_TABLE_CHUNKS, check=quality_check(check_sessions))
+                    record["rows"] = conn.execute("SELECT count(*) FROM my_table").fetchone()[0]
+                with span("refresh_weekly_aggregates"):
+                    refresh_weekly_aggregates(conn, weeks_per_chunk=WEEKS_PER_CHUNK)
+        if SESSION_JOURNEYS:
+            if rebuild or not table_exists(conn, "session_journeys"):
+                with span("create_session_journeys") as record:
+                    create_session_journeys(conn)
+                    record["rows"] = conn.execute("SELECT count(*) FROM session_journeys").fetchone()[0]
+            else:
+                with span("update_session_journeys") as record:
+                    record["rows"] = update_session_journeys(conn, watermark)
+        with span("publish_results"):
+            version = publish_results(conn, read_weekly_aggregates(conn), fingerprint, partitions=partitions)
+        save_ingestion_state(
+            conn, url, download["etag"], download["last_modified"], fingerprint, events_watermark(conn))
+        return version
+
+
+def main(
+    url: str = DATA_URL, path: str = PARQUET_PATH,
+        database: str = PERSISTENT_STORAGE_PATH, incremental: bool = INCREMENTAL,
+        lake: str = LAKE_PATH) -> int:
+    """
+    This function runs the pipeline on its own connection to the database.
+
+    Args:
+        url (str, optional): URL to the data. Defaults to DATA_URL.
+        path (str, optional): Path to save the data. Defaults to PARQUET_PATH.
+        database (str, optional): Path to the database. Defaults to PERSISTENT_STORAGE_PATH.
+        incremental (bool, optional): Update the tables instead of rebuilding them. Defaults to INCREMENTAL.
+        lake (str, optional): Directory of the events lake, None for the events table. Defaults to LAKE_PATH.
+
+    Returns:
+        int: The latest published version
+    """
+    conn = duckdb.connect(database=database, read_only=False, config=connection_config(
+        DUCKDB_THREADS, DUCKDB_MEMORY_LIMIT, DUCKDB_TEMP_DIRECTORY))
+    try:
+        return run_pipeline(conn, url, path, incremental, lake)
+    finally:
+        conn.close()
+
+
+def refresh() -> int:
+    """
+    This function runs the pipeline on the writer connection of the application,
+    making sure only one run happens at a time.
 
+    Returns:
+        int: The published version
+    """
+    with connections.writer() as conn:
+        if PROFILE_SLOW_QUERIES_SECONDS is None:
+            return run_pipeline(conn)
+        profiler = QueryProfiler(conn, PROFILE_SLOW_QUERIES_SECONDS)
+        try:
+            return run_pipeline(profiler)
+        finally:
+            profiler.close()
 
-app = FastAPI()
+
+async def run_in_pool(pool: WorkerPool, function, *args, key=None, timeout: float = None):
+    """
+    This function runs a blocking function on one of the worker pools for an endpoint,
+    answering 503 when the pool is full and 504 when the result takes too long.
+    """
+    try:
+        return await pool.run(function, *args, key=key, timeout=timeout)
+    except Overloaded:
+        raise HTTPException(status_code=503, detail="The service is busy", headers={"Retry-After": "1"})
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="The request timed out")
+
+
+async def stream_in_pool(pool: WorkerPool, function, *args, timeout: float = None):
+    """
+    This function streams the items of a blocking generator produced on one of the worker pools,
+    answering 503 when the pool is full and 504 when the first item takes too long. Later items
+    are produced on the pool too, so a response being sent keeps its slot and its cursor within
+    the bounds of the pool, and the response is cut if one of them takes longer than the timeout.
+    """
+    try:
+        return await pool.stream(function, *args, timeout=timeout)
+    except Overloaded:
+        raise HTTPException(status_code=503, detail="The service is busy", headers={"Retry-After": "1"})
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="The request timed out")
+
+
+async def refresh_periodically(interval: int = REFRESH_INTERVAL_SECONDS) -> None:
+    """
+    This function refreshes the results every `interval` seconds. The runs go through the
+    pipeline pool, so they are coalesced with the ones requested to the refresh endpoint.
+
+    Args:
+        interval (int, optional): Seconds between runs. Defaults to REFRESH_INTERVAL_SECONDS.
+    """
+    while True:
+        try:
+            await pipeline.run(refresh, key="refresh")
+        except Exception as e:
+            print(f"Scheduled refresh failed: {e}")
+        await asyncio.sleep(interval)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global connections, readers, pipeline
+    connections = ConnectionManager(
+        PERSISTENT_STORAGE_PATH, threads=DUCKDB_THREADS, memory_limit=DUCKDB_MEMORY_LIMIT,
+        temp_directory=DUCKDB_TEMP_DIRECTORY)
+    with connections.writer() as conn:
+        create_result_store(conn)
+    readers = WorkerPool(max_workers=API_WORKERS, max_pending=API_MAX_PENDING)
+    pipeline = WorkerPool(max_workers=1, max_pending=1)
+    scheduled = None
+    if REFRESH_INTERVAL_SECONDS > 0:
+        scheduled = asyncio.create_task(refresh_periodically(REFRESH_INTERVAL_SECONDS))
+    yield
+    if scheduled is not None:
+        scheduled.cancel()
+    readers.shutdown()
+    pipeline.shutdown()
+    with connections.writer():
+        connections.close()
+
+
+app = FastAPI(lifespan=lifespan)
 
 
 app.add_middleware(
@@ -29,6 +320,703 @@ app.add_middleware(
 )
 
 
+@app.middleware("http")
+async def measure_requests(request: Request, call_next):
+    start = time.perf_counter()
+    response = await call_next(request)
+    route = request.scope.get("route")
+    REGISTRY.histogram(
+        "http_request_seconds", "Time until the response of an endpoint starts", ENDPOINT_BUCKETS).observe(
+        time.perf_counter() - start, endpoint=route.path if route else "unmatched",
+        method=request.method, status=response.status_code)
+    return response
+
+
+@app.get("/metrics")
+async def metrics():
+    return Response(content=REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/api/v1/profiles")
+async def profiles():
+    return REGISTRY.slow_queries
+
+
+@app.get("/health")
+async def health():
+    return {"status": "ok", "refreshing": pipeline.is_running("refresh"), "pending_reads": readers.pending}
+
+
+@app.post("/api/v1/refresh")
+async def refresh_results():
+    try:
+        return {"version": await run_in_pool(pipeline, refresh, key="refresh", timeout=REFRESH_TIMEOUT_SECONDS)}
+    except DataQualityError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+
+def read_latest_quality_report() -> list:
+    """
+    This function reads the report of the latest quality check for an endpoint.
+
+    Returns:
+        list: One record per rule
+    """
+    with connections.reader() as conn:
+        report = read_quality_report(conn)
+    if report is None:
+        raise HTTPException(status_code=503, detail="No quality check has run yet")
+    return json.loads(report.to_json(orient='records', date_format='iso'))
+
+
+@app.get("/api/v1/quality")
+async def quality():
+    return await run_in_pool(readers, read_latest_quality_report, key="quality", timeout=READ_TIMEOUT_SECONDS)
+
+
+def read_latest_version() -> dict:
+    """
+    This function reads the metadata of the latest completed version for an endpoint.
+
+    Returns:
+        dict: version, built_at and source_fingerprint
+    """
+    with connections.reader() as conn:
+        latest = latest_version(conn)
+    if latest is None:
+        raise HTTPException(status_code=503, detail="No results have been published yet")
+    return latest
+
+
+@app.get("/api/v1/version")
+async def version():
+    return await run_in_pool(readers, read_latest_version, key="version", timeout=READ_TIMEOUT_SECONDS)
+
+
+def read_latest_results(name: str, **kwargs) -> pa.Table:
+    """
+    This function reads a page of a result of the latest completed version for an endpoint, as
+    the Arrow record batches DuckDB returns, so identical concurrent requests can share them.
+    The page is held in memory, so it must be bounded by a limit.
+
+    Args:
+        name (str): Name of the result, one of the keys in RESULT_TABLES
+        **kwargs: Filters and pagination passed to read_results_batches
+
+    Returns:
+        pa.Table: Table with the batches of the page
+    """
+    with connections.reader() as conn:
+        batches = read_results_batches(conn, name, batch_size=STREAM_BATCH_SIZE, **kwargs)
+        if batches is None:
+            raise HTTPException(status_code=503, detail="No results have been published yet")
+        return pa.Table.from_batches(list(batches), batches.schema)
+
+
+def stream_latest_results(name: str, media_type: str, **kwargs):
+    """
+    This function streams a result of the latest completed version for an endpoint, encoded
+    batch by batch as DuckDB returns them. The cursor is closed once the stream is consumed or closed.
+
+    Args:
+        name (str): Name of the result, one of the keys in RESULT_TABLES
+        media_type (str): One of MEDIA_TYPES
+        **kwargs: Filters passed to read_results_batches
+
+    Returns:
+        generator: Chunks of bytes of the encoded result
+    """
+    with connections.reader() as conn:
+        batches = read_results_batches(conn, name, batch_size=STREAM_BATCH_SIZE, **kwargs)
+        if batches is None:
+            raise HTTPException(status_code=503, detail="No results have been published yet")
+        yield from serialize_batches(batches, media_type)
+
+
+def response_media_type(accept: str = None) -> str:
+    """
+    This function chooses the media type of a response from the Accept header, answering 406
+    when none of the accepted ones can be served.
+    """
+    try:
+        return negotiate(accept)
+    except NotAcceptable as e:
+        raise HTTPException(status_code=406, detail=str(e))
+
+
+async def stream_table(table: pa.Table, media_type: str) -> StreamingResponse:
+    """
+    This function answers an endpoint with a table encoded batch by batch on the reader pool, in
+    the media type chosen by response_media_type.
+    """
+    batches = table.to_reader(max_chunksize=STREAM_BATCH_SIZE)
+    chunks = await stream_in_pool(
+        readers, functools.partial(serialize_batches, batches, media_type), timeout=READ_TIMEOUT_SECONDS)
+    return StreamingResponse(chunks, media_type=media_type)
+
+
+async def read_metric(name: str, accept: str = None, **kwargs) -> StreamingResponse:
+    """
+    This function answers a metric endpoint with the filtered result, streamed in the media type
+    asked in the Accept header: JSON records, NDJSON, Arrow IPC stream or Parquet. Identical
+    concurrent requests of a page share one read of it, and each one encodes it on its own. A
+    result without a limit is streamed from its own cursor as it is read, so it is never held in memory.
+    """
+    media_type = response_media_type(accept)
+    if kwargs.get("limit") is None:
+        chunks = await stream_in_pool(
+            readers, functools.partial(stream_latest_results, name, media_type, **kwargs),
+            timeout=READ_TIMEOUT_SECONDS)
+        return StreamingResponse(chunks, media_type=media_type)
+    table = await run_in_pool(
+        readers, functools.partial(read_latest_results, name, **kwargs),
+        key=(name, tuple(sorted(kwargs.items()))), timeout=READ_TIMEOUT_SECONDS)
+    return await stream_table(table, media_type)
+
+
 @app.get("/api/v1/main")
-async def root():
-    return main()
\ No newline at end of file
+async def root(accept: str = Header(None)):
+    return await read_metric("conversion_rate", accept)
+
+
+async def read_metric_page(
+    name: str, accept: str, year_from: int, year_to: int, week_from: int,
+        week_to: int, limit: int, offset: int, **filters) -> StreamingResponse:
+    """
+    This function answers a metric endpoint with a page of the filtered result.
+    """
+    return await read_metric(
+        name, accept, years=(year_from, year_to), weeks=(week_from, week_to),
+        limit=limit, offset=offset, **filters)
+
+
+@app.get("/api/v1/metrics/purchases-revenue")
+async def purchases_revenue(
+    year_from: int = None, year_to: int = None, week_from: int = None, week_to: int = None,
+        product: str = None, limit: int = Query(1000, ge=1, le=10000), offset: int = Query(0, ge=0),
+        accept: str = Header(None)):
+    return await read_metric_page(
+        "purchases_revenue", accept, year_from, year_to, week_from, week_to, limit, offset, product=product)
+
+
+@app.get("/api/v1/metrics/users-per-step")
+async def users_per_step(
+    year_from: int = None, year_to: int = None, week_from: int = None, week_to: int = None,
+        limit: int = Query(1000, ge=1, le=10000), offset: int = Query(0, ge=0),
+        accept: str = Header(None)):
+    return await read_metric_page("users_per_step", accept, year_from, year_to, week_from, week_to, limit, offset)
+
+
+@app.get("/api/v1/metrics/conversion-rate")
+async def conversion_rate(
+    year_from: int = None, year_to: int = None, week_from: int = None, week_to: int = None,
+        step: str = None, limit: int = Query(1000, ge=1, le=10000), offset: int = Query(0, ge=0),
+        accept: str = Header(None)):
+    return await read_metric_page(
+        "conversion_rate", accept, year_from, year_to, week_from, week_to, limit, offset, step=step)
+
+
+def stream_latest_weekly_report(years: tuple, weeks: tuple):
+    """
+    This function streams the weekly report of the latest completed version for an endpoint, as
+    one JSON document with the version and the records of every metric in WEEKLY_REPORT. The
+    metrics are read in a single transaction of the cursor, as in read_weekly_report, and each
+    one is encoded batch by batch as DuckDB returns them.
+
+    Args:
+        years (tuple): Years of the inclusive (from, to) range of weeks, None for no bound
+        weeks (tuple): Weeks of the (from, to) years, None for the first or last week
+
+    Returns:
+        generator: Chunks of bytes of the JSON document
+    """
+    with connections.reader() as conn:
+        conn.begin()
+        try:
+            latest = latest_version(conn)
+            if latest is None:
+                raise HTTPException(status_code=503, detail="No results have been published yet")
+            yield f'{{"version":{latest["version"]}'.encode()
+            for name in WEEKLY_REPORT:
+                yield f',"{name}":'.encode()
+                batches = read_results_batches(
+                    conn, name, batch_size=STREAM_BATCH_SIZE, years=years, weeks=weeks)
+                yield from serialize_batches(batches, JSON)
+            yield b"}"
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+
+@app.get("/api/v1/metrics/weekly-report")
+async def weekly_report(
+    year_from: int = None, year_to: int = None, week_from: int = None, week_to: int = None):
+    chunks = await stream_in_pool(
+        readers, functools.partial(stream_latest_weekly_report, (year_from, year_to), (week_from, week_to)),
+        timeout=READ_TIMEOUT_SECONDS)
+    return StreamingResponse(chunks, media_type=JSON)
+
+
+def _journey_events(df: pd.DataFrame) -> list:
+    """
+    This function returns the events of a journey as JSON records, without the columns that
+    identify the session and the user.
+    """
+    return json.loads(df.drop(columns=["session_id", "user_pseudo_id"]).to_json(orient='records'))
+
+
+def read_session(session_id: int) -> dict:
+    """
+    This function reads the journey of one session for an endpoint.
+
+    Args:
+        session_id (int): Session to read
+
+    Returns:
+        dict: session_id, user_pseudo_id and the ordered events of the session
+    """
+    with connections.reader() as conn:
+        df = read_session_journey(conn, session_id)
+    if df is None:
+        raise HTTPException(status_code=503, detail="The session journeys have not been built yet")
+    if df.empty:
+        raise HTTPException(status_code=404, detail=f"Session {session_id} not found")
+    return {"session_id": session_id, "user_pseudo_id": df["user_pseudo_id"].iloc[0], "events": _journey_events(df)}
+
+
+def read_user(user_pseudo_id: str, limit: int = None) -> dict:
+    """
+    This function reads the journeys of all the sessions of one user for an endpoint.
+
+    Args:
+        user_pseudo_id (str): User to read
+        limit (int, optional): Maximum number of events. Defaults to all.
+
+    Returns:
+        dict: user_pseudo_id and its sessions, each one with its ordered events
+    """
+    with connections.reader() as conn:
+        df = read_user_journeys(conn, user_pseudo_id, limit)
+    if df is None:
+        raise HTTPException(status_code=503, detail="The session journeys have not been built yet")
+    if df.empty:
+        raise HTTPException(status_code=404, detail=f"User {user_pseudo_id} not found")
+    return {
+        "user_pseudo_id": user_pseudo_id,
+        "sessions": [
+            {"session_id": int(session_id), "events": _journey_events(events)}
+            for session_id, events in df.groupby("session_id", sort=False)
+        ],
+    }
+
+
+@app.get("/api/v1/sessions/{session_id}")
+async def session(session_id: int):
+    return await run_in_pool(
+        readers, functools.partial(read_session, session_id), key=("session", session_id),
+        timeout=READ_TIMEOUT_SECONDS)
+
+
+@app.get("/api/v1/users/{user_pseudo_id}")
+async def user(user_pseudo_id: str, limit: int = Query(1000, ge=1, le=10000)):
+    return await run_in_pool(
+        readers, functools.partial(read_user, user_pseudo_id, limit), key=("user", user_pseudo_id, limit),
+        timeout=READ_TIMEOUT_SECONDS)
+
+
+def stream_latest_distinct_users(media_type: str, **kwargs):
+    """
+    This function streams the distinct users for an endpoint, counted from the sketches of the
+    latest completed version or exactly from the distinct users published with it, encoded batch
+    by batch. The cursor is closed once the stream is consumed or closed.
+
+    Args:
+        media_type (str): One of MEDIA_TYPES
+        **kwargs: Arguments of read_distinct_users_batches
+
+    Returns:
+        generator: Chunks of bytes of the encoded counts
+    """
+    with connections.reader() as conn:
+        batches = read_distinct_users_batches(conn, batch_size=STREAM_BATCH_SIZE, **kwargs)
+        if batches is None:
+            raise HTTPException(status_code=503, detail="No results have been published yet")
+        yield from serialize_batches(batches, media_type)
+
+
+@app.get("/api/v1/metrics/users")
+async def distinct_users(
+    dimension: Literal["step", "product"] = "step", value: str = None,
+        year_from: int = None, year_to: int = None, week_from: int = None, week_to: int = None,
+        per_week: bool = True, mode: Literal["approximate", "exact"] = "approximate",
+        accept: str = Header(None)):
+    media_type = response_media_type(accept)
+    kwargs = dict(
+        dimension=dimension, value=value, years=(year_from, year_to), weeks=(week_from, week_to),
+        per_week=per_week, exact=mode == "exact")
+    chunks = await stream_in_pool(
+        readers, functools.partial(stream_latest_distinct_users, media_type, **kwargs), timeout=READ_TIMEOUT_SECONDS)
+    return StreamingResponse(chunks, media_type=media_type)
+
+
+def test_main_skips_unchanged_source(service):
+    """
+    This function tests that the pipeline is not rebuilt when the source has not changed.
+    """
+    from testing import FIXTURE_SESSIONS, write_fixture_parquet
+    assert main(service.url, service.path, service.database) == 1
+    conn = duckdb.connect(service.database)
+    assert not table_exists(conn, "session_journeys")
+    conn.execute("INSERT INTO my_table (session_id) VALUES (-1)")
+    assert main(service.url, service.path, service.database) == 1
+    service.server.etag = '"v2"'
+    assert main(service.url, service.path, service.database) == 1
+    assert conn.execute("SELECT count(*) FROM my_table WHERE session_id = -1").fetchone()[0] == 1
+    write_fixture_parquet(service.source, FIXTURE_SESSIONS[:2])
+    service.server.etag = '"v3"'
+    assert main(service.url, service.path, service.database) == 2
+    conn.close()
+
+
+def _check_main_incremental(tmp_path, service, lake: bool) -> None:
+    """
+    This function checks that the incremental mode publishes the same results as a full rebuild,
+    with the events in a table or in the lake.
+    """
+    from testing import FIXTURE_SESSIONS, write_fixture_parquet
+    lake = str(tmp_path / "events") if lake else None
+    write_fixture_parquet(service.source, FIXTURE_SESSIONS[:2])
+    main(service.url, str(tmp_path / "a.parquet"), str(tmp_path / "incremental.db"), incremental=True, lake=lake)
+    write_fixture_parquet(service.source)
+    service.server.etag = '"v2"'
+    main(service.url, str(tmp_path / "a.parquet"), str(tmp_path / "incremental.db"), incremental=True, lake=lake)
+    main(service.url, str(tmp_path / "b.parquet"), str(tmp_path / "full.db"), incremental=False)
+    incremental, full = duckdb.connect(str(tmp_path / "incremental.db")), duckdb.connect(str(tmp_path / "full.db"))
+    for name in RESULT_TABLES:
+        pd.testing.assert_frame_equal(read_results(incremental, name), read_results(full, name))
+    for dimension in ("step", "product"):
+        pd.testing.assert_frame_equal(
+            read_distinct_users(incremental, dimension, exact=True), read_distinct_users(full, dimension, exact=True))
+
+
+def test_main_incremental(tmp_path, service):
+    """
+    This function tests that the incremental mode publishes the same results as a full rebuild.
+    """
+    _check_main_incremental(tmp_path, service, lake=False)
+
+
+def test_main_incremental_lake(tmp_path, service):
+    """
+    This function tests that the incremental mode publishes the same results as a full rebuild,
+    with the events in the lake.
+    """
+    _check_main_incremental(tmp_path, service, lake=True)
+
+
+def test_main_incremental_recovers_failed_run(tmp_path, service):
+    """
+    This function tests that the events appended by an incremental run that fails before updating
+    my_table are processed by the next run, which publishes the same results as a full rebuild.
+    """
+    import pytest
+    from testing import FIXTURE_SESSIONS, write_fixture_parquet
+    service.set(SESSION_JOURNEYS=True)
+    write_fixture_parquet(service.source, FIXTURE_SESSIONS[:2])
+    assert main(service.url, service.path, service.database, incremental=True) == 1
+    write_fixture_parquet(service.source)
+    service.server.etag = '"v2"'
+
+    def fail(*args, **kwargs):
+        raise RuntimeError("update_my_table failed")
+
+    update = update_my_table
+    service.set(update_my_table=fail)
+    with pytest.raises(RuntimeError):
+        main(service.url, service.path, service.database, incremental=True)
+    conn = duckdb.connect(service.database)
+    assert conn.execute("SELECT count(DISTINCT session_id) FROM events").fetchone()[0] == 4
+    assert conn.execute("SELECT count(*) FROM my_table").fetchone()[0] == 2
+    conn.close()
+    service.set(update_my_table=update)
+    assert main(service.url, service.path, service.database, incremental=True) == 2
+    main(service.url, str(tmp_path / "b.parquet"), str(tmp_path / "full.db"), incremental=False)
+    incremental, full = duckdb.connect(service.database), duckdb.connect(str(tmp_path / "full.db"))
+    assert incremental.execute("SELECT count(*) FROM events").fetchone()[0] == 11
+    for name in RESULT_TABLES:
+        pd.testing.assert_frame_equal(read_results(incremental, name), read_results(full, name))
+    assert incremental.execute("SELECT count(*) FROM session_journeys").fetchone()[0] == 11
+
+
+def test_main_sharded(tmp_path, service):
+    """
+    This function tests that the sharded build publishes the same results as a single process.
+    """
+    main(service.url, str(tmp_path / "a.parquet"), str(tmp_path / "single.db"), incremental=False)
+    service.set(SHARDS=2)
+    main(service.url, str(tmp_path / "b.parquet"), str(tmp_path / "sharded.db"), incremental=False)
+    single, sharded = duckdb.connect(str(tmp_path / "single.db")), duckdb.connect(str(tmp_path / "sharded.db"))
+    for name in RESULT_TABLES:
+        pd.testing.assert_frame_equal(read_results(sharded, name), read_results(single, name))
+
+
+def test_main_enum_encoding(tmp_path, service):
+    """
+    This function tests that the ENUM encoding publishes the same results, also when new events
+    bring values missing from the ENUM columns and the incremental run falls back to a rebuild.
+    """
+    from testing import FIXTURE_SESSIONS, write_fixture_parquet
+    main(service.url, str(tmp_path / "a.parquet"), str(tmp_path / "varchar.db"), incremental=False)
+    write_fixture_parquet(service.source, FIXTURE_SESSIONS[:2])
+    service.server.etag = '"v2"'
+    service.set(EVENTS_ENCODING="enum")
+    main(service.url, str(tmp_path / "b.parquet"), str(tmp_path / "enum.db"), incremental=True)
+    write_fixture_parquet(service.source)
+    service.server.etag = '"v3"'
+    main(service.url, str(tmp_path / "b.parquet"), str(tmp_path / "enum.db"), incremental=True)
+    varchar, enum = duckdb.connect(str(tmp_path / "varchar.db")), duckdb.connect(str(tmp_path / "enum.db"))
+    assert enum.execute("SELECT typeof(event_name) FROM events LIMIT 1").fetchone()[0].startswith("ENUM")
+    for name in RESULT_TABLES:
+        pd.testing.assert_frame_equal(read_results(enum, name), read_results(varchar, name))
+
+
+def _check_quality_blocks_publish(service, incremental: bool) -> None:
+    """
+    This function checks that events breaching a quality threshold are not published, and that
+    the previous version, its events and my_table are kept and still served.
+    """
+    import pytest
+    from testing import FIXTURE_SESSIONS, write_fixture_parquet
+    service.set(QUALITY_CHECKS=True, QUALITY_THRESHOLDS={"negative_amount": 0})
+    assert main(service.url, service.path, service.database, incremental=incremental) == 1
+    write_fixture_parquet(service.source, FIXTURE_SESSIONS + [
+        (5, "u4", 1673308800000, ["landing", "checkout", "purchase"], ("p1", -10, "USD"))])
+    service.server.etag = '"v2"'
+    with pytest.raises(DataQualityError, match="negative_amount"):
+        main(service.url, service.path, service.database, incremental=incremental)
+    conn = duckdb.connect(service.database)
+    assert latest_version(conn)["version"] == 1
+    report = read_quality_report(conn).set_index("rule")
+    assert report.loc["negative_amount", "violations"] == 1 and report.loc["negative_amount", "breached"]
+    assert conn.execute("SELECT count(*) FROM events WHERE session_id = 5").fetchone()[0] == 0
+    assert conn.execute("SELECT count(*) FROM my_table").fetchone()[0] == len(FIXTURE_SESSIONS)
+    conn.close()
+    with service.client() as client:
+        response = client.get("/api/v1/metrics/users", params={"dimension": "step", "mode": "exact"})
+        assert response.status_code == 200
+
+
+def test_main_quality_blocks_publish(service):
+    """
+    This function tests that a full rebuild breaching a quality threshold publishes nothing.
+    """
+    _check_quality_blocks_publish(service, incremental=False)
+
+
+def test_main_quality_blocks_publish_incremental(service):
+    """
+    This function tests that an incremental run breaching a quality threshold publishes nothing.
+    """
+    _check_quality_blocks_publish(service, incremental=True)
+
+
+def test_main_session_quality_blocks_publish(service):
+    """
+    This function tests that sessions breaching a quality threshold roll my_table back and publish
+    nothing, while the events already appended are checked again by the next run.
+    """
+    import pytest
+    from testing import FIXTURE_SESSIONS, write_fixture_parquet
+    service.set(QUALITY_CHECKS=True, QUALITY_THRESHOLDS={"out_of_order_steps": 0})
+    assert main(service.url, service.path, service.database, incremental=True) == 1
+    write_fixture_parquet(service.source, FIXTURE_SESSIONS + [
+        (5, "u4", 1673308800000, ["checkout", "landing", "purchase"], ("p1", 10, "USD"))])
+    service.server.etag = '"v2"'
+    for _ in range(2):
+        with pytest.raises(DataQualityError, match="out_of_order_steps"):
+            main(service.url, service.path, service.database, incremental=True)
+    conn = duckdb.connect(service.database)
+    assert latest_version(conn)["version"] == 1
+    assert read_quality_report(conn).set_index("rule").loc["out_of_order_steps", "samples"] == [
+        {"session_id": 5, "event_timestamp": None}]
+    assert conn.execute("SELECT count(*) FROM events WHERE session_id = 5").fetchone()[0] == 3
+    assert conn.execute("SELECT count(*) FROM my_table WHERE session_id = 5").fetchone()[0] == 0
+    conn.close()
+
+
+def _publish_fixture(database: str, path: str) -> None:
+    """
+    This function builds and publishes the results of the fixture parquet into the database.
+    """
+    from testing import write_fixture_parquet
+    write_fixture_parquet(path)
+    conn = duckdb.connect(database)
+    create_table(conn, path=path)
+    create_view(conn)
+    create_my_table(conn)
+    refresh_weekly_aggregates(conn)
+    create_session_journeys(conn)
+    publish_results(conn, read_weekly_aggregates(conn), "a")
+    conn.close()
+
+
+def test_journey_endpoints(service):
+    """
+    This function tests that the journeys of a session and of a user are returned in order.
+    """
+    with service.client() as client:
+        assert client.get("/api/v1/sessions/1").status_code == 503
+    _publish_fixture(service.database, service.path)
+    with service.client() as client:
+        journey = client.get("/api/v1/sessions/1").json()
+        assert journey["user_pseudo_id"] == "u1"
+        assert [e["step"] for e in journey["events"]] == ["landing", "checkout", "purchase"]
+        assert journey["events"][-1] == {
+            "event_timestamp": 1672617720000, "event_name": "purchase", "step": "purchase",
+            "product": "p1", "amount": 100, "currency": "USD"}
+        assert client.get("/api/v1/sessions/5").status_code == 404
+        user = client.get("/api/v1/users/u1").json()
+        assert [(s["session_id"], len(s["events"])) for s in user["sessions"]] == [(1, 3), (3, 3)]
+        user = client.get("/api/v1/users/u1", params={"limit": 4}).json()
+        assert [(s["session_id"], len(s["events"])) for s in user["sessions"]] == [(1, 3), (3, 1)]
+        assert client.get("/api/v1/users/u9").status_code == 404
+
+
+def test_instrumentation(service):
+    """
+    This function tests that a refresh records every stage and the profile of its slow queries,
+    and that the endpoints and stages are exposed in /metrics.
+    """
+    service.set(PROFILE_SLOW_QUERIES_SECONDS=0, run_pipeline=functools.partial(
+        run_pipeline, url=service.url, path=service.path, incremental=False))
+    with service.client() as client:
+        assert client.post("/api/v1/refresh").json() == {"version": 1}
+        assert client.get("/api/v1/main").status_code == 200
+        text = client.get("/metrics").text
+        assert client.get("/api/v1/profiles").json()
+    for stage in ["download_data", "create_table", "create_my_table", "calculate_weekly_report",
+                  "publish_results", "pipeline"]:
+        assert f'pipeline_stage_seconds_count{{stage="{stage}"}}' in text
+    assert 'pipeline_stage_rows{stage="create_table"}' in text
+    assert 'http_request_seconds_count{endpoint="/api/v1/main",method="GET",status="200"}' in text
+
+
+def test_metric_endpoints(service):
+    """
+    This function tests that the metric endpoints return only the requested slice.
+    """
+    import io
+    import pyarrow.parquet as pq
+    with service.client() as client:
+        assert client.get("/api/v1/metrics/conversion-rate").status_code == 503
+        assert client.get("/api/v1/metrics/users", params={"mode": "exact"}).status_code == 503
+        assert client.get("/api/v1/metrics/weekly-report").status_code == 503
+    _publish_fixture(service.database, service.path)
+    with service.client() as client:
+        rows = client.get("/api/v1/metrics/conversion-rate", params={"step": "checkout", "week_from": 2}).json()
+        assert [(r["step"], r["week"], r["total"]) for r in rows] == [("checkout", 2, 1)]
+        rows = client.get("/api/v1/metrics/purchases-revenue", params={"product": "p1"}).json()
+        assert [(r["product"], r["purchases"], r["revenue"]) for r in rows] == [("p1", 1, 100)]
+        assert len(client.get("/api/v1/metrics/users-per-step", params={"limit": 1}).json()) == 1
+        assert client.get("/api/v1/metrics/users-per-step", params={"limit": 0}).status_code == 422
+        response = client.get("/api/v1/main", headers={"Accept": "application/x-ndjson"})
+        assert len(response.text.splitlines()) == len(client.get("/api/v1/main").json())
+        response = client.get("/api/v1/main", headers={"Accept": "application/vnd.apache.arrow.stream"})
+        assert pa.ipc.open_stream(response.content).read_all().to_pylist() == client.get("/api/v1/main").json()
+        response = client.get("/api/v1/metrics/purchases-revenue", headers={"Accept": "application/vnd.apache.parquet"})
+        assert pq.read_table(io.BytesIO(response.content)).column("product").to_pylist() == ["p1", "p2"]
+        assert client.get("/api/v1/main", headers={"Accept": "text/html"}).status_code == 406
+        rows = client.get("/api/v1/metrics/users", params={"dimension": "product", "per_week": False}).json()
+        assert rows == [{"product": "p1", "users": 1}, {"product": "p2", "users": 1}]
+        rows = client.get("/api/v1/metrics/users", params={"value": "landing", "mode": "exact"}).json()
+        assert [(r["week"], r["users"]) for r in rows] == [(1, 2), (2, 2)]
+        assert client.get("/api/v1/metrics/users", params={"mode": "fast"}).status_code == 422
+        report = client.get("/api/v1/metrics/weekly-report", params={"week_from": 2}).json()
+        assert report["version"] == 1
+        assert [(r["step"], r["week"]) for r in report["conversion_rate"]] == [
+            (r["step"], r["week"]) for r in client.get("/api/v1/metrics/conversion-rate", params={"week_from": 2}).json()]
+        assert [r["week"] for r in report["users_per_step"]] == [2]
+        assert report["purchases_revenue"] == client.get("/api/v1/metrics/purchases-revenue", params={"week_from": 2}).json()
+
+
+def test_parallel_reads_during_publish(service):
+    """
+    This function tests that many parallel GETs are served while new versions are published,
+    and that every response holds one complete version.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    def publish(version):
+        df = pd.DataFrame({"total": [version] * 50, "step": ["landing"] * 50, "week": range(50), "year": 2023})
+        with connections.writer() as conn:
+            publish_results(conn, {"conversion_rate": df}, str(version))
+
+    with service.client() as client:
+        publish(1)
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            writes = executor.map(publish, range(2, 12))
+            responses = list(executor.map(lambda _: client.get("/api/v1/main"), range(200)))
+            list(writes)
+    for response in responses:
+        assert response.status_code == 200
+        rows = response.json()
+        assert len(rows) == 50 and len({r["total"] for r in rows}) == 1
+
+
+def test_identical_reads_are_single_flight(service):
+    """
+    This function tests that identical concurrent requests of a page read it once, and that each
+    one still gets the whole response in its own media type, while the results without a limit
+    are streamed from a cursor of every request.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    _publish_fixture(service.database, service.path)
+    reads, read = [], read_results_batches
+
+    def slow_read(*args, **kwargs):
+        reads.append(kwargs.get("limit"))
+        time.sleep(0.5)
+        return read(*args, **kwargs)
+
+    service.set(read_results_batches=slow_read)
+    with service.client() as client:
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            responses = list(executor.map(
+                lambda accept: client.get("/api/v1/metrics/conversion-rate", headers={"Accept": accept}),
+                ["application/json", "application/json", "application/x-ndjson", "application/json"]))
+        assert reads == [1000]
+        assert responses[0].json() == responses[1].json() == responses[3].json()
+        assert len(responses[2].text.splitlines()) == len(responses[0].json())
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            responses = list(executor.map(lambda _: client.get("/api/v1/main"), range(4)))
+        assert reads[1:] == [None] * 4
+        assert all(response.json() == responses[0].json() for response in responses)
+
+
+def test_refresh_is_single_flight(service):
+    """
+    This function tests that concurrent refreshes run the pipeline once, and that the health
+    endpoint and cached reads keep answering while it runs.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    _publish_fixture(service.database, service.path)
+    runs = []
+
+    def slow_refresh():
+        runs.append(1)
+        time.sleep(1)
+        return 2
+
+    service.set(refresh=slow_refresh)
+    with service.client() as client:
+        with ThreadPoolExecutor(max_workers=5) as executor:
+            refreshes = [executor.submit(client.post, "/api/v1/refresh") for _ in range(4)]
+            time.sleep(0.2)
+            start = time.perf_counter()
+            health = client.get("/health")
+            assert client.get("/api/v1/main").status_code == 200
+            assert time.perf_counter() - start < 0.5
+            assert health.json()["refreshing"]
+            assert [r.result().json() for r in refreshes] == [{"version": 2}] * 4
+    assert len(runs) == 1
@@ -1,6 +1,5 @@
 # %%
 import duckdb
-import pandas as pd
 import requests
 conn = duckdb.connect(database='./data/data.db', read_only=False)
 
@@ -66,22 +65,23 @@ conn.execute("""
 # %%
 conn.execute("""
     CREATE OR REPLACE TABLE my_table AS (
-        SELECT DISTINCT ON(session_id) session_id, user_pseudo_id, week(epoch_ms(event_timestamp)) as week,
+        SELECT session_id, first(user_pseudo_id) as user_pseudo_id, week(epoch_ms(event_timestamp)) as week,
         year(epoch_ms(event_timestamp)) as year,
-        list(string_value) FILTER (WHERE key = 'step') over w1 as steps,
-        string_agg(string_value, '') FILTER (WHERE key = 'product') over w1 as product,
-        sum(int_value) FILTER (WHERE key = 'amount') over w1 as amount,
-        string_agg(string_value, '') FILTER (WHERE key = 'currency') over w1 as currency,
+        list_transform(
+            list_sort(list({'event_timestamp': event_timestamp, 'step': string_value}) FILTER (WHERE key = 'step')),
+            s -> s.step) as steps,
+        string_agg(string_value, '') FILTER (WHERE key = 'product') as product,
+        sum(int_value) FILTER (WHERE key = 'amount') as amount,
+        string_agg(string_value, '') FILTER (WHERE key = 'currency') as currency,
             from events_unnested
-            window w1 as (
-            PARTITION BY session_id, year(epoch_ms(event_timestamp)), week(epoch_ms(event_timestamp))
-        )
+            GROUP BY session_id, year, week
     )"""
     )
 
 # The table has the following columns:
 # session_id, user_pseudo_id, week, year, steps, product, amount, currency
-# Where steps is an ordered list of the steps the user has taken in the funnel.
+# There is one row per session, year and week, built with a single grouped aggregation.
+# Where steps is the list of the steps the user has taken in the funnel, ordered by event_timestamp.
 # The product is the product the user has bought. NaN if no purchase was made.
 # The amount is the amount the user has spent. Nan if no purchase was made.
 # The currency is the currency the user has spent in. Nan if no purchase was made.
@@ -150,22 +150,22 @@ conn.execute("""
 
 # %%
 #The following version is in order to get the conversion rate for all steps of the funnel.
-pd.concat(
-    conn.execute(f"""
-        SELECT
-            DISTINCT ON (week)
-            count(*) FILTER (WHERE list_contains(steps, '{i}')) over (PARTITION BY week)  as total,
-            count(*) FILTER (WHERE steps[-1] = '{i}') over (PARTITION BY week) as dropped,
-            round((total::DOUBLE - dropped::DOUBLE) / total::DOUBLE * 100, 2) as conversion_rate,
-            '{i}' as step,
-            week,
-            year
+#The steps of every session are unnested once, so all steps are calculated in a single scan.
+conn.execute("""
+    SELECT
+        count(*) as total,
+        count(*) FILTER (WHERE steps[-1] = step) as dropped,
+        round((total::DOUBLE - dropped::DOUBLE) / total::DOUBLE * 100, 2) as conversion_rate,
+        step,
+        week,
+        year
+    FROM (
+        SELECT year, week, steps, UNNEST(list_distinct(steps)) as step
         FROM my_table
-        QUALIFY 
-            total > 0;
-        """).fetch_df() for i in conn.execute("""
-        select distinct string_value from events_unnested where key = 'step' """).fetch_df()['string_value']
     )
+    GROUP BY year, week, step
+    ORDER BY year, week, step
+""").fetch_df()
 
 
 # Note: I've also done the queries to get the answers with the view events_unnested. They are in the file utils.py
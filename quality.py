@@ -0,0 +1,298 @@
+from instrumentation import REGISTRY, Registry
+import duckdb
+import pandas as pd
+import time
+
+FUNNEL_ORDER = ["landing", "login-options", "sign-up", "checkout", "purchase"]
+
+_FUNNEL_RANKS = (
+    "list_filter(list_transform(step_events, e -> coalesce(list_position(["
+    + ", ".join(f"'{step}'" for step in FUNNEL_ORDER) + "], e.step::VARCHAR), 0)), r -> r > 0)")
+
+PARAM_CHECKS = {
+    # name: condition of a param p, true when one of the params of the event meets it
+    "invalid_type": """(p.key IN ('step', 'product', 'currency') AND p.value.string_value IS NULL)
+        OR (p.key = 'amount' AND p.value.int_value IS NULL)""",
+    "negative_amount": "p.key = 'amount' AND p.value.int_value < 0",
+    "product": "p.key = 'product' AND p.value.string_value IS NOT NULL",
+    "purchase": "p.key = 'step' AND p.value.string_value = 'purchase'",
+}
+
+QUALITY_RULES = {
+    # name: (unit, condition)
+    # The conditions of the events rules can use the checks of PARAM_CHECKS by name. The conditions
+    # of the sessions rules are evaluated on every session and week while my_table is built, and
+    # can use its step_events, sorted by event_timestamp, and shared_user, whether its events
+    # have more than one user_pseudo_id.
+    "missing_mandatory": (
+        "events",
+        "event_timestamp IS NULL OR event_name IS NULL OR user_pseudo_id IS NULL OR session_id IS NULL"),
+    "invalid_timestamp": ("events", "event_timestamp < 0 OR event_timestamp > {now}"),
+    "invalid_param_type": ("events", "{invalid_type}"),
+    "negative_amount": ("events", "{negative_amount}"),
+    "purchase_without_product": ("events", "{purchase} AND NOT {product}"),
+    "duplicate_event": (
+        "sessions",
+        "len(step_events) > len(list_distinct(list_transform(step_events, e -> hash(e.event_timestamp, e.step))))"),
+    "shared_session_id": ("sessions", "shared_user"),
+    "out_of_order_steps": ("sessions", f"{_FUNNEL_RANKS} <> list_sort({_FUNNEL_RANKS})"),
+}
+
+SESSION_RULES = [name for name, (unit, _) in QUALITY_RULES.items() if unit == "sessions"]
+
+
+def session_quality_flags() -> str:
+    """
+    This function returns the SQL expression of the quality_flags of a row of my_table, with the
+    bit of every rule of SESSION_RULES, in order, set when the session breaks it.
+    """
+    return "(" + " | ".join(
+        f"(coalesce({QUALITY_RULES[name][1]}, false)::UTINYINT << {bit})"
+        for bit, name in enumerate(SESSION_RULES)) + ")::UTINYINT"
+
+
+class DataQualityError(Exception):
+    """
+    This exception is raised when the violations of a rule exceed its threshold.
+    """
+
+
+def create_quality_store(conn: duckdb.connect) -> None:
+    """
+    This function creates the data_quality table if it does not exist yet. Every check registers
+    one row per rule in it with the following columns:
+    checked_at, rule, unit, checked, violations, rate, threshold, breached, samples
+    The samples are a few of the violations, as the session_id and event_timestamp to look them up.
+
+    Args:
+        conn (duckdb.connect): Connection to the database
+    """
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS data_quality (
+        checked_at TIMESTAMP,
+        rule VARCHAR,
+        unit VARCHAR,
+        checked BIGINT,
+        violations BIGINT,
+        rate DOUBLE,
+        threshold DOUBLE,
+        breached BOOLEAN,
+        samples STRUCT(session_id BIGINT, event_timestamp BIGINT)[]
+    )""")
+
+
+def _validate_thresholds(thresholds: dict) -> dict:
+    """
+    This function checks that the thresholds are keyed by rules of QUALITY_RULES.
+    """
+    thresholds = thresholds or {}
+    unknown = set(thresholds) - set(QUALITY_RULES)
+    if unknown:
+        raise ValueError(f"Unknown quality rules: {', '.join(sorted(unknown))}")
+    return thresholds
+
+
+def _write_report(
+    conn: duckdb.connect, unit: str, checked: int, violations: dict, samples: dict,
+        thresholds: dict, registry: Registry) -> pd.DataFrame:
+    """
+    This function appends the report of the rules of one unit to data_quality, through a cursor
+    of its own, so the report is kept when the transaction being checked is rolled back. It then
+    raises DataQualityError when the rate of violations of a rule exceeds its threshold.
+
+    Returns:
+        pd.DataFrame: Dataframe with the report, one row per rule
+    """
+    cursor = conn.cursor()
+    try:
+        create_quality_store(cursor)
+        checked_at = cursor.execute("SELECT current_timestamp::TIMESTAMP").fetchone()[0]
+        for name, count in violations.items():
+            rate = count / checked if checked else 0.0
+            threshold = thresholds.get(name)
+            cursor.execute(
+                "INSERT INTO data_quality VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [checked_at, name, unit, checked, count, rate, threshold,
+                 threshold is not None and rate > threshold, samples.get(name, [])])
+            registry.gauge("data_quality_violations", "Violations of the quality rules in the last check").set(
+                count, rule=name)
+        report = cursor.execute(
+            "SELECT * FROM data_quality WHERE checked_at = ? AND unit = ? ORDER BY rowid", [checked_at, unit]).fetch_df()
+    finally:
+        cursor.close()
+    print(f"Data quality checked on {checked} {unit}")
+    breached = report[report["breached"]]
+    if len(breached):
+        raise DataQualityError("Data quality thresholds breached: " + ", ".join(
+            f"{rule} ({rate:.2%} > {threshold:.2%})"
+            for rule, rate, threshold in breached[["rule", "rate", "threshold"]].itertuples(index=False)))
+    return report
+
+
+def check_events(
+    conn: duckdb.connect, where: str = "TRUE", source: str = "events", thresholds: dict = None,
+        samples: int = 5, registry: Registry = REGISTRY) -> pd.DataFrame:
+    """
+    This function evaluates the events rules of QUALITY_RULES on the events of source, as plain
+    filtered aggregates of a single scan. The params of every event are gone through once, the
+    checks of PARAM_CHECKS being packed as the bits of one flags column. It is meant to run in
+    the transaction that loaded the events, right after they are written, so a breach rolls them
+    back. The samples, a few of the violations as their session_id and event_timestamp, are
+    only looked up for the rules with violations.
+    The report is appended to data_quality and the violations set as gauges of the registry.
+    DataQualityError is raised, after the report is written, when the rate of violations of a
+    rule exceeds its threshold.
+
+    Args:
+        conn (duckdb.connect): Connection to the database
+        where (str, optional): Condition of the events to check. Defaults to all.
+        source (str, optional): Table, view or subquery with the columns of events. Defaults to "events".
+        thresholds (dict, optional): Maximum rate of violations keyed by rule. Defaults to no threshold.
+        samples (int, optional): Violations kept per rule. Defaults to 5.
+        registry (Registry, optional): Registry of the metrics. Defaults to REGISTRY.
+
+    Returns:
+        pd.DataFrame: Dataframe with the report, one row per events rule
+    """
+    thresholds = _validate_thresholds(thresholds)
+    checks = {name: f"(param_flags & {1 << bit} <> 0)" for bit, name in enumerate(PARAM_CHECKS)}
+    rules = {
+        name: condition.format(now=int(time.time() * 1000), **checks)
+        for name, (unit, condition) in QUALITY_RULES.items() if unit == "events"}
+    flags = " | ".join(
+        f"(coalesce({condition}, false)::INTEGER << {bit})" for bit, condition in enumerate(PARAM_CHECKS.values()))
+    events = f"""(
+        SELECT
+            session_id, event_timestamp, event_name, user_pseudo_id,
+            coalesce(list_bit_or(list_transform(event_params, p -> {flags})), 0) AS param_flags
+        FROM {source}
+        WHERE {where}
+    )"""
+    counts = conn.execute(f"""
+    SELECT count(*), {", ".join(f"count(*) FILTER (WHERE {condition})" for condition in rules.values())}
+    FROM {events}
+    """).fetchone()
+    violations = dict(zip(rules, counts[1:]))
+    found = {
+        name: [
+            {"session_id": session_id, "event_timestamp": event_timestamp}
+            for session_id, event_timestamp in conn.execute(
+                f"SELECT session_id, event_timestamp FROM {events} WHERE {rules[name]} LIMIT {int(samples)}").fetchall()]
+        for name, count in violations.items() if count
+    }
+    return _write_report(conn, "events", counts[0], violations, found, thresholds, registry)
+
+
+def check_sessions(
+    conn: duckdb.connect, where: str = "TRUE", thresholds: dict = None,
+        samples: int = 5, registry: Registry = REGISTRY) -> pd.DataFrame:
+    """
+    This function counts the violations of the sessions rules of QUALITY_RULES from the
+    quality_flags of my_table, which the same aggregation that builds it sets when it is built with
+    a check, so the events are not read again. It is meant to run in the transaction that writes my_table, so a
+    breach rolls it back. Every session and week of my_table is checked, and the samples only
+    have the session_id.
+    The report is written and DataQualityError raised as in check_events.
+
+    Args:
+        conn (duckdb.connect): Connection to the database
+        where (str, optional): Condition of the rows of my_table to check. Defaults to all.
+        thresholds (dict, optional): Maximum rate of violations keyed by rule. Defaults to no threshold.
+        samples (int, optional): Violations kept per rule. Defaults to 5.
+        registry (Registry, optional): Registry of the metrics. Defaults to REGISTRY.
+
+    Returns:
+        pd.DataFrame: Dataframe with the report, one row per sessions rule
+    """
+    thresholds = _validate_thresholds(thresholds)
+    counts = conn.execute(f"""
+    SELECT count(*), {", ".join(
+        f"count(*) FILTER (WHERE quality_flags & {1 << bit} <> 0)" for bit in range(len(SESSION_RULES)))}
+    FROM my_table
+    WHERE {where}
+    """).fetchone()
+    violations = dict(zip(SESSION_RULES, counts[1:]))
+    found = {
+        name: [
+            {"session_id": session_id, "event_timestamp": None}
+            for session_id, in conn.execute(f"""
+            SELECT session_id FROM my_table
+            WHERE ({where}) AND quality_flags & {1 << SESSION_RULES.index(name)} <> 0
+            LIMIT {int(samples)}""").fetchall()]
+        for name, count in violations.items() if count
+    }
+    return _write_report(conn, "sessions", counts[0], violations, found, thresholds, registry)
+
+
+def read_quality_report(conn: duckdb.connect) -> pd.DataFrame:
+    """
+    This function reads the latest report of every rule, the events rules and the sessions rules
+    being checked at different stages of the pipeline.
+
+    Args:
+        conn (duckdb.connect): Connection to the database
+
+    Returns:
+        pd.DataFrame: Dataframe with the report, one row per rule. None if nothing has been checked yet
+    """
+    try:
+        report = conn.execute("""
+        SELECT * FROM data_quality
+        QUALIFY checked_at = max(checked_at) OVER (PARTITION BY rule)
+        ORDER BY list_position(?, rule)
+        """, [list(QUALITY_RULES)]).fetch_df()
+    except duckdb.CatalogException:
+        return None
+    return report if len(report) else None
+
+
+def test_check_quality(tmp_path):
+    """
+    This function tests that every rule finds the events or sessions that break it, and that a
+    breached threshold raises once the report is written and rolls back the load it checks.
+    """
+    import pytest
+    from functools import partial
+    from testing import FIXTURE_SESSIONS, write_fixture_parquet
+    from utils import create_my_table, create_table, create_view
+    conn = duckdb.connect()
+    path = str(tmp_path / "file.parquet")
+    write_fixture_parquet(path, FIXTURE_SESSIONS + [
+        (5, "u4", 1672617600000, ["checkout", "landing", "purchase"], ("p1", -10, "USD")),
+    ])
+    create_table(conn, path=path)
+    conn.execute("""
+    INSERT INTO events
+    SELECT * REPLACE (CASE WHEN event_name = 'purchase' THEN 'u9' ELSE user_pseudo_id END AS user_pseudo_id)
+    FROM events WHERE session_id = 4
+    UNION ALL SELECT * REPLACE (NULL AS event_name) FROM events WHERE session_id = 2 AND event_name = 'landing'
+    UNION ALL SELECT * REPLACE ([{'key': 'step', 'value': {'int_value': NULL, 'string_value': 'purchase'}}] AS event_params)
+    FROM events WHERE session_id = 1 AND event_name = 'purchase'
+    """)
+    events = conn.execute("SELECT count(*) FROM events").fetchone()[0]
+    report = check_events(conn, registry=Registry()).set_index("rule")
+    assert report["violations"].to_dict() == {
+        "missing_mandatory": 1, "invalid_timestamp": 0, "invalid_param_type": 0, "negative_amount": 1,
+        "purchase_without_product": 1,
+    }
+    assert report.loc["negative_amount", "samples"] == [{"session_id": 5, "event_timestamp": 1672617720000}]
+    create_view(conn)
+    create_my_table(conn)
+    assert "quality_flags" not in [column for column, *_ in conn.execute("DESCRIBE my_table").fetchall()]
+    create_my_table(conn, quality_flags=True)
+    report = check_sessions(conn, registry=Registry()).set_index("rule")
+    assert report["violations"].to_dict() == {"duplicate_event": 3, "shared_session_id": 1, "out_of_order_steps": 1}
+    assert report.loc["shared_session_id", "samples"] == [{"session_id": 4, "event_timestamp": None}]
+    assert report.loc["shared_session_id", "checked"] == 5
+    with pytest.raises(DataQualityError, match="negative_amount"):
+        create_table(conn, path=path, check=partial(
+            check_events, thresholds={"negative_amount": 0, "missing_mandatory": 0.5}, registry=Registry()))
+    assert conn.execute("SELECT count(*) FROM events").fetchone()[0] == events
+    assert read_quality_report(conn)["breached"].tolist() == [False, False, False, True, False, False, False, False]
+    conn.execute("DELETE FROM my_table WHERE session_id = 5")
+    with pytest.raises(DataQualityError, match="out_of_order_steps"):
+        create_my_table(conn, check=partial(check_sessions, thresholds={"out_of_order_steps": 0}, registry=Registry()))
+    assert conn.execute("SELECT count(*) FROM my_table").fetchone()[0] == 4
+    assert read_quality_report(conn).set_index("rule").loc["out_of_order_steps", "breached"]
+    with pytest.raises(ValueError):
+        check_events(conn, thresholds={"nulls": 0})
@@ -0,0 +1,168 @@
+import io
+import json
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+JSON = "application/json"
+NDJSON = "application/x-ndjson"
+ARROW = "application/vnd.apache.arrow.stream"
+PARQUET = "application/vnd.apache.parquet"
+
+MEDIA_TYPES = (JSON, NDJSON, ARROW, PARQUET)
+
+
+class NotAcceptable(Exception):
+    """
+    This exception is raised when none of the accepted media types can be served.
+    """
+
+
+def negotiate(accept: str = None) -> str:
+    """
+    This function chooses the media type of a response from the Accept header of the request.
+    The types are tried in order of quality, JSON being the default for */* or no header.
+
+    Args:
+        accept (str, optional): Accept header of the request. Defaults to None.
+
+    Returns:
+        str: One of MEDIA_TYPES
+    """
+    if not accept:
+        return JSON
+    ranges = []
+    for position, item in enumerate(accept.split(",")):
+        media_type, *parameters = [part.strip() for part in item.split(";")]
+        quality = 1.0
+        for parameter in parameters:
+            if parameter.startswith("q="):
+                try:
+                    quality = float(parameter[2:])
+                except ValueError:
+                    quality = 0.0
+        if quality > 0:
+            ranges.append((-quality, position, media_type.lower()))
+    for _, _, media_type in sorted(ranges):
+        if media_type in ("*/*", "application/*"):
+            return JSON
+        if media_type in MEDIA_TYPES:
+            return media_type
+    raise NotAcceptable(f"None of {accept} can be served, use one of {', '.join(MEDIA_TYPES)}")
+
+
+class _ChunkSink:
+    """
+    This class is a write only file that keeps the bytes written since they were last taken,
+    so the Arrow and Parquet writers can be streamed chunk by chunk.
+    """
+    def __init__(self):
+        self._buffer = io.BytesIO()
+        self._position = 0
+        self.closed = False
+
+    def write(self, data) -> int:
+        size = self._buffer.write(data)
+        self._position += size
+        return size
+
+    def tell(self) -> int:
+        return self._position
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self.closed = True
+
+    def take(self) -> bytes:
+        """
+        This method returns the bytes written since the last call and forgets them.
+        """
+        data = self._buffer.getvalue()
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        return data
+
+
+def _json_rows(batch: pa.RecordBatch) -> str:
+    """
+    This function encodes a record batch as JSON records, one per line, with the same encoding
+    pandas uses for the records orientation.
+    """
+    return batch.to_pandas().to_json(orient='records', lines=True).strip()
+
+
+def serialize_batches(batches, media_type: str):
+    """
+    This function encodes a stream of record batches in the given media type, one chunk per batch,
+    so the memory used does not depend on the number of batches.
+
+    Args:
+        batches (pa.RecordBatchReader): Batches to encode
+        media_type (str): One of MEDIA_TYPES
+
+    Returns:
+        generator: Chunks of bytes of the encoded stream
+    """
+    if media_type == JSON:
+        separator = "["
+        for batch in batches:
+            if len(batch):
+                yield (separator + _json_rows(batch).replace("\n", ",")).encode()
+                separator = ","
+        yield ("[]" if separator == "[" else "]").encode()
+    elif media_type == NDJSON:
+        for batch in batches:
+            if len(batch):
+                yield (_json_rows(batch) + "\n").encode()
+    elif media_type in (ARROW, PARQUET):
+        sink = _ChunkSink()
+        if media_type == ARROW:
+            writer = pa.ipc.new_stream(sink, batches.schema)
+        else:
+            writer = pq.ParquetWriter(sink, batches.schema)
+        for batch in batches:
+            writer.write_batch(batch)
+            yield sink.take()
+        writer.close()
+        yield sink.take()
+    else:
+        raise NotAcceptable(f"{media_type} can not be served")
+
+
+def _reader(n_rows: int, batch_size: int = 4) -> pa.RecordBatchReader:
+    """
+    This function returns a reader of n_rows rows split in batches of batch_size rows.
+    """
+    table = pa.table({"step": [f"s{i}" for i in range(n_rows)], "total": list(range(n_rows))})
+    return pa.RecordBatchReader.from_batches(table.schema, table.to_batches(max_chunksize=batch_size))
+
+
+def test_negotiate():
+    """
+    This function tests the choice of the media type from the Accept header.
+    """
+    import pytest
+    assert negotiate(None) == JSON
+    assert negotiate("*/*") == JSON
+    assert negotiate(f"{JSON};q=0.5, {PARQUET}") == PARQUET
+    assert negotiate(f"text/html, {ARROW};q=0.9, */*;q=0.1") == ARROW
+    with pytest.raises(NotAcceptable):
+        negotiate("text/html")
+
+
+def test_serialize_batches():
+    """
+    This function tests that every media type decodes back to the same rows, also without any row.
+    """
+    for n_rows in (0, 10):
+        expected = _reader(n_rows).read_all()
+        rows = json.loads(b"".join(serialize_batches(_reader(n_rows), JSON)))
+        assert rows == expected.to_pylist()
+        ndjson = b"".join(serialize_batches(_reader(n_rows), NDJSON)).decode().splitlines()
+        assert [json.loads(line) for line in ndjson] == expected.to_pylist()
+        arrow = b"".join(serialize_batches(_reader(n_rows), ARROW))
+        assert pa.ipc.open_stream(arrow).read_all().equals(expected)
+        chunks = list(serialize_batches(_reader(n_rows), PARQUET))
+        assert pq.read_table(io.BytesIO(b"".join(chunks))).equals(expected)
+        assert len(chunks) == len(expected.to_batches()) + 1
@@ -0,0 +1,157 @@
+from utils import (
+    WEEKLY_AGGREGATES, create_view, create_my_table, events_select, replace_steps_dictionary,
+    update_steps_dictionary, refresh_weekly_aggregates, read_weekly_aggregates)
+from connection import connection_config, split_memory_limit
+import duckdb
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+SHARD_MERGES = {
+    "purchases_revenue": """
+        SELECT product, week, sum(purchases) AS purchases, sum(revenue) AS revenue, year
+        FROM partials
+        GROUP BY product, year, week
+    """,
+    "users_per_step": """
+        SELECT sum(COLUMNS(* EXCLUDE (year, week))), year, week
+        FROM partials
+        GROUP BY year, week
+    """,
+    "conversion_rate": """
+        SELECT
+            sum(total) AS total,
+            sum(dropped) AS dropped,
+            round((sum(total)::DOUBLE - sum(dropped)::DOUBLE) / sum(total)::DOUBLE * 100, 2) AS conversion_rate,
+            step, week, year
+        FROM partials
+        GROUP BY year, week, step
+    """,
+    "user_sketches": """
+        SELECT dimension, value, year, week, register, max(rank) AS rank
+        FROM partials
+        GROUP BY dimension, value, year, week, register
+    """,
+}
+
+
+def _build_shard(
+    path: str, shard: int, shards: int, steps: list, database: str, threads: int,
+        vocabularies: dict = None, memory_limit: str = None, temp_directory: str = None,
+        quality_flags: bool = False) -> str:
+    """
+    This function builds one shard in its own database file: the events of the sessions whose
+    session_id hashes to the shard, their slice of my_table, with the quality_flags when asked,
+    and the partial weekly aggregates. It is meant to run in a worker process.
+
+    Returns:
+        str: Path to the database of the shard
+    """
+    conn = duckdb.connect(database, config=connection_config(threads, memory_limit, temp_directory))
+    conn.execute("SET enable_progress_bar = false")
+    conn.execute(f"""
+        CREATE TABLE events AS
+        SELECT * FROM ({events_select(path, vocabularies)})
+        WHERE hash(session_id) % {shards} = {shard}
+    """)
+    create_view(conn)
+    conn.execute("CREATE TABLE steps_dictionary (step_id UINTEGER PRIMARY KEY, step VARCHAR UNIQUE)")
+    conn.executemany("INSERT INTO steps_dictionary VALUES (?, ?)", steps)
+    create_my_table(conn, reset_steps=False, quality_flags=quality_flags)
+    refresh_weekly_aggregates(conn)
+    conn.close()
+    return database
+
+
+def build_sharded(
+    conn: duckdb.connect, path: str = "/data/file.parquet", shards: int = 2,
+        threads_per_shard: int = None, directory: str = None, vocabularies: dict = None,
+        memory_limit: str = None, temp_directory: str = None, check=None) -> None:
+    """
+    This function builds my_table and the weekly aggregates with a pool of processes, one per
+    shard. The sessions are split by the hash of their session_id, so every session is built by
+    a single shard. Every worker reads its sessions from the parquet file into its own database
+    file and calculates the partial aggregates of its sessions, which are then merged: counts and
+    sums are added, the conversion rate is calculated again from the merged counts and the
+    sketches keep the maximum rank of every register.
+    The steps are numbered again before the workers start, so every shard encodes the steps
+    with the same ids, and steps_dictionary is replaced together with my_table. events_unnested
+    must already exist. As in create_my_table, check is called on my_table before it is committed,
+    and the shards only set the quality_flags it reads when there is a check.
+
+    Args:
+        conn (duckdb.connect): Connection to the database
+        path (str, optional): Path to the parquet file. Defaults to "/data/file.parquet".
+        shards (int, optional): Number of shards and worker processes. Defaults to 2.
+        threads_per_shard (int, optional): Threads of every worker. Defaults to the cores divided by the shards.
+        directory (str, optional): Directory of the shard databases. Defaults to a temporary directory.
+        vocabularies (dict, optional): Values of the ENUM columns of the events, as in create_table. Defaults to VARCHAR.
+        memory_limit (str, optional): Memory limit of all the workers, like "4GB", divided evenly between them. Defaults to DuckDB's default.
+        temp_directory (str, optional): Directory the workers spill to, one subdirectory per shard. Defaults to DuckDB's default.
+        check (callable, optional): Check of the new sessions. Defaults to no check.
+    """
+    threads_per_shard = threads_per_shard or max((os.cpu_count() or 1) // shards, 1)
+    update_steps_dictionary(conn, table="steps_dictionary_staging", reset=True)
+    steps = conn.execute("SELECT step_id, step FROM steps_dictionary_staging").fetchall()
+    memory_per_shard = split_memory_limit(memory_limit, shards) if memory_limit else None
+    spill_directories = [
+        os.path.join(temp_directory, f"shard_{shard}") if temp_directory else None for shard in range(shards)]
+    with tempfile.TemporaryDirectory(dir=directory) as shard_directory:
+        with ProcessPoolExecutor(max_workers=shards, mp_context=get_context("spawn")) as executor:
+            databases = list(executor.map(
+                _build_shard, [path] * shards, range(shards), [shards] * shards, [steps] * shards,
+                [os.path.join(shard_directory, f"shard_{shard}.db") for shard in range(shards)],
+                [threads_per_shard] * shards, [vocabularies] * shards, [memory_per_shard] * shards,
+                spill_directories, [check is not None] * shards))
+        for shard, database in enumerate(databases):
+            conn.execute(f"ATTACH '{database}' AS shard_{shard} (READ_ONLY)")
+        try:
+            conn.begin()
+            conn.execute("CREATE OR REPLACE TABLE my_table AS " + " UNION ALL ".join(
+                f"SELECT * FROM shard_{shard}.my_table" for shard in range(shards)))
+            if check is not None:
+                check(conn, "TRUE")
+            for name in WEEKLY_AGGREGATES:
+                partials = " UNION ALL ".join(
+                    f"SELECT * FROM shard_{shard}.weekly_{name}" for shard in range(shards))
+                conn.execute(f"CREATE OR REPLACE TABLE weekly_{name} AS SELECT * FROM shard_0.weekly_{name} LIMIT 0")
+                conn.execute(f"""
+                    INSERT INTO weekly_{name}
+                    WITH partials AS ({partials})
+                    {SHARD_MERGES[name]}
+                """)
+            replace_steps_dictionary(conn)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            for shard in range(shards):
+                conn.execute(f"DETACH shard_{shard}")
+    print(f"Table my_table and weekly aggregates built with {shards} shards")
+
+
+def test_build_sharded(tmp_path):
+    """
+    This function tests that the sharded build gives the same my_table and weekly aggregates
+    as the build in a single process.
+    """
+    from generator import write_synthetic_events
+    from utils import create_table
+    path = str(tmp_path / "events.parquet")
+    write_synthetic_events(path, n_sessions=5000)
+    single, sharded = duckdb.connect(), duckdb.connect(str(tmp_path / "sharded.db"))
+    for conn in (single, sharded):
+        create_table(conn, path=path)
+        create_view(conn)
+    create_my_table(single)
+    refresh_weekly_aggregates(single)
+    build_sharded(
+        sharded, path, shards=3, directory=str(tmp_path), memory_limit="768MB",
+        temp_directory=str(tmp_path / "spill"))
+    query = "SELECT * FROM my_table ORDER BY session_id, year, week"
+    assert sharded.execute(query).to_arrow_table().equals(single.execute(query).to_arrow_table())
+    expected = read_weekly_aggregates(single)
+    for name, table in read_weekly_aggregates(sharded).items():
+        assert table.equals(expected[name]), name
@@ -0,0 +1,655 @@
+import duckdb
+import math
+import pandas as pd
+import pyarrow as pa
+
+RESULT_TABLES = {
+    "purchases_revenue": "results_purchases_revenue",
+    "users_per_step": "results_users_per_step",
+    "conversion_rate": "results_conversion_rate",
+    "user_sketches": "results_user_sketches",
+}
+
+RESULT_FILTERS = {
+    "purchases_revenue": ("product",),
+    "users_per_step": (),
+    "conversion_rate": ("step",),
+    "user_sketches": ("dimension", "value"),
+}
+
+WEEKLY_REPORT = ("purchases_revenue", "users_per_step", "conversion_rate")
+
+HLL_PRECISION = 12
+HLL_REGISTERS = 1 << HLL_PRECISION
+HLL_MAX_RANK = 65 - HLL_PRECISION
+
+STEPS_MASK_BITS = 32
+
+
+def reached_step(step_id: str, step: str) -> str:
+    """
+    This function returns the SQL condition of a row of my_table reaching a step, given as SQL
+    expressions of its step_id and its name. The steps with an id below STEPS_MASK_BITS are read
+    from the bits of steps_mask, and the rest from the list of steps.
+    """
+    return (
+        f"CASE WHEN {step_id} < {STEPS_MASK_BITS} THEN steps_mask & (1::UINTEGER << {step_id}) <> 0 "
+        f"ELSE list_contains(steps, {step}) END")
+
+
+def create_result_store(conn: duckdb.connect) -> None:
+    """
+    This function creates the result_versions table if it does not exist yet.
+    Every completed pipeline run registers one row in it with the following columns:
+    version, built_at, source_fingerprint
+
+    Args:
+        conn (duckdb.connect): Connection to the database
+    """
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS result_versions (
+        version INTEGER PRIMARY KEY,
+        built_at TIMESTAMP,
+        source_fingerprint VARCHAR
+    )""")
+
+
+def publish_results(
+    conn: duckdb.connect, results: dict, source_fingerprint: str,
+        keep: int = 3, partitions: pd.DataFrame = None) -> int:
+    """
+    This function writes the results of a pipeline run as a new version of the result tables.
+    All the result rows and the version row are written in a single transaction, so readers
+    only ever see completed versions. Only the last `keep` versions are retained.
+    The results are written by the name of their columns. When they bring columns new to a
+    table, like the one of a new step in the users per step, the table is rewritten with the
+    columns of the results first, in their order, and the new ones are NULL in older versions.
+
+    Args:
+        conn (duckdb.connect): Connection to the database
+        results (dict): Dataframes to publish, keyed by the names in RESULT_TABLES
+        source_fingerprint (str): Fingerprint of the source data the results were built from
+        keep (int, optional): Number of versions to retain. Defaults to 3.
+        partitions (pd.DataFrame, optional): year and week partitions of my_table that changed since the last version. Defaults to all.
+
+    Returns:
+        int: The published version
+    """
+    create_result_store(conn)
+    conn.begin()
+    try:
+        version = conn.execute(
+            "SELECT coalesce(max(version), 0) + 1 FROM result_versions").fetchone()[0]
+        for name, df in results.items():
+            table_name = RESULT_TABLES[name]
+            conn.register("result_df", df)
+            conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS {table_name} AS
+                SELECT 0::INTEGER AS version, * FROM result_df LIMIT 0
+            """)
+            columns = [column for column, *_ in conn.execute(f"SELECT * FROM {table_name} LIMIT 0").description]
+            types = dict(row[:2] for row in conn.execute("DESCRIBE SELECT * FROM result_df").fetchall())
+            if set(types) - set(columns):
+                quoted = {column: '"' + column.replace('"', '""') + '"' for column in columns + list(types)}
+                conn.execute(f"""
+                CREATE OR REPLACE TABLE {table_name} AS
+                SELECT version, {", ".join(
+                    quoted[column] if column in columns else f"NULL::{column_type} AS {quoted[column]}"
+                    for column, column_type in types.items())}{"".join(
+                    f", {quoted[column]}" for column in columns if column not in types and column != "version")}
+                FROM {table_name}
+                """)
+            conn.execute(
+                f"INSERT INTO {table_name} BY NAME SELECT ?::INTEGER AS version, * FROM result_df", [version])
+            conn.execute(f"DELETE FROM {table_name} WHERE version <= ?", [version - keep])
+            conn.unregister("result_df")
+        _publish_user_weeks(conn, partitions)
+        conn.execute(
+            "INSERT INTO result_versions VALUES (?, current_timestamp, ?)",
+            [version, source_fingerprint])
+        conn.execute("DELETE FROM result_versions WHERE version <= ?", [version - keep])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    print(f"Results version {version} published successfully")
+    return version
+
+
+def _publish_user_weeks(conn: duckdb.connect, partitions: pd.DataFrame = None) -> None:
+    """
+    This function keeps results_user_weeks, with one row per year, week and user of my_table and
+    the following columns: year, week, user_pseudo_id, steps_mask, steps, products
+    steps_mask has the bits of the steps the sessions of the user reached that week, and steps
+    their distinct steps only when steps_dictionary has steps past STEPS_MASK_BITS, so the exact
+    counts of distinct users read the same sessions as the published results from a table much
+    narrower than my_table. results_steps is replaced with the steps they are encoded with.
+    When partitions are given only their rows are written again, so the cost of a publish grows
+    with the partitions that changed. It runs in the transaction of the version, and nothing is
+    written when my_table does not exist.
+
+    Args:
+        conn (duckdb.connect): Connection to the database, inside the transaction of the version
+        partitions (pd.DataFrame, optional): year and week partitions that changed. Defaults to all.
+    """
+    if not conn.execute("SELECT count(*) FROM duckdb_tables() WHERE table_name = 'my_table'").fetchone()[0]:
+        return
+    exists = conn.execute("""
+    SELECT count(*) FROM duckdb_columns() WHERE table_name = 'results_user_weeks' AND column_name = 'products'
+    """).fetchone()[0]
+    past_mask = conn.execute(
+        "SELECT count(*) FROM steps_dictionary WHERE step_id >= ?", [STEPS_MASK_BITS]).fetchone()[0]
+    query = f"""
+    SELECT year, week, user_pseudo_id, bit_or(steps_mask)::UINTEGER AS steps_mask,
+        {"list_distinct(flatten(list(steps)))" if past_mask else "NULL"}::VARCHAR[] AS steps,
+        list(DISTINCT product::VARCHAR) FILTER (WHERE product IS NOT NULL) AS products
+    FROM my_table
+    WHERE {{where}}
+    GROUP BY year, week, user_pseudo_id
+    """
+    if partitions is None or not exists:
+        conn.execute(f"CREATE OR REPLACE TABLE results_user_weeks AS {query.format(where='TRUE')}")
+    else:
+        conn.register("published_partitions", partitions)
+        where = "year * 100 + week IN (SELECT year * 100 + week FROM published_partitions)"
+        conn.execute(f"DELETE FROM results_user_weeks WHERE {where}")
+        conn.execute(f"INSERT INTO results_user_weeks {query.format(where=where)}")
+        conn.unregister("published_partitions")
+    conn.execute("CREATE OR REPLACE TABLE results_steps AS SELECT step_id, step FROM steps_dictionary")
+
+
+def latest_version(conn: duckdb.connect) -> dict:
+    """
+    This function returns the metadata of the latest completed version.
+
+    Args:
+        conn (duckdb.connect): Connection to the database
+
+    Returns:
+        dict: version, built_at and source_fingerprint. None if nothing has been published yet
+    """
+    try:
+        row = conn.execute("""
+        SELECT version, built_at, source_fingerprint
+        FROM result_versions
+        ORDER BY version DESC
+        LIMIT 1
+        """).fetchone()
+    except duckdb.CatalogException:
+        return None
+    if row is None:
+        return None
+    return {"version": row[0], "built_at": row[1].isoformat(), "source_fingerprint": row[2]}
+
+
+def _range_conditions(years: tuple = (None, None), weeks: tuple = (None, None)) -> tuple:
+    """
+    This function builds the conditions of an inclusive range of weeks, from (year, week) to
+    (year, week), None being no bound. The bounds compare year * 100 + week, the same key as
+    _partition_filter, so a range can span several years: a missing week is the first or the
+    last week of its year. When only one bound has a year, a week without a year on the other
+    bound is a week of that same year, so both bounds are built the same way; when no bound has
+    a year, the weeks bound the week of every year.
+
+    Returns:
+        tuple: The list of conditions and the list of their parameters
+    """
+    if (years[0] is None) != (years[1] is None):
+        year = years[0] if years[1] is None else years[1]
+        years = tuple(year if bound is None and week is not None else bound for bound, week in zip(years, weeks))
+    conditions, parameters = [], []
+    for (year, week), operator, bound in [
+            ((years[0], weeks[0]), ">=", 0), ((years[1], weeks[1]), "<=", 99)]:
+        if year is not None:
+            conditions.append(f"year * 100 + week {operator} ?")
+            parameters.append(year * 100 + (bound if week is None else week))
+        elif week is not None:
+            conditions.append(f"week {operator} ?")
+            parameters.append(week)
+    return conditions, parameters
+
+
+def _results_query(
+    conn: duckdb.connect, name: str, years: tuple = (None, None),
+        weeks: tuple = (None, None), limit: int = None, offset: int = 0, **filters) -> tuple:
+    """
+    This function builds the parameterized query reading one result table at the latest
+    completed version. The arguments are the ones of read_results.
+
+    Returns:
+        tuple: The query and its parameters. None if nothing has been published yet
+    """
+    latest = latest_version(conn)
+    if latest is None:
+        return None
+    conditions, parameters = _range_conditions(years, weeks)
+    conditions, parameters = ["version = ?"] + conditions, [latest["version"]] + parameters
+    for column, value in filters.items():
+        if column not in RESULT_FILTERS[name]:
+            raise ValueError(f"{name} can not be filtered by {column}")
+        if value is not None:
+            conditions.append(f"{column} = ?")
+            parameters.append(value)
+    query = f"""
+    SELECT * EXCLUDE (version) FROM {RESULT_TABLES[name]}
+    WHERE {" AND ".join(conditions)}
+    ORDER BY rowid
+    """
+    if limit is not None:
+        query += "LIMIT ? OFFSET ?"
+        parameters += [limit, offset]
+    return query, parameters
+
+
+def read_results(conn: duckdb.connect, name: str, **kwargs) -> pd.DataFrame:
+    """
+    This function reads one result table at the latest completed version.
+    All the filters are bound as parameters of a prepared statement, so they are applied
+    while scanning the result table.
+
+    Args:
+        conn (duckdb.connect): Connection to the database
+        name (str): Name of the result, one of the keys in RESULT_TABLES
+        years (tuple, optional): Years of the inclusive (from, to) range of weeks, None for no bound. Defaults to all.
+        weeks (tuple, optional): Weeks of the (from, to) years, None for the first or last week. Defaults to all.
+        limit (int, optional): Maximum number of rows. Defaults to all.
+        offset (int, optional): Number of rows to skip. Defaults to 0.
+        **filters: Values of the columns in RESULT_FILTERS[name], None for no filter
+
+    Returns:
+        pd.DataFrame: Dataframe with the results. None if nothing has been published yet
+    """
+    query = _results_query(conn, name, **kwargs)
+    if query is None:
+        return None
+    return conn.execute(*query).fetch_df()
+
+
+def read_results_batches(
+    conn: duckdb.connect, name: str, batch_size: int = 10000, **kwargs) -> pa.RecordBatchReader:
+    """
+    This function reads one result table at the latest completed version as a stream of Arrow
+    record batches, so the result is never materialized as a whole. The cursor must stay open
+    until the reader is consumed.
+
+    Args:
+        conn (duckdb.connect): Connection to the database
+        name (str): Name of the result, one of the keys in RESULT_TABLES
+        batch_size (int, optional): Maximum number of rows per batch. Defaults to 10000.
+        **kwargs: Filters and pagination, as in read_results
+
+    Returns:
+        pa.RecordBatchReader: Reader of the results. None if nothing has been published yet
+    """
+    query = _results_query(conn, name, **kwargs)
+    if query is None:
+        return None
+    return conn.execute(*query).to_arrow_reader(batch_size)
+
+
+def read_weekly_report(
+    conn: duckdb.connect, years: tuple = (None, None), weeks: tuple = (None, None)) -> dict:
+    """
+    This function reads the metrics of WEEKLY_REPORT together, in a single transaction, so they
+    all come from the same completed version even if a new one is published meanwhile.
+
+    Args:
+        conn (duckdb.connect): Connection to the database
+        years (tuple, optional): Years of the inclusive (from, to) range of weeks, None for no bound. Defaults to all.
+        weeks (tuple, optional): Weeks of the (from, to) years, None for the first or last week. Defaults to all.
+
+    Returns:
+        dict: The version and the dataframes keyed by the names in WEEKLY_REPORT. None if nothing has been published yet
+    """
+    conn.begin()
+    try:
+        latest = latest_version(conn)
+        report = None
+        if latest is not None:
+            report = {"version": latest["version"]}
+            for name in WEEKLY_REPORT:
+                report[name] = read_results(conn, name, years=years, weeks=weeks)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return report
+
+
+_JOURNEY_COLUMNS = """
+    session_id, user_pseudo_id, event_timestamp, event_name::VARCHAR AS event_name, step::VARCHAR AS step,
+    product::VARCHAR AS product, amount, currency::VARCHAR AS currency
+"""
+
+
+def read_session_journey(conn: duckdb.connect, session_id: int) -> pd.DataFrame:
+    """
+    This function reads the events of one session from session_journeys, in order, through the
+    index on session_id. The columns stored as ENUM are read as strings.
+
+    Args:
+        conn (duckdb.connect): Connection to the database
+        session_id (int): Session to read
+
+    Returns:
+        pd.DataFrame: Dataframe with the events of the session. None if session_journeys does not exist
+    """
+    try:
+        return conn.execute(f"""
+        SELECT {_JOURNEY_COLUMNS} FROM session_journeys
+        WHERE session_id = ?
+        ORDER BY event_timestamp
+        """, [session_id]).fetch_df()
+    except duckdb.CatalogException:
+        return None
+
+
+def read_user_journeys(conn: duckdb.connect, user_pseudo_id: str, limit: int = None) -> pd.DataFrame:
+    """
+    This function reads the events of all the sessions of one user from session_journeys, through
+    the index on user_pseudo_id. The sessions are ordered by their first event and their events
+    by event_timestamp.
+
+    Args:
+        conn (duckdb.connect): Connection to the database
+        user_pseudo_id (str): User to read
+        limit (int, optional): Maximum number of events. Defaults to all.
+
+    Returns:
+        pd.DataFrame: Dataframe with the events of the user. None if session_journeys does not exist
+    """
+    query = f"""
+    SELECT {_JOURNEY_COLUMNS} FROM session_journeys
+    WHERE user_pseudo_id = ?
+    ORDER BY min(event_timestamp) OVER (PARTITION BY session_id), session_id, event_timestamp
+    """
+    parameters = [user_pseudo_id]
+    if limit is not None:
+        query += "LIMIT ?"
+        parameters.append(limit)
+    try:
+        return conn.execute(query, parameters).fetch_df()
+    except duckdb.CatalogException:
+        return None
+
+
+def _hll_estimate(histogram: dict, m: int = HLL_REGISTERS, q: int = HLL_MAX_RANK - 1) -> float:
+    """
+    This function estimates the distinct count of a HyperLogLog sketch from the number of
+    registers with every rank, with the improved estimator of Ertl, "New cardinality estimation
+    algorithms for HyperLogLog sketches" (2017). The registers that were never hit have rank 0.
+
+    Args:
+        histogram (dict): Number of registers keyed by rank, the rank 0 can be left out
+        m (int, optional): Number of registers. Defaults to HLL_REGISTERS.
+        q (int, optional): Number of hash bits the rank is taken from. Defaults to HLL_MAX_RANK - 1.
+
+    Returns:
+        float: The estimated distinct count
+    """
+    counts = [histogram.get(k, 0) for k in range(q + 2)]
+    counts[0] = m - sum(counts[1:])
+    if counts[0] == m:
+        return 0.0
+    x, y, tau = 1 - counts[q + 1] / m, 1.0, 0.0
+    if 0 < x < 1:
+        tau = 1 - x
+        while True:
+            x, y, previous = x ** 0.5, y / 2, tau
+            tau -= (1 - x) ** 2 * y
+            if tau == previous:
+                break
+        tau /= 3
+    z = m * tau
+    for k in range(q, 0, -1):
+        z = (z + counts[k]) / 2
+    x, y, sigma = counts[0] / m, 1.0, counts[0] / m
+    while x > 0:
+        x, previous = x * x, sigma
+        sigma += x * y
+        y += y
+        if sigma == previous:
+            break
+    return m * m / (2 * math.log(2)) / (z + m * sigma)
+
+
+def read_distinct_users_batches(
+    conn: duckdb.connect, dimension: str, years: tuple = (None, None), weeks: tuple = (None, None),
+        value: str = None, per_week: bool = True, exact: bool = False, batch_size: int = 10000) -> pa.RecordBatchReader:
+    """
+    This function counts the distinct users of every step or product, per week or over the whole
+    range of weeks, as a stream of Arrow record batches. The approximate count merges the
+    HyperLogLog sketches of the weeks in the latest completed version, taking the maximum rank of
+    every register, so it never reads the sessions, and every batch of merged sketches is
+    estimated as it is read. The estimate is the improved estimator of Ertl (2017), which needs no bias
+    correction for small counts. With 4096 registers its standard error is 1.04 / sqrt(4096), about 1.6%:
+    about 95% of the estimates are within 3.3% of the exact count and almost all within 5%.
+    The exact count scans the users of every week published together with the latest completed
+    version in results_user_weeks with count(DISTINCT user_pseudo_id). The cursor must stay open
+    until the reader is consumed.
+
+    Args:
+        conn (duckdb.connect): Connection to the database
+        dimension (str): "step" or "product"
+        years (tuple, optional): Years of the inclusive (from, to) range of weeks, None for no bound. Defaults to all.
+        weeks (tuple, optional): Weeks of the (from, to) years, None for the first or last week. Defaults to all.
+        value (str, optional): Only this step or product. Defaults to all.
+        per_week (bool, optional): One count per week instead of one for the whole range. Defaults to True.
+        exact (bool, optional): Count exactly instead of estimating. Defaults to False.
+        batch_size (int, optional): Maximum number of rows per batch. Defaults to 10000.
+
+    Returns:
+        pa.RecordBatchReader: Reader with the columns step or product, year and week when per_week,
+        and users. None if nothing has been published yet
+    """
+    if dimension not in ("step", "product"):
+        raise ValueError(f"Distinct users can not be counted by {dimension}")
+    latest = latest_version(conn)
+    if latest is None:
+        return None
+    conditions, parameters = _range_conditions(years, weeks)
+    if value is not None:
+        conditions.append("value = ?")
+        parameters.append(value)
+    groups = "value, year, week" if per_week else "value"
+    if exact:
+        if dimension == "step":
+            source = f"""(SELECT step AS value, year, week, user_pseudo_id FROM results_user_weeks
+                JOIN results_steps ON {reached_step("step_id", "step")})"""
+        else:
+            source = "(SELECT UNNEST(products) AS value, year, week, user_pseudo_id FROM results_user_weeks)"
+        try:
+            return conn.execute(f"""
+            SELECT {groups.replace("value", f"value AS {dimension}")}, count(DISTINCT user_pseudo_id) AS users
+            FROM {source}
+            WHERE {" AND ".join(conditions) or "TRUE"}
+            GROUP BY {groups}
+            ORDER BY {groups}
+            """, parameters).to_arrow_reader(batch_size)
+        except duckdb.CatalogException:
+            return None
+    conditions, parameters = ["dimension = ?"] + conditions, [dimension] + parameters
+    histograms = conn.execute(f"""
+    WITH registers AS (
+        SELECT {groups}, register, max(rank) AS rank
+        FROM results_user_sketches
+        WHERE version = ? AND {" AND ".join(conditions)}
+        GROUP BY {groups}, register
+    )
+    SELECT {groups.replace("value", f"value AS {dimension}")}, list(rank) AS ranks, list(registers) AS registers
+    FROM (SELECT {groups}, rank, count(*) AS registers FROM registers GROUP BY {groups}, rank)
+    GROUP BY {groups}
+    ORDER BY {groups}
+    """, [latest["version"]] + parameters).to_arrow_reader(batch_size)
+    schema = pa.schema(
+        [histograms.schema.field(name) for name in histograms.schema.names[:-2]] + [pa.field("users", pa.int64())])
+
+    def estimates():
+        for batch in histograms:
+            users = [
+                round(_hll_estimate(dict(zip(ranks, registers))))
+                for ranks, registers in zip(batch.column("ranks").to_pylist(), batch.column("registers").to_pylist())]
+            yield pa.RecordBatch.from_arrays(batch.columns[:-2] + [pa.array(users, pa.int64())], schema=schema)
+    return pa.RecordBatchReader.from_batches(schema, estimates())
+
+
+def read_distinct_users(conn: duckdb.connect, dimension: str, **kwargs) -> pd.DataFrame:
+    """
+    This function counts the distinct users of every step or product, as read_distinct_users_batches.
+
+    Args:
+        conn (duckdb.connect): Connection to the database
+        dimension (str): "step" or "product"
+        **kwargs: Range of weeks, value, per_week and exact, as in read_distinct_users_batches
+
+    Returns:
+        pd.DataFrame: Dataframe with the columns step or product, year and week when per_week,
+        and users. None if nothing has been published yet
+    """
+    batches = read_distinct_users_batches(conn, dimension, **kwargs)
+    if batches is None:
+        return None
+    return batches.read_pandas()
+
+
+def test_publish_results():
+    """
+    This function tests that readers only see the latest published version.
+    """
+    conn = duckdb.connect()
+    assert read_results(conn, "conversion_rate") is None
+    publish_results(conn, {"conversion_rate": pd.DataFrame({"step": ["landing"], "week": [1]})}, "a")
+    version = publish_results(
+        conn, {"conversion_rate": pd.DataFrame({"step": ["checkout"], "week": [1]})}, "b")
+    assert latest_version(conn)["source_fingerprint"] == "b"
+    assert read_results(conn, "conversion_rate")["step"].tolist() == ["checkout"]
+    assert read_distinct_users(conn, "step", exact=True) is None
+    assert version == 2
+
+
+def test_publish_results_keeps_last_versions():
+    """
+    This function tests that old versions are removed from the result tables.
+    """
+    conn = duckdb.connect()
+    for i in range(4):
+        publish_results(conn, {"users_per_step": pd.DataFrame({"landing": [i]})}, str(i), keep=2)
+    assert conn.execute("SELECT count(*) FROM result_versions").fetchone()[0] == 2
+    assert conn.execute("SELECT min(version) FROM results_users_per_step").fetchone()[0] == 3
+
+
+def test_publish_results_new_columns():
+    """
+    This function tests that a column new to a result table is added to it, and that the results
+    are written by the name of their columns.
+    """
+    conn = duckdb.connect()
+    publish_results(conn, {"users_per_step": pd.DataFrame({"landing": [1], "week": [1]})}, "a")
+    publish_results(conn, {"users_per_step": pd.DataFrame({"week": [1], "landing": [2], "upsell": [3]})}, "b")
+    assert read_results(conn, "users_per_step").to_dict("records") == [{"week": 1, "landing": 2, "upsell": 3}]
+    assert conn.execute("SELECT upsell FROM results_users_per_step WHERE version = 1").fetchall() == [(None,)]
+
+
+def test_publish_user_weeks_partitions(tmp_path):
+    """
+    This function tests that the exact distinct users are published per week and user, and that
+    a publish with partitions only writes those weeks again.
+    """
+    from testing import write_fixture_parquet
+    from utils import create_table, create_view, create_my_table
+    conn = duckdb.connect()
+    path = str(tmp_path / "file.parquet")
+    write_fixture_parquet(path)
+    create_table(conn, path=path)
+    create_view(conn)
+    create_my_table(conn)
+    publish_results(conn, {}, "a")
+    assert conn.execute("SELECT count(*) FROM results_user_weeks").fetchone()[0] == 4
+    products = read_distinct_users(conn, "product", exact=True)
+    assert products[["product", "week", "users"]].values.tolist() == [["p1", 1, 1], ["p2", 2, 1]]
+    conn.execute("DELETE FROM my_table WHERE session_id IN (1, 4)")
+    publish_results(conn, {}, "b", partitions=pd.DataFrame({"year": [2023], "week": [2]}))
+    products = read_distinct_users(conn, "product", exact=True)
+    assert products[["product", "week", "users"]].values.tolist() == [["p1", 1, 1]]
+    landing = read_distinct_users(conn, "step", value="landing", exact=True)
+    assert landing[["week", "users"]].values.tolist() == [[1, 2], [2, 1]]
+
+
+def test_read_results_filters():
+    """
+    This function tests the filters and the pagination of the results.
+    """
+    import pytest
+    conn = duckdb.connect()
+    publish_results(conn, {"conversion_rate": pd.DataFrame({
+        "step": ["landing", "checkout", "landing", "checkout", "landing"],
+        "week": [1, 1, 2, 2, 3],
+        "year": [2023, 2023, 2023, 2023, 2024],
+    })}, "a")
+    assert read_results(conn, "conversion_rate", step="landing")["week"].tolist() == [1, 2, 3]
+    assert read_results(conn, "conversion_rate", years=(2023, 2023), weeks=(2, None))["step"].tolist() == ["landing", "checkout"]
+    assert read_results(conn, "conversion_rate", years=(2023, 2024), weeks=(2, 1))["week"].tolist() == [2, 2]
+    assert read_results(conn, "conversion_rate", years=(2023, 2024), weeks=(2, 3))["week"].tolist() == [2, 2, 3]
+    assert read_results(conn, "conversion_rate", years=(None, 2023), weeks=(None, 1))["week"].tolist() == [1, 1]
+    assert read_results(conn, "conversion_rate", years=(2023, None), weeks=(2, 3))["week"].tolist() == [2, 2]
+    assert read_results(conn, "conversion_rate", years=(None, 2024), weeks=(2, 3))["week"].tolist() == [3]
+    assert read_results(conn, "conversion_rate", years=(2023, None), weeks=(2, None))["week"].tolist() == [2, 2, 3]
+    assert read_results(conn, "conversion_rate", limit=2, offset=1)["week"].tolist() == [1, 2]
+    with pytest.raises(ValueError):
+        read_results(conn, "conversion_rate", product="p1")
+
+
+def test_read_results_batches():
+    """
+    This function tests that the batches hold the same rows as the dataframe.
+    """
+    conn = duckdb.connect()
+    assert read_results_batches(conn, "users_per_step") is None
+    publish_results(conn, {"users_per_step": pd.DataFrame({"landing": range(25), "week": 1})}, "a")
+    batches = list(read_results_batches(conn, "users_per_step", batch_size=10, limit=21))
+    assert max(len(batch) for batch in batches) <= 10
+    assert pa.Table.from_batches(batches).to_pandas().equals(read_results(conn, "users_per_step", limit=21))
+
+
+def test_read_weekly_report():
+    """
+    This function tests that the report holds every metric of the latest version, filtered by week.
+    """
+    conn = duckdb.connect()
+    assert read_weekly_report(conn) is None
+    for version in (1, 2):
+        publish_results(conn, {
+            name: pd.DataFrame({"total": [version] * 3, "year": 2023, "week": [1, 2, 3]})
+            for name in WEEKLY_REPORT}, str(version))
+    report = read_weekly_report(conn, weeks=(2, None))
+    assert report["version"] == 2
+    assert all(report[name]["total"].tolist() == [2, 2] for name in WEEKLY_REPORT)
+
+
+def test_read_distinct_users():
+    """
+    This function tests that the merged sketches stay within the documented error of the exact
+    counts, per week and over all the weeks, on synthetic sessions.
+    """
+    import pytest
+    from generator import create_synthetic_events
+    from utils import create_view, create_my_table, calculate_user_sketches
+    conn = duckdb.connect()
+    create_synthetic_events(conn, 200000, n_users=50000, n_weeks=4)
+    create_view(conn)
+    create_my_table(conn)
+    assert read_distinct_users(conn, "step") is None
+    publish_results(conn, {"user_sketches": calculate_user_sketches(conn)}, "a")
+    for dimension in ("step", "product"):
+        for per_week in (True, False):
+            approximate = read_distinct_users(conn, dimension, per_week=per_week)
+            exact = read_distinct_users(conn, dimension, per_week=per_week, exact=True)
+            assert approximate.drop(columns="users").equals(exact.drop(columns="users"))
+            assert ((approximate["users"] - exact["users"]).abs() / exact["users"]).max() < 0.05
+    published = read_distinct_users(conn, "step", exact=True)
+    conn.execute("DELETE FROM my_table WHERE week = 1")
+    assert read_distinct_users(conn, "step", exact=True).equals(published)
+    checkout = read_distinct_users(conn, "step", weeks=(2, 3), value="checkout", per_week=False)
+    assert checkout["step"].tolist() == ["checkout"]
+    with pytest.raises(ValueError):
+        read_distinct_users(conn, "currency")
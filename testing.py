@@ -0,0 +1,110 @@
+import duckdb
+import gzip
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+FIXTURE_SESSIONS = [
+    # session_id, user_pseudo_id, first event timestamp, steps, (product, amount, currency)
+    (1, "u1", 1672617600000, ["landing", "checkout", "purchase"], ("p1", 100, "USD")),
+    (2, "u2", 1672621200000, ["landing", "checkout"], None),
+    (3, "u1", 1673222400000, ["landing", "login-options", "sign-up"], None),
+    (4, "u3", 1673226000000, ["landing", "checkout", "purchase"], ("p2", 50, "USD")),
+]
+
+
+def write_fixture_parquet(path: str, sessions: list = FIXTURE_SESSIONS) -> None:
+    """
+    This function writes a small parquet file with the same schema as the source data.
+    Every step is one event, one minute after the previous one, and the purchase event
+    also carries the product, amount and currency parameters.
+    """
+    def param(key, int_value=None, string_value=None):
+        int_sql = "NULL" if int_value is None else str(int_value)
+        string_sql = "NULL" if string_value is None else f"'{string_value}'"
+        return f"{{'key': '{key}', 'value': {{'int_value': {int_sql}::INTEGER, 'string_value': {string_sql}::VARCHAR}}}}"
+
+    rows = []
+    for session_id, user_pseudo_id, timestamp, steps, purchase in sessions:
+        for i, step in enumerate(steps):
+            params = [param("step", string_value=step)]
+            if step == "purchase" and purchase is not None:
+                product, amount, currency = purchase
+                params += [
+                    param("product", string_value=product),
+                    param("amount", int_value=amount),
+                    param("currency", string_value=currency),
+                ]
+            rows.append(
+                f"({timestamp + i * 60000}, '{step}', [{', '.join(params)}], "
+                f"NULL, '{user_pseudo_id}', {session_id})")
+    duckdb.connect().execute(f"""
+        COPY (
+            SELECT * FROM (VALUES {', '.join(rows)})
+                AS t(event_timestamp, event_name, event_params, user_id, user_pseudo_id, session_id)
+        ) TO '{path}' (FORMAT PARQUET)
+    """)
+
+
+def serve_file(path: str, etag: str = '"v1"', last_modified: str = None) -> ThreadingHTTPServer:
+    """
+    This function serves a file over HTTP on a random local port, standing in for the data URL.
+    The etag and last_modified attributes of the returned server can be changed at any time,
+    and conditional requests are answered with 304 when they match. Range requests are
+    honoured, and the next `drops` responses are cut after `drop_after` bytes. After them, the
+    statuses in `failures` are answered, one per request, with a Retry-After of `retry_after`.
+    With `gzip` set the file is sent gzip encoded to the requests that accept it, and with
+    `gzip` set to "always" also to the ones asking for identity, as some servers do. Ranges
+    are then taken from the encoded bytes.
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            server.requests.append(dict(self.headers))
+            if server.failures and not server.drops:
+                self.send_response(server.failures.pop(0))
+                self.send_header("Retry-After", server.retry_after)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            if server.etag is not None and self.headers.get("If-None-Match") == server.etag:
+                self.send_response(304)
+                self.end_headers()
+                return
+            with open(server.path, "rb") as f:
+                body = f.read()
+            accepted = self.headers.get("Accept-Encoding", "gzip")
+            encoded = server.gzip == "always" or (server.gzip and "gzip" in accepted)
+            if encoded:
+                body = gzip.compress(body, mtime=0)
+            start = 0
+            if "Range" in self.headers and self.headers.get("If-Range", server.etag) == server.etag:
+                start = int(self.headers["Range"][len("bytes="):].rstrip("-"))
+                self.send_response(206)
+                self.send_header("Content-Range", f"bytes {start}-{len(body) - 1}/{len(body)}")
+            else:
+                self.send_response(200)
+            self.send_header("Content-Length", str(len(body) - start))
+            if encoded:
+                self.send_header("Content-Encoding", "gzip")
+            if server.etag is not None:
+                self.send_header("ETag", server.etag)
+            if server.last_modified is not None:
+                self.send_header("Last-Modified", server.last_modified)
+            self.end_headers()
+            if server.drops > 0:
+                server.drops -= 1
+                self.wfile.write(body[start:start + server.drop_after])
+                return
+            self.wfile.write(body[start:])
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.path, server.etag, server.last_modified, server.requests = path, etag, last_modified, []
+    server.drops, server.drop_after = 0, 0
+    server.failures, server.retry_after = [], "0"
+    server.gzip = False
+    server.url = f"http://127.0.0.1:{server.server_port}/"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
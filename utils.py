@@ -1,52 +1,641 @@
 import requests
+import urllib3
 import duckdb
 import pandas as pd
 import os
+import gzip
+import hashlib
+import shutil
+import sys
+import time
+import datetime
+from email.utils import parsedate_to_datetime
+from instrumentation import span
+from store import HLL_PRECISION, STEPS_MASK_BITS, reached_step
+from quality import session_quality_flags
 
-def download_data(url: str = "https://sde-test-data-sltezl542q-ew.a.run.app/", path: str = "/data/file.parquet") -> None:
+RETRYABLE_STATUSES = (408, 429, 500, 502, 503, 504)
+
+
+def _retry_after(response: requests.Response) -> float:
+    """
+    This function returns the seconds to wait that a response asks for in its Retry-After
+    header, given as seconds or as an HTTP date. None when there is no valid header.
+    """
+    value = response.headers.get("Retry-After")
+    if value is None:
+        return None
+    if value.strip().isdigit():
+        return float(value)
+    try:
+        return max((parsedate_to_datetime(value) - datetime.datetime.now(datetime.timezone.utc)).total_seconds(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+def download_data(
+    url: str = "https://sde-test-data-sltezl542q-ew.a.run.app/", path: str = "/data/file.parquet",
+        etag: str = None, last_modified: str = None, sha256: str = None,
+        chunk_size: int = 1 << 20, retries: int = 5, backoff: float = 1.0) -> dict:
     """
     This function downloads the data from the url and saves it to data/file.parquet
+    When etag or last_modified are given the request is conditional, and the file is
+    left untouched if the server answers that it has not been modified.
+    The response is streamed in chunks to a temporary file next to path, which is only
+    renamed to path once it is complete. The file is asked without Content-Encoding, so the
+    bytes written are the ones counted by Content-Length and Range. A server that gzips it anyway
+    is written as sent and decompressed once complete. A dropped connection, or a response with one of
+    RETRYABLE_STATUSES, is retried with exponential backoff, or after the delay of its
+    Retry-After header, resuming from the bytes already written with an HTTP Range request.
 
     Args:
         url (str, optional): URL to the data. Defaults to "https://sde-test-data-sltezl542q-ew.a.run.app/".
         path (str, optional): Path to save the data. Defaults to "/data/file.parquet".
+        etag (str, optional): ETag of the last download. Defaults to None.
+        last_modified (str, optional): Last-Modified of the last download. Defaults to None.
+        sha256 (str, optional): Expected hex digest of the file. Defaults to None.
+        chunk_size (int, optional): Bytes written at a time. Defaults to 1MiB.
+        retries (int, optional): Attempts after the first one. Defaults to 5.
+        backoff (float, optional): Seconds to wait before the first retry. Defaults to 1.0.
+
+    Returns:
+        dict: modified, etag, last_modified and sha256 of the download
     """
-    response = requests.get(url, stream=True)
-    with open(path, "wb") as f:
-        f.write(response.content)
+    part_path = f"{path}.part"
+    headers = {"Accept-Encoding": "identity"}
+    if etag is not None:
+        headers["If-None-Match"] = etag
+    if last_modified is not None:
+        headers["If-Modified-Since"] = last_modified
+    download, encoding = None, "identity"
+    attempt = 0
+    if os.path.exists(part_path):
+        os.remove(part_path)
+    while True:
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        if offset:
+            validator = download["etag"] or download["last_modified"]
+            request_headers = {"Accept-Encoding": "identity", "Range": f"bytes={offset}-"}
+            if validator is not None:
+                request_headers["If-Range"] = validator
+        else:
+            request_headers = headers
+        try:
+            with requests.get(url, stream=True, headers=request_headers, timeout=60) as response:
+                if response.status_code == 304:
+                    print("Data not modified, skipping download")
+                    return {"modified": False, "etag": etag, "last_modified": last_modified, "sha256": None}
+                response.raise_for_status()
+                if response.status_code != 206:
+                    offset = 0
+                    download = {
+                        "modified": True,
+                        "etag": response.headers.get("ETag"),
+                        "last_modified": response.headers.get("Last-Modified"),
+                    }
+                    encoding = response.headers.get("Content-Encoding", "identity").lower()
+                    if encoding not in ("identity", "gzip"):
+                        raise ValueError(f"Unsupported Content-Encoding: {encoding}")
+                length = response.headers.get("Content-Length")
+                with open(part_path, "ab" if offset else "wb") as f:
+                    try:
+                        for chunk in response.raw.stream(chunk_size, decode_content=False):
+                            f.write(chunk)
+                    except urllib3.exceptions.ProtocolError as e:
+                        raise requests.exceptions.ChunkedEncodingError(e)
+                    except urllib3.exceptions.ReadTimeoutError as e:
+                        raise requests.ConnectionError(e)
+                if length is not None and os.path.getsize(part_path) != offset + int(length):
+                    raise requests.ConnectionError("Connection closed before the download completed")
+            break
+        except (
+            requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError,
+                requests.HTTPError) as e:
+            http_error = isinstance(e, requests.HTTPError)
+            attempt += 1
+            if attempt > retries or (http_error and e.response.status_code not in RETRYABLE_STATUSES):
+                if os.path.exists(part_path):
+                    os.remove(part_path)
+                raise
+            delay = _retry_after(e.response) if http_error else None
+            delay = backoff * 2 ** (attempt - 1) if delay is None else delay
+            print(f"Download interrupted ({e}), retrying in {delay}s")
+            time.sleep(delay)
+    if encoding == "gzip":
+        with gzip.open(part_path, "rb") as compressed, open(f"{part_path}.decoded", "wb") as f:
+            shutil.copyfileobj(compressed, f, chunk_size)
+        os.replace(f"{part_path}.decoded", part_path)
+    download["sha256"] = file_fingerprint(part_path)
+    if sha256 is not None and download["sha256"] != sha256:
+        os.remove(part_path)
+        raise ValueError(f"Checksum mismatch: expected {sha256}, got {download['sha256']}")
+    os.replace(part_path, path)
     print("Data downloaded successfully")
+    return download
 
 
-def create_table(
-    conn: duckdb.connect, table_name: str = "events",
-        path: str = "/data/file.parquet") -> None:
+def file_fingerprint(path: str = "/data/file.parquet", chunk_size: int = 1 << 20) -> str:
     """
-    This function creates the table from the parquet file.
-    The table is called events by default and has the following columns:
-    event_timestamp, event_name, event_params, user_id, user_pseudo_id, session_id
-    
+    This function calculates the sha256 of a file, reading it in chunks.
+
+    Args:
+        path (str, optional): Path to the file. Defaults to "/data/file.parquet".
+        chunk_size (int, optional): Bytes read at a time. Defaults to 1MiB.
+
+    Returns:
+        str: Hex digest of the file content
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_ingestion_state(conn: duckdb.connect, url: str) -> dict:
+    """
+    This function returns the fingerprint of the last data ingested from the url.
+    The fingerprints are kept in the ingestion_state table, which has the following columns:
+    url, etag, last_modified, sha256, ingested_at, watermark
+    The watermark is the latest event_timestamp that reached my_table and the published results.
+    It is only saved once they are, so the events appended by a run that failed before stay
+    above it and the next incremental run processes them again.
+
     Args:
         conn (duckdb.connect): Connection to the database
-        table_name (str, optional): Name of the table. Defaults to "events".
-        path (str, optional): Path to the parquet file. Defaults to "data/file.parquet".
+        url (str): URL to the data
+
+    Returns:
+        dict: etag, last_modified, sha256 and watermark of the last ingestion. None if there is none
     """
-    conn.execute(f"""
-        CREATE OR REPLACE TABLE {table_name} AS
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS ingestion_state (
+        url VARCHAR PRIMARY KEY,
+        etag VARCHAR,
+        last_modified VARCHAR,
+        sha256 VARCHAR,
+        ingested_at TIMESTAMP
+    )""")
+    conn.execute("ALTER TABLE ingestion_state ADD COLUMN IF NOT EXISTS watermark BIGINT")
+    row = conn.execute(
+        "SELECT etag, last_modified, sha256, watermark FROM ingestion_state WHERE url = ?", [url]).fetchone()
+    if row is None:
+        return None
+    return {"etag": row[0], "last_modified": row[1], "sha256": row[2], "watermark": row[3]}
+
+
+def save_ingestion_state(
+    conn: duckdb.connect, url: str, etag: str,
+        last_modified: str, sha256: str, watermark: int = None) -> None:
+    """
+    This function stores the fingerprint of the data ingested from the url.
+
+    Args:
+        conn (duckdb.connect): Connection to the database
+        url (str): URL to the data
+        etag (str): ETag of the download
+        last_modified (str): Last-Modified of the download
+        sha256 (str): Hex digest of the downloaded file
+        watermark (int, optional): Latest event_timestamp in my_table and the published results. Defaults to None.
+    """
+    get_ingestion_state(conn, url)
+    conn.begin()
+    try:
+        conn.execute("DELETE FROM ingestion_state WHERE url = ?", [url])
+        conn.execute(
+            "INSERT INTO ingestion_state (url, etag, last_modified, sha256, ingested_at, watermark) "
+            "VALUES (?, ?, ?, ?, current_timestamp, ?)",
+            [url, etag, last_modified, sha256, watermark])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+_EVENTS_SELECT = """
         SELECT
             "event_timestamp"::BIGINT AS event_timestamp,
-            "event_name"::VARCHAR AS event_name,
+            "event_name"::{event_name_type} AS event_name,
             "event_params"::
                 STRUCT(
-                    key VARCHAR, value STRUCT(
-                        int_value INTEGER, string_value VARCHAR)
+                    key {key_type}, value STRUCT(
+                        int_value INTEGER, string_value {string_value_type})
                     )[] AS event_params,
             "user_id"::VARCHAR AS user_id,
             "user_pseudo_id"::VARCHAR AS user_pseudo_id,
             "session_id"::BIGINT AS session_id,
         FROM read_parquet('{path}')
-    """)
+"""
+
+
+ENUM_MAX_VALUES = 1 << 16
+
+
+class VocabularyError(ValueError):
+    """
+    This exception is raised when new events hold a value missing from the ENUM of their column.
+    """
+
+
+def discover_vocabularies(conn: duckdb.connect, path: str = "/data/file.parquet") -> dict:
+    """
+    This function finds the distinct values of event_name and of the key and string_value of
+    event_params in the parquet file, to store them as ENUM columns. A column with more than
+    ENUM_MAX_VALUES distinct values is kept as VARCHAR. The three columns are collected in a
+    single scan of the file, from the distinct (event_name, key, string_value) of its params: the
+    events without params are unnested as a single NULL param, so they still give their event_name.
+
+    Args:
+        conn (duckdb.connect): Connection to the database
+        path (str, optional): Path to the parquet file. Defaults to "/data/file.parquet".
+
+    Returns:
+        dict: Sorted values of event_name, key and string_value, None for the ones kept as VARCHAR
+    """
+    columns = ["event_name", "key", "string_value"]
+    lists = ",\n".join(
+        f"""CASE WHEN count(DISTINCT {column}) <= {ENUM_MAX_VALUES}
+            THEN list_sort(list(DISTINCT {column}) FILTER (WHERE {column} IS NOT NULL)) END"""
+        for column in columns)
+    row = conn.execute(f"""
+        SELECT {lists}
+        FROM (
+            SELECT DISTINCT event_name::VARCHAR AS event_name, param.key::VARCHAR AS key,
+                param.value.string_value::VARCHAR AS string_value
+            FROM (
+                SELECT event_name,
+                    UNNEST(CASE WHEN len(event_params) > 0 THEN event_params ELSE [NULL] END) AS param
+                FROM read_parquet('{path}')
+            )
+        )
+        """).fetchone()
+    return dict(zip(columns, row))
+
+
+def events_select(path: str, vocabularies: dict = None) -> str:
+    """
+    This function returns the query reading the events of the parquet file, with the columns of
+    vocabularies typed as ENUM of their values and the others as VARCHAR.
+
+    Args:
+        path (str): Path to the parquet file
+        vocabularies (dict, optional): Values of the ENUM columns, as in create_table. Defaults to VARCHAR columns.
+
+    Returns:
+        str: The SELECT of the events, with the columns of the events table
+    """
+    types = {}
+    for column in ("event_name", "key", "string_value"):
+        values = (vocabularies or {}).get(column)
+        if values is None:
+            types[f"{column}_type"] = "VARCHAR"
+        else:
+            types[f"{column}_type"] = "ENUM(" + ", ".join(
+                "'" + value.replace("'", "''") + "'" for value in values) + ")"
+    return _EVENTS_SELECT.format(path=path, **types)
+
+
+def create_table(
+    conn: duckdb.connect, table_name: str = "events",
+        path: str = "/data/file.parquet", vocabularies: dict = None, check=None) -> None:
+    """
+    This function creates the table from the parquet file.
+    The table is called events by default and has the following columns:
+    event_timestamp, event_name, event_params, user_id, user_pseudo_id, session_id
+    With the vocabularies of discover_vocabularies, event_name and the key and string_value of
+    event_params are stored as ENUM, so they hold a small integer code per row instead of a
+    string. They still read and compare as strings, and events_unnested and the steps of
+    my_table keep their type.
+    The table is replaced in a transaction, and check, like quality.check_events, is called with
+    the connection and the condition of the events to check before it commits, so raising
+    rolls the new table back and keeps the previous one.
+    
+    Args:
+        conn (duckdb.connect): Connection to the database
+        table_name (str, optional): Name of the table. Defaults to "events".
+        path (str, optional): Path to the parquet file. Defaults to "data/file.parquet".
+        vocabularies (dict, optional): Values of the ENUM columns. Defaults to VARCHAR columns.
+        check (callable, optional): Check of the new events. Defaults to no check.
+    """
+    conn.begin()
+    try:
+        _drop_relation(conn, table_name)
+        conn.execute(f"""
+            CREATE TABLE {table_name} AS
+            {events_select(path, vocabularies)}
+        """)
+        if check is not None:
+            check(conn, "TRUE")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
     print(f"Table {table_name} created successfully")
 
+
+def table_exists(conn: duckdb.connect, table_name: str) -> bool:
+    """
+    This function checks if a table or view exists in the database.
+
+    Args:
+        conn (duckdb.connect): Connection to the database
+        table_name (str): Name of the table
+
+    Returns:
+        bool: True if it exists
+    """
+    return conn.execute(
+        "SELECT count(*) FROM information_schema.tables WHERE table_name = ?", [table_name]
+    ).fetchone()[0] > 0
+
+
+def events_watermark(conn: duckdb.connect, table_name: str = "events") -> int:
+    """
+    This function returns the latest event_timestamp already ingested.
+
+    Args:
+        conn (duckdb.connect): Connection to the database
+        table_name (str, optional): Name of the table. Defaults to "events".
+
+    Returns:
+        int: The latest event_timestamp. None if the table is empty
+    """
+    return conn.execute(f"SELECT max(event_timestamp) FROM {table_name}").fetchone()[0]
+
+
+def append_events(
+    conn: duckdb.connect, watermark: int, table_name: str = "events",
+        path: str = "/data/file.parquet", check=None) -> int:
+    """
+    This function appends to the table the events of the parquet file newer than the watermark.
+    Events that arrive late, with an event_timestamp older than the watermark, are not ingested.
+    The new events are cast to the types of the table, and VocabularyError is raised when they
+    hold a value missing from one of its ENUM columns, since the table must then be created again.
+    As in create_table, check is called on the appended events before they are committed.
+
+    Args:
+        conn (duckdb.connect): Connection to the database
+        watermark (int): Latest event_timestamp already ingested
+        table_name (str, optional): Name of the table. Defaults to "events".
+        path (str, optional): Path to the parquet file. Defaults to "data/file.parquet".
+        check (callable, optional): Check of the new events. Defaults to no check.
+
+    Returns:
+        int: Number of events appended
+    """
+    conn.begin()
+    try:
+        appended = conn.execute(f"""
+            INSERT INTO {table_name}
+            SELECT * FROM ({events_select(path)})
+            WHERE event_timestamp > {int(watermark)}
+        """).fetchone()[0]
+        if check is not None:
+            check(conn, f"event_timestamp > {int(watermark)}")
+        conn.commit()
+    except duckdb.ConversionException as e:
+        conn.rollback()
+        raise VocabularyError(f"New events do not fit the types of {table_name}: {e}")
+    except Exception:
+        conn.rollback()
+        raise
+    print(f"{appended} events appended to {table_name}")
+    return appended
+
+
+def _drop_relation(conn: duckdb.connect, name: str) -> None:
+    """
+    This function drops the table or view with the given name, if there is one, so it can be
+    created again as the other kind.
+    """
+    row = conn.execute(
+        "SELECT table_type FROM information_schema.tables WHERE table_name = ?", [name]).fetchone()
+    if row is not None:
+        conn.execute(f"DROP {'VIEW' if row[0] == 'VIEW' else 'TABLE'} {name}")
+
+
+def _write_lake_files(
+    conn: duckdb.connect, path: str, directory: str, watermark: int = None,
+        row_group_size: int = 122880) -> int:
+    """
+    This function writes the events of the parquet file newer than the watermark into directory,
+    as parquet files partitioned by year and week and sorted by event_timestamp, so the row
+    groups of every file cover narrow ranges of time in their statistics.
+
+    Returns:
+        int: Number of events written
+    """
+    where = "" if watermark is None else f"WHERE event_timestamp > {int(watermark)}"
+    return conn.execute(f"""
+        COPY (
+            SELECT *, year(epoch_ms(event_timestamp)) AS year, week(epoch_ms(event_timestamp)) AS week
+            FROM ({events_select(path)})
+            {where}
+            ORDER BY event_timestamp, session_id
+        ) TO '{directory}' (FORMAT PARQUET, PARTITION_BY (year, week), ROW_GROUP_SIZE {row_group_size})
+    """).fetchone()[0]
+
+
+def create_lake_view(conn: duckdb.connect, lake: str = "/data/events", view_name: str = "events") -> None:
+    """
+    This function creates the events view over the parquet files of the lake. It has the columns
+    of the events table plus the year and week partitions, and filters on them or on
+    event_timestamp only read the matching files and row groups.
+
+    Args:
+        conn (duckdb.connect): Connection to the database
+        lake (str, optional): Directory of the lake. Defaults to "/data/events".
+        view_name (str, optional): Name of the view. Defaults to "events".
+    """
+    _drop_relation(conn, view_name)
+    conn.execute(f"""
+        CREATE VIEW {view_name} AS
+        SELECT * FROM read_parquet('{lake}/*/*/*.parquet', hive_partitioning=1)
+    """)
+
+
+def create_lake(
+    conn: duckdb.connect, path: str = "/data/file.parquet", lake: str = "/data/events",
+        view_name: str = "events", row_group_size: int = 122880) -> None:
+    """
+    This function writes the events of the parquet file into a Hive partitioned lake, with one
+    directory per year and week, instead of copying them into a table, and creates the
+    events view over it. The lake is written next to the previous one and swapped in once complete.
+
+    Args:
+        conn (duckdb.connect): Connection to the database
+        path (str, optional): Path to the parquet file. Defaults to "/data/file.parquet".
+        lake (str, optional): Directory of the lake. Defaults to "/data/events".
+        view_name (str, optional): Name of the view. Defaults to "events".
+        row_group_size (int, optional): Rows per row group. Defaults to 122880.
+    """
+    staging, previous = lake + ".staging", lake + ".previous"
+    shutil.rmtree(staging, ignore_errors=True)
+    _write_lake_files(conn, path, staging, row_group_size=row_group_size)
+    if os.path.exists(lake):
+        os.replace(lake, previous)
+    os.replace(staging, lake)
+    shutil.rmtree(previous, ignore_errors=True)
+    create_lake_view(conn, lake, view_name)
+    print(f"Lake {lake} created successfully")
+
+
+def append_lake(
+    conn: duckdb.connect, watermark: int, path: str = "/data/file.parquet",
+        lake: str = "/data/events", row_group_size: int = 122880) -> int:
+    """
+    This function appends to the lake the events of the parquet file newer than the watermark.
+    They are written to a staging directory and then moved into their partitions under new file
+    names, so the files already in the lake are never rewritten.
+
+    Args:
+        conn (duckdb.connect): Connection to the database
+        watermark (int): Latest event_timestamp already ingested
+        path (str, optional): Path to the parquet file. Defaults to "/data/file.parquet".
+        lake (str, optional): Directory of the lake. Defaults to "/data/events".
+        row_group_size (int, optional): Rows per row group. Defaults to 122880.
+
+    Returns:
+        int: Number of events appended
+    """
+    staging = lake + ".staging"
+    shutil.rmtree(staging, ignore_errors=True)
+    appended = _write_lake_files(conn, path, staging, watermark, row_group_size)
+    batch = time.time_ns()
+    for directory, _, files in os.walk(staging):
+        partition = os.path.join(lake, os.path.relpath(directory, staging))
+        for name in files:
+            os.makedirs(partition, exist_ok=True)
+            os.replace(os.path.join(directory, name), os.path.join(partition, f"{batch}_{name}"))
+    shutil.rmtree(staging, ignore_errors=True)
+    print(f"{appended} events appended to {lake}")
+    return appended
+
+
+def test_download_data_conditional(tmp_path):
+    """
+    This function tests that the data is only downloaded again when the ETag changes.
+    """
+    from testing import serve_file, write_fixture_parquet
+    source, target = str(tmp_path / "source.parquet"), str(tmp_path / "file.parquet")
+    write_fixture_parquet(source)
+    server = serve_file(source)
+    try:
+        first = download_data(server.url, target)
+        assert first == {"modified": True, "etag": '"v1"', "last_modified": None, "sha256": file_fingerprint(source)}
+        assert file_fingerprint(target) == file_fingerprint(source)
+        os.remove(target)
+        assert not download_data(server.url, target, etag=first["etag"])["modified"]
+        assert not os.path.exists(target)
+        server.etag = '"v2"'
+        assert download_data(server.url, target, etag=first["etag"])["etag"] == '"v2"'
+    finally:
+        server.shutdown()
+
+
+def test_download_data_resumes(tmp_path):
+    """
+    This function tests that a dropped download is resumed from the bytes already written.
+    """
+    from testing import serve_file, write_fixture_parquet
+    source, target = str(tmp_path / "source.parquet"), str(tmp_path / "file.parquet")
+    write_fixture_parquet(source)
+    server = serve_file(source)
+    server.drops, server.drop_after = 2, 100
+    try:
+        download = download_data(server.url, target, sha256=file_fingerprint(source), chunk_size=10, backoff=0)
+        assert download["sha256"] == file_fingerprint(source) == file_fingerprint(target)
+        assert [r.get("Range") for r in server.requests] == [None, "bytes=100-", "bytes=200-"]
+        assert not os.path.exists(f"{target}.part")
+    finally:
+        server.shutdown()
+
+
+def test_download_data_gzip(tmp_path):
+    """
+    This function tests that the file is asked without Content-Encoding, and that a server
+    gzipping it anyway is resumed on the encoded bytes and decompressed once complete.
+    """
+    from testing import serve_file, write_fixture_parquet
+    source, target = str(tmp_path / "source.parquet"), str(tmp_path / "file.parquet")
+    write_fixture_parquet(source)
+    server = serve_file(source)
+    server.gzip = True
+    try:
+        assert download_data(server.url, target)["sha256"] == file_fingerprint(source)
+        assert server.requests[0]["Accept-Encoding"] == "identity"
+        server.requests, server.gzip, server.drops, server.drop_after = [], "always", 2, 100
+        download = download_data(server.url, target, chunk_size=10, backoff=0)
+        assert download["sha256"] == file_fingerprint(source) == file_fingerprint(target)
+        assert [r.get("Range") for r in server.requests] == [None, "bytes=100-", "bytes=200-"]
+        assert all(r["Accept-Encoding"] == "identity" for r in server.requests)
+        assert not os.path.exists(f"{target}.part")
+    finally:
+        server.shutdown()
+
+
+def test_download_data_retries_statuses(tmp_path):
+    """
+    This function tests that retryable statuses are retried after their Retry-After, also when
+    resuming, and that other errors are raised at once.
+    """
+    import pytest
+    from testing import serve_file, write_fixture_parquet
+    source, target = str(tmp_path / "source.parquet"), str(tmp_path / "file.parquet")
+    write_fixture_parquet(source)
+    server = serve_file(source)
+    server.failures = [503, 429]
+    try:
+        assert download_data(server.url, target, backoff=60)["sha256"] == file_fingerprint(source)
+        assert len(server.requests) == 3
+        server.requests, server.drops, server.drop_after, server.failures = [], 1, 100, [502]
+        download_data(server.url, target, chunk_size=10, backoff=0)
+        assert [r.get("Range") for r in server.requests] == [None, "bytes=100-", "bytes=100-"]
+        server.requests, server.failures = [], [404, 503]
+        with pytest.raises(requests.HTTPError):
+            download_data(server.url, target, backoff=0)
+        assert len(server.requests) == 1
+    finally:
+        server.shutdown()
+    assert _retry_after(requests.Response()) is None
+
+
+def test_download_data_failure_keeps_file(tmp_path):
+    """
+    This function tests that a failed download never replaces the existing file.
+    """
+    import pytest
+    from testing import serve_file, write_fixture_parquet
+    source, target = str(tmp_path / "source.parquet"), tmp_path / "file.parquet"
+    write_fixture_parquet(source)
+    target.write_bytes(b"previous")
+    server = serve_file(source)
+    server.drops, server.drop_after = 3, 100
+    try:
+        with pytest.raises(requests.exceptions.RequestException):
+            download_data(server.url, str(target), retries=2, backoff=0)
+        with pytest.raises(ValueError):
+            download_data(server.url, str(target), sha256="0" * 64)
+        assert target.read_bytes() == b"previous"
+        assert not os.path.exists(f"{target}.part")
+    finally:
+        server.shutdown()
+
+
+def test_ingestion_state():
+    """
+    This function tests that the last ingested fingerprint is stored per url.
+    """
+    conn = duckdb.connect()
+    assert get_ingestion_state(conn, "http://a") is None
+    save_ingestion_state(conn, "http://a", '"v1"', None, "abc")
+    save_ingestion_state(conn, "http://a", '"v2"', None, "def")
+    assert get_ingestion_state(conn, "http://a") == {
+        "etag": '"v2"', "last_modified": None, "sha256": "def", "watermark": None}
+    save_ingestion_state(conn, "http://a", '"v3"', None, "ghi", 1672617600000)
+    assert get_ingestion_state(conn, "http://a")["watermark"] == 1672617600000
+
+
 def test_download_data():
     """
     This function tests if the data has been downloaded successfully.
@@ -63,6 +652,58 @@ def test_create_table():
     assert conn.execute("""SELECT * FROM events LIMIT 1""").fetch_df().shape[0] == 1
 
 
+def test_enum_vocabularies(tmp_path, monkeypatch):
+    """
+    This function tests that the vocabularies are stored as ENUM columns, which read as strings,
+    and that events with a new value can not be appended.
+    """
+    import pytest
+    from testing import FIXTURE_SESSIONS, write_fixture_parquet
+    conn = duckdb.connect()
+    path = str(tmp_path / "file.parquet")
+    write_fixture_parquet(path, FIXTURE_SESSIONS[:2])
+    vocabularies = discover_vocabularies(conn, path)
+    assert vocabularies == {
+        "event_name": ["checkout", "landing", "purchase"],
+        "key": ["amount", "currency", "product", "step"],
+        "string_value": ["USD", "checkout", "landing", "p1", "purchase"],
+    }
+    without_params = str(tmp_path / "without_params.parquet")
+    conn.execute(f"""
+    COPY (
+        SELECT * REPLACE (CASE WHEN event_name = 'landing' THEN [] ELSE event_params END AS event_params)
+        FROM read_parquet('{path}')
+    ) TO '{without_params}' (FORMAT PARQUET)""")
+    monkeypatch.setattr(sys.modules[__name__], "ENUM_MAX_VALUES", 3)
+    assert discover_vocabularies(conn, without_params) == {
+        "event_name": ["checkout", "landing", "purchase"], "key": None, "string_value": None}
+    monkeypatch.undo()
+    create_table(conn, path=path, vocabularies=vocabularies)
+    assert conn.execute("SELECT typeof(event_name) FROM events LIMIT 1").fetchone()[0].startswith("ENUM")
+    assert conn.execute("SELECT count(*) FROM events WHERE event_name = 'checkout'").fetchone()[0] == 2
+    create_view(conn)
+    create_my_table(conn)
+    types = conn.execute(
+        "SELECT typeof(steps), typeof(product), typeof(currency) FROM my_table WHERE product IS NOT NULL").fetchone()
+    assert types == (types[0], "VARCHAR", "VARCHAR")
+    assert types[0].startswith("ENUM") and types[0].endswith("[]")
+    write_fixture_parquet(path)
+    with pytest.raises(VocabularyError):
+        append_events(conn, events_watermark(conn), path=path)
+    assert conn.execute("SELECT count(*) FROM events").fetchone()[0] == 5
+
+
+_EVENTS_UNNESTED_SELECT = """
+        SELECT event_timestamp, event_name,
+        UNNEST(event_params).key as key,
+        UNNEST(event_params).value.int_value as int_value,
+        UNNEST(event_params).value.string_value as string_value,
+        user_id, user_pseudo_id, session_id 
+    from events
+    {where}
+"""
+
+
 def create_view(conn: duckdb.connect, view_name: str = 'events_unnested') -> None:
     """
     This function creates a view from the table events.
@@ -75,12 +716,7 @@ def create_view(conn: duckdb.connect, view_name: str = 'events_unnested') -> Non
     """
     conn.execute(f"""
     CREATE OR REPLACE VIEW {view_name} AS
-        SELECT event_timestamp, event_name,
-        UNNEST(event_params).key as key,
-        UNNEST(event_params).value.int_value as int_value,
-        UNNEST(event_params).value.string_value as string_value,
-        user_id, user_pseudo_id, session_id 
-    from events
+        {_EVENTS_UNNESTED_SELECT.format(where="")}
     """)
     print(f"View {view_name} created successfully")
 
@@ -110,15 +746,24 @@ def legacy_two_b_1(conn: duckdb.connect) -> pd.DataFrame:
     GROUP BY t2.product, week
     """).fetch_df()
 
-def legacy_two_b_2(conn: duckdb.connect):
-    print(conn.execute("""
+def legacy_two_b_2(conn: duckdb.connect) -> pd.DataFrame:
+    """
     This function performs calculation directly from the events_unnested view.
+    This function calculates the number of users for each step and week.
+
+    Args:
+        conn (duckdb.connect): Connection to the database
+
+    Returns:
+        pd.DataFrame: Dataframe with the number of users for each step and week
+    """
+    return conn.execute("""
     SELECT string_value, count(distinct user_pseudo_id) as users,
         week(epoch_ms(event_timestamp)) as week 
     from events_unnested
     WHERE key = 'step'
     GROUP BY string_value, week
-    """).fetch_df())
+    """).fetch_df()
 
 
 def legacy_two_b_3_select_one(conn: duckdb.connect, step: str = 'landing') -> pd.DataFrame:
@@ -188,31 +833,414 @@ def legacy_two_b_3(conn: duckdb.connect) -> pd.DataFrame:
 
 
 
-def create_my_table(conn: duckdb.connect) -> None:
+def update_steps_dictionary(
+    conn: duckdb.connect, source: str = "events_unnested", table: str = "steps_dictionary",
+        reset: bool = False) -> None:
     """
-    This function creates the table that I propose to use to answer the queries in the
-    assignment. The table is called my_table and has the following columns:
-    session_id, user_pseudo_id, week, year, steps, product, amount, currency
-    To find a more detailed description of the table, please refer to the notebook.py file.
+    This function adds the new steps found in the source to the steps_dictionary table, which has
+    the following columns: step_id, step
+    The ids of the steps already in the dictionary never change, so the codes stored in my_table
+    stay valid. A full rebuild numbers the steps again in a staging table, which replaces the
+    dictionary together with my_table, so the steps that no longer appear free their ids. The
+    first STEPS_MASK_BITS steps are a bit of the steps_mask of my_table, and reached_step reads
+    the rest from its list of steps.
+
+    Args:
+        conn (duckdb.connect): Connection to the database
+        source (str, optional): View or subquery with the unnested events. Defaults to "events_unnested".
+        table (str, optional): Name of the dictionary. Defaults to "steps_dictionary".
+        reset (bool, optional): Number the steps from scratch. Defaults to False.
+    """
+    conn.execute(f"""
+    CREATE {"OR REPLACE TABLE" if reset else "TABLE IF NOT EXISTS"} {table} (
+        step_id UINTEGER PRIMARY KEY,
+        step VARCHAR UNIQUE
+    )""")
+    conn.execute(f"""
+    INSERT INTO {table}
+    SELECT
+        (SELECT coalesce(max(step_id) + 1, 0) FROM {table}) + row_number() OVER (ORDER BY step) - 1,
+        step
+    FROM (
+        SELECT DISTINCT string_value as step FROM {source}
+        WHERE key = 'step' AND string_value IS NOT NULL
+    )
+    WHERE step NOT IN (SELECT step FROM {table})
+    """)
+
+
+def replace_steps_dictionary(conn: duckdb.connect) -> None:
+    """
+    This function replaces the rows of steps_dictionary with the ones of steps_dictionary_staging.
+    It is meant to run in the transaction that replaces my_table.
+
+    Args:
+        conn (duckdb.connect): Connection to the database
     """
     conn.execute("""
-    CREATE OR REPLACE TABLE my_table AS (
-        SELECT DISTINCT ON(session_id) session_id, user_pseudo_id, week(epoch_ms(event_timestamp)) as week,
+    CREATE OR REPLACE TABLE steps_dictionary (
+        step_id UINTEGER PRIMARY KEY,
+        step VARCHAR UNIQUE
+    )""")
+    conn.execute("INSERT INTO steps_dictionary SELECT * FROM steps_dictionary_staging")
+    conn.execute("DROP TABLE steps_dictionary_staging")
+
+
+def step_masks(conn: duckdb.connect) -> dict:
+    """
+    This function returns the bit of steps_mask and the last_step code of every step. The steps
+    without a bit, past STEPS_MASK_BITS, have a mask of 0.
+
+    Args:
+        conn (duckdb.connect): Connection to the database
+
+    Returns:
+        dict: (mask, code) keyed by step
+    """
+    return {
+        step: (1 << step_id if step_id < STEPS_MASK_BITS else 0, step_id)
+        for step_id, step in conn.execute("SELECT step_id, step FROM steps_dictionary ORDER BY step_id").fetchall()
+    }
+
+
+def step_column(step: str) -> str:
+    """
+    This function returns the column of a step in the users per step, as quoted in SQL: the
+    name of the step with underscores instead of hyphens.
+
+    Args:
+        step (str): Name of the step
+
+    Returns:
+        str: Quoted name of the column
+    """
+    return '"' + step.replace("-", "_").replace('"', '""') + '"'
+
+
+# Steps of the first columns of the users per step, in the order they always had
+USERS_PER_STEP = ["landing", "checkout", "login-options", "sign-up", "purchase"]
+
+
+def _users_per_step_columns(masks: dict) -> list:
+    """
+    This function returns the steps of the columns of the users per step, in order: the steps of
+    USERS_PER_STEP, also when no session reached them, then the other steps of steps_dictionary
+    sorted by name, so an incremental update and a full rebuild give the same columns.
+
+    Args:
+        masks (dict): (mask, code) keyed by step, as returned by step_masks
+
+    Returns:
+        list: (step, code) of every column, the code being None for the steps not in steps_dictionary
+
+    Raises:
+        ValueError: If two steps have the same column
+    """
+    columns, steps = {}, []
+    for step in USERS_PER_STEP + sorted(set(masks) - set(USERS_PER_STEP)):
+        column = step_column(step).lower()
+        if column in columns:
+            raise ValueError(f"The steps {columns[column]} and {step} would both be counted in the column {column}")
+        columns[column] = step
+        steps.append((step, masks[step][1] if step in masks else None))
+    return steps
+
+
+_MY_TABLE_SELECT = """
+    SELECT session_id, user_pseudo_id, week, year,
+        list_transform(step_events, s -> s.step) as steps,
+        product, amount, currency,
+        coalesce(steps_mask, 0)::UINTEGER as steps_mask,
+        struct_extract(step_events[-1], 'step_id') as last_step{quality_flags}
+    FROM (
+        SELECT session_id, first(user_pseudo_id) as user_pseudo_id, week(epoch_ms(event_timestamp)) as week,
         year(epoch_ms(event_timestamp)) as year,
-        list(string_value) FILTER (WHERE key = 'step') over w1 as steps,
-        string_agg(string_value, '') FILTER (WHERE key = 'product') over w1 as product,
-        sum(int_value) FILTER (WHERE key = 'amount') over w1 as amount,
-        string_agg(string_value, '') FILTER (WHERE key = 'currency') over w1 as currency,
-            from events_unnested
-            window w1 as (
-            PARTITION BY session_id, year(epoch_ms(event_timestamp)), week(epoch_ms(event_timestamp))
-        )
-    )"""
+        list_sort(
+            list({{'event_timestamp': event_timestamp, 'step': string_value, 'step_id': step_id}})
+            FILTER (WHERE key = 'step')) as step_events,
+        string_agg(string_value, '') FILTER (WHERE key = 'product') as product,
+        sum(int_value) FILTER (WHERE key = 'amount') as amount,
+        string_agg(string_value, '') FILTER (WHERE key = 'currency') as currency,
+        bit_or(CASE WHEN step_id < {mask_bits} THEN 1::UINTEGER << step_id END) as steps_mask{shared_user}
+            from {source}
+            LEFT JOIN {dictionary} ON key = 'step' AND string_value = step
+            GROUP BY session_id, year, week
     )
+"""
+
+
+def _my_table_select(source: str, dictionary: str, quality_flags: bool = False) -> str:
+    """
+    This function returns the query of the rows of my_table built from the unnested events of
+    source, with the steps encoded by dictionary and, when asked, their quality_flags.
+    """
+    return _MY_TABLE_SELECT.format(
+        source=source, dictionary=dictionary, mask_bits=STEPS_MASK_BITS,
+        quality_flags=",\n        " + session_quality_flags() + " as quality_flags" if quality_flags else "",
+        shared_user=",\n        min(user_pseudo_id) <> max(user_pseudo_id) as shared_user" if quality_flags else "")
+
+
+def create_my_table(
+    conn: duckdb.connect, chunks: int = 1, reset_steps: bool = True, check=None,
+        quality_flags: bool = None) -> None:
+    """
+    This function creates the table that I propose to use to answer the queries in the
+    assignment. The table is called my_table and has the following columns:
+    session_id, user_pseudo_id, week, year, steps, product, amount, currency, steps_mask, last_step
+    and, when the sessions are checked, quality_flags.
+    There is one row per session, year and week, and the steps are ordered by event_timestamp.
+    The steps are collected together with their event_timestamp and sorted per session, which is
+    cheaper than an ordered aggregate.
+    The steps are also encoded with the ids of steps_dictionary, which is numbered again from the
+    steps of events unless reset_steps is False: steps_mask has the bit of every step the session
+    reached among the first STEPS_MASK_BITS steps, and last_step is the id of the step where it dropped.
+    check, like quality.check_sessions, is called with the connection and the condition of the
+    rows to check before my_table is committed. Only then, unless quality_flags says otherwise, the
+    same aggregation sets quality_flags, the bit of every rule of quality.SESSION_RULES the session
+    breaks, which makes the build slower and its rows wider.
+    With more than one chunk the sessions are split by the hash of their session_id and built one
+    chunk at a time, so the aggregation only holds the sessions of one chunk in memory. The table
+    is built next to my_table and swapped in once complete. Every chunk scans and unnests the
+    events again, so they are read once per chunk: benchmark_chunks measures that cost, which
+    writing the chunks apart in a single pass first does not save without holding more memory.
+    To find a more detailed description of the table, please refer to the notebook.py file.
+
+    Args:
+        conn (duckdb.connect): Connection to the database
+        chunks (int, optional): Number of chunks of sessions. Defaults to 1.
+        reset_steps (bool, optional): Number the steps of steps_dictionary again. Defaults to True.
+        check (callable, optional): Check of the new sessions. Defaults to no check.
+        quality_flags (bool, optional): Set quality_flags. Defaults to when there is a check.
+    """
+    if quality_flags is None:
+        quality_flags = check is not None
+    dictionary = "steps_dictionary_staging" if reset_steps else "steps_dictionary"
+    update_steps_dictionary(conn, table=dictionary, reset=reset_steps)
+    if chunks > 1:
+        for chunk in range(chunks):
+            source = _EVENTS_UNNESTED_SELECT.format(where=f"WHERE hash(session_id) % {chunks} = {chunk}")
+            query = _my_table_select(f"({source})", dictionary, quality_flags)
+            if chunk == 0:
+                conn.execute(f"CREATE OR REPLACE TABLE my_table_chunks AS ({query})")
+            else:
+                conn.execute(f"INSERT INTO my_table_chunks {query}")
+            print(f"Chunk {chunk + 1} of {chunks} of my_table created")
+    conn.begin()
+    try:
+        if chunks > 1:
+            _drop_relation(conn, "my_table")
+            conn.execute("ALTER TABLE my_table_chunks RENAME TO my_table")
+        else:
+            conn.execute(f"""
+            CREATE OR REPLACE TABLE my_table AS (
+                {_my_table_select("events_unnested", dictionary, quality_flags)}
+            )"""
+            )
+        if check is not None:
+            check(conn, "TRUE")
+        if reset_steps:
+            replace_steps_dictionary(conn)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
     print("Table my_table created successfully")
 
 
-def calculate_purchases_and_revenue_per_product_week(conn: duckdb.connect) -> pd.DataFrame():
+def test_create_my_table(tmp_path):
+    """
+    This function tests that my_table has one row per session with its steps in order.
+    """
+    from testing import FIXTURE_SESSIONS, write_fixture_parquet
+    conn = duckdb.connect()
+    path = str(tmp_path / "file.parquet")
+    write_fixture_parquet(path, FIXTURE_SESSIONS[::-1])
+    create_table(conn, path=path)
+    conn.execute("CREATE OR REPLACE TABLE events AS SELECT * FROM events ORDER BY event_timestamp DESC")
+    create_view(conn)
+    create_my_table(conn)
+    rows = conn.execute("""
+    SELECT session_id, steps, product, amount, steps_mask, step
+    FROM my_table JOIN steps_dictionary ON last_step = step_id
+    ORDER BY session_id""").fetchall()
+    masks = {step: mask for step, (mask, _) in step_masks(conn).items()}
+    assert rows == [
+        (1, ["landing", "checkout", "purchase"], "p1", 100, masks["landing"] | masks["checkout"] | masks["purchase"], "purchase"),
+        (2, ["landing", "checkout"], None, None, masks["landing"] | masks["checkout"], "checkout"),
+        (3, ["landing", "login-options", "sign-up"], None, None, masks["landing"] | masks["login-options"] | masks["sign-up"], "sign-up"),
+        (4, ["landing", "checkout", "purchase"], "p2", 50, masks["landing"] | masks["checkout"] | masks["purchase"], "purchase"),
+    ]
+    conn.execute("""
+    INSERT INTO events
+    SELECT event_timestamp + 1, event_name, [
+        {'key': 'product', 'value': {'int_value': NULL, 'string_value': 'p2'}},
+        {'key': 'amount', 'value': {'int_value': 7, 'string_value': NULL}}], user_id, user_pseudo_id, session_id
+    FROM events WHERE session_id = 1 AND event_name = 'purchase'""")
+    create_my_table(conn)
+    product, amount = conn.execute("SELECT product, amount FROM my_table WHERE session_id = 1").fetchone()
+    assert sorted([product[:2], product[2:]]) == ["p1", "p2"] and amount == 107
+
+
+def update_my_table(conn: duckdb.connect, watermark: int, check=None) -> pd.DataFrame:
+    """
+    This function updates my_table with the events newer than the watermark.
+    Only the sessions that received new events are rebuilt: their rows are deleted
+    and computed again from all of their events, which are the only ones unnested.
+    As in create_my_table, check is called on the rebuilt sessions before they are committed, and
+    only then are their quality_flags set, adding the column to a my_table built without it. The
+    rows are inserted by name, so the sessions rebuilt without a check leave it NULL.
+
+    Args:
+        conn (duckdb.connect): Connection to the database
+        watermark (int): Latest event_timestamp before the new events were appended
+        check (callable, optional): Check of the rebuilt sessions. Defaults to no check.
+
+    Returns:
+        pd.DataFrame: Dataframe with the year and week partitions that changed
+    """
+    conn.execute(f"""
+    CREATE OR REPLACE TEMP TABLE affected_sessions AS
+        SELECT DISTINCT session_id FROM events WHERE event_timestamp > {int(watermark)}
+    """)
+    partitions = conn.execute(f"""
+    SELECT year, week FROM my_table
+        WHERE session_id IN (SELECT session_id FROM affected_sessions)
+    UNION
+    SELECT year(epoch_ms(event_timestamp)) as year, week(epoch_ms(event_timestamp)) as week
+        FROM events
+        WHERE event_timestamp > {int(watermark)}
+    """).fetch_df()
+    affected_events = _EVENTS_UNNESTED_SELECT.format(
+        where="WHERE session_id IN (SELECT session_id FROM affected_sessions)")
+    update_steps_dictionary(conn, f"({affected_events})")
+    conn.begin()
+    try:
+        if check is not None:
+            conn.execute("ALTER TABLE my_table ADD COLUMN IF NOT EXISTS quality_flags UTINYINT")
+        conn.execute("DELETE FROM my_table WHERE session_id IN (SELECT session_id FROM affected_sessions)")
+        conn.execute(f"""
+        INSERT INTO my_table BY NAME
+            {_my_table_select(f"({affected_events})", "steps_dictionary", check is not None)}
+        """)
+        if check is not None:
+            check(conn, "session_id IN (SELECT session_id FROM affected_sessions)")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    print(f"Table my_table updated successfully, {len(partitions)} partitions affected")
+    return partitions
+
+
+_SESSION_JOURNEYS_SELECT = """
+    SELECT user_pseudo_id, session_id, event_timestamp, event_name,
+        list_filter(event_params, p -> p.key = 'step')[1].value.string_value as step,
+        list_filter(event_params, p -> p.key = 'product')[1].value.string_value as product,
+        list_filter(event_params, p -> p.key = 'amount')[1].value.int_value as amount,
+        list_filter(event_params, p -> p.key = 'currency')[1].value.string_value as currency
+    FROM events
+    {where}
+    ORDER BY user_pseudo_id, session_id, event_timestamp
+"""
+
+
+def create_session_journeys(conn: duckdb.connect) -> None:
+    """
+    This function creates the session_journeys table, with one row per event and the following
+    columns: user_pseudo_id, session_id, event_timestamp, event_name, step, product, amount, currency
+    The parameters are read from the event_params of every event, without unnesting them, and
+    the rows are sorted by user_pseudo_id, session_id and event_timestamp, so the events of a user
+    or a session are stored together. ART indexes on session_id and user_pseudo_id let a lookup
+    read only those rows, whatever the size of the table.
+    The table is built next to session_journeys and swapped in, with its indexes, in a single
+    transaction.
+
+    Args:
+        conn (duckdb.connect): Connection to the database
+    """
+    conn.execute(f"""
+    CREATE OR REPLACE TABLE session_journeys_staging AS
+        {_SESSION_JOURNEYS_SELECT.format(where="")}
+    """)
+    conn.begin()
+    try:
+        _drop_relation(conn, "session_journeys")
+        conn.execute("ALTER TABLE session_journeys_staging RENAME TO session_journeys")
+        conn.execute("CREATE INDEX session_journeys_session_id ON session_journeys (session_id)")
+        conn.execute("CREATE INDEX session_journeys_user_pseudo_id ON session_journeys (user_pseudo_id)")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    print("Table session_journeys created successfully")
+
+
+def update_session_journeys(conn: duckdb.connect, watermark: int) -> int:
+    """
+    This function appends to session_journeys the events newer than the watermark. Their rows
+    are added at the end of the table and found through the indexes, until the next full rebuild
+    sorts the table again. The rows newer than the watermark are deleted first, so running it
+    again after a failed run does not duplicate them.
+
+    Args:
+        conn (duckdb.connect): Connection to the database
+        watermark (int): Latest event_timestamp before the new events were appended
+
+    Returns:
+        int: Number of events appended
+    """
+    conn.begin()
+    try:
+        conn.execute(f"DELETE FROM session_journeys WHERE event_timestamp > {int(watermark)}")
+        appended = conn.execute(f"""
+        INSERT INTO session_journeys
+            {_SESSION_JOURNEYS_SELECT.format(where=f"WHERE event_timestamp > {int(watermark)}")}
+        """).fetchone()[0]
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    print(f"{appended} events appended to session_journeys")
+    return appended
+
+
+def test_session_journeys(tmp_path):
+    """
+    This function tests that the journeys hold the parameters of every event, in order, and that
+    a lookup by session_id goes through the index.
+    """
+    from testing import FIXTURE_SESSIONS, write_fixture_parquet
+    conn = duckdb.connect()
+    path = str(tmp_path / "file.parquet")
+    write_fixture_parquet(path, FIXTURE_SESSIONS[:2])
+    create_table(conn, path=path)
+    create_session_journeys(conn)
+    watermark = events_watermark(conn)
+    write_fixture_parquet(path)
+    append_events(conn, watermark, path=path)
+    assert update_session_journeys(conn, watermark) == 6
+    rows = conn.execute("""
+    SELECT step, product, amount, currency FROM session_journeys WHERE session_id = 4 ORDER BY event_timestamp
+    """).fetchall()
+    assert rows == [("landing", None, None, None), ("checkout", None, None, None), ("purchase", "p2", 50, "USD")]
+    assert conn.execute("SELECT count(*) FROM session_journeys WHERE user_pseudo_id = 'u1'").fetchone()[0] == 6
+    plan = conn.execute("EXPLAIN ANALYZE SELECT * FROM session_journeys WHERE session_id = 4").fetchall()[0][1]
+    assert "INDEX_SCAN" in plan.upper().replace(" ", "_")
+
+
+def _partition_filter(conn: duckdb.connect, partitions: pd.DataFrame) -> str:
+    """
+    This function returns the condition that restricts my_table to the given partitions.
+    The partitions are registered as the affected_partitions view of the connection.
+    """
+    if partitions is None:
+        return "TRUE"
+    conn.register("affected_partitions", partitions)
+    return "year * 100 + week IN (SELECT year * 100 + week FROM affected_partitions)"
+
+
+def calculate_purchases_and_revenue_per_product_week(
+    conn: duckdb.connect, partitions: pd.DataFrame = None) -> pd.DataFrame():
     """
     This function calculates the purchases and revenue for each week.
     The purchases are calculated as the number of sessions that have a purchase.
@@ -220,44 +1248,55 @@ def calculate_purchases_and_revenue_per_product_week(conn: duckdb.connect) -> pd
 
     Args:
         conn (duckdb.connect): Connection to the database
+        partitions (pd.DataFrame, optional): year and week partitions to calculate. Defaults to all.
     
     Returns:
         pd.DataFrame: Dataframe with the purchases and revenue for each week
     """
-    return conn.execute("""
+    return conn.execute(f"""
     SELECT
         product,
         week,
         count(*) as purchases,
-        sum(amount) as revenue
+        sum(amount) as revenue,
+        year
     FROM my_table
-    WHERE product IS NOT NULL
-    GROUP BY product, week
-    ORDER BY week, product
+    WHERE product IS NOT NULL AND {_partition_filter(conn, partitions)}
+    GROUP BY product, year, week
+    ORDER BY year, week, product
     """).fetch_df()
 
-def calculate_number_of_users_per_step_per_week(conn: duckdb.connect) -> pd.DataFrame:
+def calculate_number_of_users_per_step_per_week(
+    conn: duckdb.connect, partitions: pd.DataFrame = None) -> pd.DataFrame:
     """
     This function calculates the number of users for each step and week.
-    The number of users is calculated as the number of distinct user_pseudo_id for each step and week.
+    The number of users is calculated as the number of sessions that reached each step in the week,
+    so a user with several sessions is counted several times. The distinct user_pseudo_id
+    are estimated from the sketches of calculate_user_sketches.
+    There is one column per step, named by step_column, in the order of _users_per_step_columns,
+    and the rows are ordered by year and week.
     
     Args:
         conn (duckdb.connect): Connection to the database
+        partitions (pd.DataFrame, optional): year and week partitions to calculate. Defaults to all.
     
     Returns:
         pd.DataFrame: Dataframe with the number of users for each step and week
     """
-    return conn.execute("""
+    columns = _users_per_step_columns(step_masks(conn))
+    counts = "".join(
+        f"count(*) FILTER (WHERE {reached_step(code, '?::VARCHAR')}) as {step_column(step)},\n"
+        if code is not None else f"0::BIGINT as {step_column(step)},\n"
+        for step, code in columns)
+    return conn.execute(f"""
     SELECT
-        DISTINCT ON (week)
-        count(*) FILTER (WHERE list_contains(steps, 'landing')) over (PARTITION BY year, week)  as landing,
-        count(*) FILTER (WHERE list_contains(steps, 'checkout')) over (PARTITION BY year, week)  as checkout,
-        count(*) FILTER (WHERE list_contains(steps, 'login-options')) over (PARTITION BY year, week)  as login_options,
-        count(*) FILTER (WHERE list_contains(steps, 'sign-up')) over (PARTITION BY year, week)  as sign_up,
-        count(*) FILTER (WHERE list_contains(steps, 'purchase')) over (PARTITION BY year, week)  as purchase,
+        {counts}
         year, week
         FROM my_table
-    """).fetch_df()
+        WHERE {_partition_filter(conn, partitions)}
+        GROUP BY year, week
+        ORDER BY year, week
+    """, [step for step, code in columns if code is not None]).fetch_df()
 
 def calculate_conversion_rate_per_week(conn: duckdb.connect, step:str) -> pd.DataFrame:
     """
@@ -272,45 +1311,500 @@ def calculate_conversion_rate_per_week(conn: duckdb.connect, step:str) -> pd.Dat
     Returns:
         pd.DataFrame: Dataframe with the conversion rate for the given step
     """
+    _, code = step_masks(conn).get(step, (0, -1))
+    reached = reached_step(code, "?::VARCHAR") if code >= 0 else "false"
     return conn.execute(f"""
         SELECT
             DISTINCT ON (week)
-            count(*) FILTER (WHERE list_contains(steps, '{step}')) over (PARTITION BY year, week)  as total,
-            count(*) FILTER (WHERE steps[-1] = '{step}') over (PARTITION BY year, week) as dropped,
+            count(*) FILTER (WHERE {reached}) over (PARTITION BY year, week)  as total,
+            count(*) FILTER (WHERE last_step = ?) over (PARTITION BY year, week) as dropped,
             round((total::DOUBLE - dropped::DOUBLE) / total::DOUBLE * 100, 2) as conversion_rate,
-            '{step}' as step,
+            ?::VARCHAR as step,
             week,
             year
         FROM my_table
         QUALIFY 
             total > 0;
-        """).fetch_df()
+        """, ([step] if code >= 0 else []) + [code, step]).fetch_df()
 
-def calculate_conversion_rate_per_step_per_week(conn: duckdb.connect) -> pd.DataFrame:
+def calculate_conversion_rate_per_step_per_week(
+    conn: duckdb.connect, partitions: pd.DataFrame = None) -> pd.DataFrame:
     """
     This function calculates the conversion rate for each step and week.
     The conversion rate is calculated as the number of users who arrived the step divided minus number of users who dropped
     divided by the number of users who arrived the step.
+    Every session is matched with the steps of steps_dictionary whose bit is set in its steps_mask,
+    so all steps are calculated in a single scan of my_table, partitioned by year and week like
+    calculate_conversion_rate_per_week.
     
     Args:
         conn (duckdb.connect): Connection to the database
+        partitions (pd.DataFrame, optional): year and week partitions to calculate. Defaults to all.
     
     Returns:
         pd.DataFrame: Dataframe with the conversion rate for each step and week
     """
-    return pd.concat(
-    conn.execute(f"""
+    return conn.execute(f"""
         SELECT
-            DISTINCT ON (week)
-            count(*) FILTER (WHERE list_contains(steps, '{i}')) over (PARTITION BY week)  as total,
-            count(*) FILTER (WHERE steps[-1] = '{i}') over (PARTITION BY week) as dropped,
+            count(*) as total,
+            count(*) FILTER (WHERE last_step = step_id) as dropped,
             round((total::DOUBLE - dropped::DOUBLE) / total::DOUBLE * 100, 2) as conversion_rate,
-            '{i}' as step,
+            step,
             week,
             year
         FROM my_table
-        QUALIFY 
-            total > 0;
-        """).fetch_df() for i in conn.execute("""
-        select distinct string_value from events_unnested where key = 'step' """).fetch_df()['string_value']
+        JOIN steps_dictionary ON {reached_step("step_id", "step")}
+        WHERE {_partition_filter(conn, partitions)}
+        GROUP BY year, week, step
+        ORDER BY year, week, step
+        """).fetch_df()
+
+
+def test_calculate_conversion_rate_per_step_per_week(tmp_path):
+    """
+    This function tests that the single scan gives the same conversion rates as calculating
+    every step on its own with calculate_conversion_rate_per_week.
+    """
+    from testing import write_fixture_parquet
+    conn = duckdb.connect()
+    path = str(tmp_path / "file.parquet")
+    write_fixture_parquet(path)
+    create_table(conn, path=path)
+    create_view(conn)
+    create_my_table(conn)
+    expected = pd.concat(
+        calculate_conversion_rate_per_week(conn, step)
+        for step in ["landing", "checkout", "purchase", "login-options", "sign-up"]
+    ).sort_values(["year", "week", "step"]).reset_index(drop=True)
+    pd.testing.assert_frame_equal(calculate_conversion_rate_per_step_per_week(conn), expected)
+    assert len(expected) == 8
+
+
+def test_steps_past_the_mask():
+    """
+    This function tests that the steps without a bit in steps_mask are read from the list of
+    steps, and that a full rebuild numbers the steps of steps_dictionary again.
+    """
+    from generator import create_synthetic_events
+    conn = duckdb.connect()
+    create_synthetic_events(conn, 2000, n_steps=STEPS_MASK_BITS + 4)
+    create_view(conn)
+    create_my_table(conn)
+    assert conn.execute("SELECT count(*) FROM steps_dictionary").fetchone()[0] == STEPS_MASK_BITS + 4
+    rates = calculate_conversion_rate_per_step_per_week(conn)
+    expected = conn.execute("""
+    SELECT step, year, week, count(*) AS total
+    FROM my_table, unnest(list_distinct(steps)) AS s(step)
+    GROUP BY ALL ORDER BY year, week, step""").fetch_df()
+    assert rates[["step", "year", "week", "total"]].values.tolist() == expected.values.tolist()
+    report = calculate_weekly_report(conn)
+    pd.testing.assert_frame_equal(report["conversion_rate"], rates)
+    conn.execute("""
+    DELETE FROM events WHERE list_contains(
+        list_transform(event_params, p -> p.value.string_value), 'step-6')""")
+    create_my_table(conn)
+    assert conn.execute("SELECT max(step_id) + 1, count(*) FROM steps_dictionary").fetchone() == (
+        STEPS_MASK_BITS + 3, STEPS_MASK_BITS + 3)
+
+
+def calculate_weekly_report(conn: duckdb.connect, partitions: pd.DataFrame = None) -> dict:
+    """
+    This function calculates the purchases and revenue, the number of users per step and the
+    conversion rate of every week in a single scan of my_table, with the same columns as
+    calculate_purchases_and_revenue_per_product_week, calculate_number_of_users_per_step_per_week
+    and calculate_conversion_rate_per_step_per_week.
+    The scan groups the sessions by year, week and product, counting for every step of
+    steps_dictionary the sessions that reached it and the ones that dropped at it. The groups are
+    kept in a temporary table, which is small, and the three metrics are read from it: the
+    purchases and revenue are its rows with a product, and the other two add up the counts of
+    every week.
+    Without any step in steps_dictionary the conversion rate has no rows.
+
+    Args:
+        conn (duckdb.connect): Connection to the database
+        partitions (pd.DataFrame, optional): year and week partitions to calculate. Defaults to all.
+
+    Returns:
+        dict: Dataframes keyed by purchases_revenue, users_per_step and conversion_rate
+    """
+    masks = step_masks(conn)
+    step_counts = "".join(
+        f",\ncount(*) FILTER (WHERE {reached_step(code, '?::VARCHAR')}) as total_{code},\n"
+        f"count(*) FILTER (WHERE last_step = {code}) as dropped_{code}"
+        for _, code in masks.values())
+    conn.execute(f"""
+    CREATE OR REPLACE TEMP TABLE weekly_report AS
+    SELECT
+        year, week, product,
+        count(*) FILTER (WHERE product IS NOT NULL) as purchases,
+        sum(amount) FILTER (WHERE product IS NOT NULL) as revenue
+        {step_counts}
+    FROM my_table
+    WHERE {_partition_filter(conn, partitions)}
+    GROUP BY year, week, product
+    """, list(masks))
+    users = "".join(
+        f"sum(total_{code})::BIGINT as {step_column(step)},\n" if code is not None else f"0::BIGINT as {step_column(step)},\n"
+        for step, code in _users_per_step_columns(masks))
+    steps_totals = " UNION ALL ".join(
+        f"""SELECT sum(total_{code})::BIGINT as total, sum(dropped_{code})::BIGINT as dropped,
+            ?::VARCHAR as step, week, year
+        FROM weekly_report GROUP BY year, week"""
+        for _, code in masks.values()) or """
+        SELECT NULL::BIGINT as total, NULL::BIGINT as dropped, NULL::VARCHAR as step, week, year
+        FROM weekly_report WHERE false"""
+    report = {
+        "purchases_revenue": conn.execute("""
+            SELECT product, week, purchases, revenue, year FROM weekly_report
+            WHERE product IS NOT NULL
+            ORDER BY year, week, product
+            """).fetch_df(),
+        "users_per_step": conn.execute(f"""
+            SELECT {users} year, week FROM weekly_report
+            GROUP BY year, week
+            ORDER BY year, week
+            """).fetch_df(),
+        "conversion_rate": conn.execute(f"""
+            SELECT
+                total,
+                dropped,
+                round((total::DOUBLE - dropped::DOUBLE) / total::DOUBLE * 100, 2) as conversion_rate,
+                step, week, year
+            FROM ({steps_totals})
+            WHERE total > 0
+            ORDER BY year, week, step
+            """, list(masks)).fetch_df(),
+    }
+    conn.execute("DROP TABLE weekly_report")
+    return report
+
+
+def test_calculate_weekly_report():
+    """
+    This function tests that the single scan report gives the same metrics as calculating each
+    one on its own, also for a few partitions.
+    """
+    from generator import create_synthetic_events
+    conn = duckdb.connect()
+    create_synthetic_events(conn, 2000, n_steps=7)
+    create_view(conn)
+    create_my_table(conn)
+    partitions = conn.execute("SELECT DISTINCT year, week FROM my_table ORDER BY year, week LIMIT 2").fetch_df()
+    for chunk in [None, partitions]:
+        report = calculate_weekly_report(conn, chunk)
+        pd.testing.assert_frame_equal(
+            report["purchases_revenue"], calculate_purchases_and_revenue_per_product_week(conn, chunk))
+        pd.testing.assert_frame_equal(
+            report["users_per_step"], calculate_number_of_users_per_step_per_week(conn, chunk))
+        pd.testing.assert_frame_equal(
+            report["conversion_rate"], calculate_conversion_rate_per_step_per_week(conn, chunk))
+    assert len(report["users_per_step"]) == 2
+    assert report["users_per_step"].columns.tolist() == [
+        "landing", "checkout", "login_options", "sign_up", "purchase", "step_6", "step_7", "year", "week"]
+
+
+def test_users_per_step_columns():
+    """
+    This function tests that the users per step keep the columns of USERS_PER_STEP first, in their
+    order, and reject the steps that would be counted in the same column.
+    """
+    import pytest
+    masks = {step: (1 << code, code) for code, step in enumerate(["upsell", "checkout", "landing", "abandon"])}
+    assert _users_per_step_columns(masks) == [
+        ("landing", 2), ("checkout", 1), ("login-options", None), ("sign-up", None), ("purchase", None),
+        ("abandon", 3), ("upsell", 0)]
+    for step in ["sign_up", "Landing"]:
+        with pytest.raises(ValueError, match=step):
+            _users_per_step_columns({**masks, step: (0, 4)})
+
+
+def test_calculate_weekly_report_without_steps(tmp_path):
+    """
+    This function tests that the report of events without any step has an empty conversion rate
+    with the same columns as calculate_conversion_rate_per_step_per_week.
+    """
+    from testing import write_fixture_parquet
+    conn = duckdb.connect()
+    path, no_steps = str(tmp_path / "file.parquet"), str(tmp_path / "no_steps.parquet")
+    write_fixture_parquet(path)
+    conn.execute(f"""
+    COPY (
+        SELECT * REPLACE (list_filter(event_params, p -> p.key <> 'step') AS event_params)
+        FROM read_parquet('{path}')
+    ) TO '{no_steps}' (FORMAT PARQUET)""")
+    create_table(conn, path=no_steps)
+    create_view(conn)
+    create_my_table(conn)
+    report = calculate_weekly_report(conn)
+    assert report["conversion_rate"].empty
+    pd.testing.assert_frame_equal(report["conversion_rate"], calculate_conversion_rate_per_step_per_week(conn))
+    assert report["users_per_step"].columns.tolist() == [
+        "landing", "checkout", "login_options", "sign_up", "purchase", "year", "week"]
+    assert report["users_per_step"].drop(columns=["year", "week"]).eq(0).all(axis=None)
+    pd.testing.assert_frame_equal(report["users_per_step"], calculate_number_of_users_per_step_per_week(conn))
+    assert report["purchases_revenue"]["revenue"].tolist() == [100, 50]
+
+
+def calculate_user_sketches(conn: duckdb.connect, partitions: pd.DataFrame = None) -> pd.DataFrame:
+    """
+    This function calculates HyperLogLog sketches of the distinct user_pseudo_id of every step and
+    every product in each week. The hash of a user picks one of the 2^HLL_PRECISION registers with
+    its lowest bits, and the rank is the position of the lowest set bit of the rest of the hash.
+    A sketch is the maximum rank of each register, and only the registers that were hit are kept.
+    Sketches are merged by taking the maximum rank of each register, so the distinct users of any
+    range of weeks can be estimated without going back to the sessions.
+
+    Args:
+        conn (duckdb.connect): Connection to the database
+        partitions (pd.DataFrame, optional): year and week partitions to calculate. Defaults to all.
+
+    Returns:
+        pd.DataFrame: Dataframe with the columns dimension, value, year, week, register and rank
+    """
+    return conn.execute(f"""
+    WITH hashes AS (
+        SELECT
+            dimension, value, year, week,
+            h & {(1 << HLL_PRECISION) - 1} AS register,
+            h >> {HLL_PRECISION} AS w
+        FROM (
+            SELECT 'step' AS dimension, step AS value, year, week, hash(user_pseudo_id) AS h
+            FROM my_table JOIN steps_dictionary ON {reached_step("step_id", "step")}
+            WHERE {_partition_filter(conn, partitions)}
+            UNION ALL
+            SELECT 'product' AS dimension, product AS value, year, week, hash(user_pseudo_id) AS h
+            FROM my_table
+            WHERE product IS NOT NULL AND {_partition_filter(conn, partitions)}
+        )
     )
+    SELECT
+        dimension, value, year, week, register::USMALLINT AS register,
+        max(CASE WHEN w = 0 THEN {65 - HLL_PRECISION}
+            ELSE log2(w & ~((w - 1)::UBIGINT))::INTEGER + 1 END)::UTINYINT AS rank
+    FROM hashes
+    GROUP BY dimension, value, year, week, register
+    ORDER BY dimension, value, year, week, register
+    """).fetch_df()
+
+
+WEEKLY_AGGREGATES = {
+    "purchases_revenue": (calculate_weekly_report, "year, week, product"),
+    "users_per_step": (calculate_weekly_report, "year, week"),
+    "conversion_rate": (calculate_weekly_report, "year, week, step"),
+    "user_sketches": (calculate_user_sketches, "dimension, value, year, week, register"),
+}
+
+
+def _calculate_weekly(
+    conn: duckdb.connect, calculate, names: list, partitions: pd.DataFrame = None,
+        weeks_per_chunk: int = None) -> dict:
+    """
+    This function runs one of the functions of WEEKLY_AGGREGATES on the partitions, or on the
+    whole my_table, weeks_per_chunk weeks at a time, and concatenates the chunks.
+
+    Returns:
+        dict: Dataframes keyed by the names it calculates
+    """
+    chunks = [partitions]
+    if weeks_per_chunk:
+        if partitions is None:
+            partitions_to_chunk = conn.execute(
+                "SELECT DISTINCT year, week FROM my_table ORDER BY year, week").fetch_df()
+        else:
+            partitions_to_chunk = partitions
+        chunks = [
+            partitions_to_chunk.iloc[i:i + weeks_per_chunk]
+            for i in range(0, len(partitions_to_chunk), weeks_per_chunk)] or [partitions_to_chunk]
+    results = [calculate(conn, chunk) for chunk in chunks]
+    if not isinstance(results[0], dict):
+        results = [{names[0]: result} for result in results]
+    return {name: pd.concat([result[name] for result in results], ignore_index=True) for name in names}
+
+
+def refresh_weekly_aggregates(
+    conn: duckdb.connect, partitions: pd.DataFrame = None, weeks_per_chunk: int = None) -> None:
+    """
+    This function keeps the weekly_<name> tables up to date with the metrics in WEEKLY_AGGREGATES,
+    which maps every name to the function that calculates it and the columns that sort it.
+    A function shared by several names, like calculate_weekly_report, runs once and returns the
+    dataframes of all of them.
+    When partitions are given only their rows are calculated again, otherwise the tables are
+    rebuilt from the whole my_table. A metric whose columns no longer match its table, like the
+    users per step once a new step is added to steps_dictionary, is rebuilt as well. Every metric
+    is grouped by year and week, so it can be calculated a few weeks at a time and the chunks
+    concatenated, to bound the memory it uses.
+
+    Args:
+        conn (duckdb.connect): Connection to the database
+        partitions (pd.DataFrame, optional): year and week partitions that changed. Defaults to all.
+        weeks_per_chunk (int, optional): Weeks calculated at a time. Defaults to all at once.
+    """
+    calculations = {}
+    for name, (calculate, _) in WEEKLY_AGGREGATES.items():
+        calculations.setdefault(calculate, []).append(name)
+    for calculate, names in calculations.items():
+        rebuild = partitions is None
+        with span(calculate.__name__) as record:
+            weekly_dfs = _calculate_weekly(conn, calculate, names, partitions, weeks_per_chunk)
+            if not rebuild and any(
+                    weekly_df.columns.tolist() != [
+                        column for column, *_ in conn.execute(f"SELECT * FROM weekly_{name} LIMIT 0").description]
+                    for name, weekly_df in weekly_dfs.items()):
+                rebuild = True
+                weekly_dfs = _calculate_weekly(conn, calculate, names, None, weeks_per_chunk)
+            record["rows"] = sum(len(weekly_df) for weekly_df in weekly_dfs.values())
+        for name, weekly_df in weekly_dfs.items():
+            conn.register("weekly_df", weekly_df)
+            if rebuild:
+                conn.execute(f"CREATE OR REPLACE TABLE weekly_{name} AS SELECT * FROM weekly_df")
+            else:
+                conn.begin()
+                try:
+                    conn.execute(f"DELETE FROM weekly_{name} WHERE {_partition_filter(conn, partitions)}")
+                    conn.execute(f"INSERT INTO weekly_{name} SELECT * FROM weekly_df")
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+            conn.unregister("weekly_df")
+    print("Weekly aggregates refreshed successfully")
+
+
+def read_weekly_aggregates(conn: duckdb.connect) -> dict:
+    """
+    This function reads the weekly aggregates, ordered by year and week, as Arrow tables
+    that can be published without going through pandas.
+
+    Args:
+        conn (duckdb.connect): Connection to the database
+
+    Returns:
+        dict: Arrow tables keyed by the names in WEEKLY_AGGREGATES
+    """
+    return {
+        name: conn.execute(f"SELECT * FROM weekly_{name} ORDER BY {order}").to_arrow_table()
+        for name, (_, order) in WEEKLY_AGGREGATES.items()
+    }
+
+
+def test_incremental_update_matches_full_rebuild(tmp_path):
+    """
+    This function tests that appending new events and updating only the affected sessions and
+    partitions gives the same my_table and weekly aggregates as rebuilding everything.
+    """
+    from testing import FIXTURE_SESSIONS, write_fixture_parquet
+    first, second = str(tmp_path / "first.parquet"), str(tmp_path / "second.parquet")
+    write_fixture_parquet(first, FIXTURE_SESSIONS[:3])
+    write_fixture_parquet(second, FIXTURE_SESSIONS[:2] + [
+        (3, "u1", 1673222400000, ["landing", "login-options", "sign-up", "checkout"], None),
+        FIXTURE_SESSIONS[3],
+    ])
+    incremental, full = duckdb.connect(), duckdb.connect()
+    create_table(incremental, path=first)
+    create_view(incremental)
+    create_my_table(incremental)
+    refresh_weekly_aggregates(incremental)
+    watermark = events_watermark(incremental)
+    assert append_events(incremental, watermark, path=second) == 4
+    partitions = update_my_table(incremental, watermark)
+    assert partitions.values.tolist() == [[2023, 2]]
+    refresh_weekly_aggregates(incremental, partitions)
+
+    create_table(full, path=second)
+    create_view(full)
+    create_my_table(full)
+    refresh_weekly_aggregates(full)
+    query = "SELECT * FROM my_table ORDER BY session_id"
+    pd.testing.assert_frame_equal(incremental.execute(query).fetch_df(), full.execute(query).fetch_df())
+    for name, table in read_weekly_aggregates(incremental).items():
+        assert table.equals(read_weekly_aggregates(full)[name])
+
+
+def test_incremental_update_new_step(tmp_path):
+    """
+    This function tests that a step first seen by an incremental update gets its column in the
+    users per step, as in a full rebuild, and that the sessions keep their counts. The update is
+    checked, so it sets the quality_flags of the sessions it rebuilds in a my_table built without them.
+    """
+    from testing import FIXTURE_SESSIONS, write_fixture_parquet
+    first, second = str(tmp_path / "first.parquet"), str(tmp_path / "second.parquet")
+    write_fixture_parquet(first, FIXTURE_SESSIONS[:3])
+    write_fixture_parquet(second, FIXTURE_SESSIONS[:3] + [(4, "u3", 1673226000000, ["landing", "upsell"], None)])
+    incremental, full = duckdb.connect(), duckdb.connect()
+    create_table(incremental, path=first)
+    create_view(incremental)
+    create_my_table(incremental)
+    refresh_weekly_aggregates(incremental)
+    watermark = events_watermark(incremental)
+    append_events(incremental, watermark, path=second)
+    flagged = []
+    refresh_weekly_aggregates(incremental, update_my_table(incremental, watermark, check=lambda conn, where: flagged.append(
+        conn.execute(f"SELECT count(quality_flags) FROM my_table WHERE {where}").fetchone()[0])))
+    assert flagged == [1]
+    assert incremental.execute("SELECT count(quality_flags) FROM my_table").fetchone()[0] == 1
+
+    create_table(full, path=second)
+    create_view(full)
+    create_my_table(full)
+    refresh_weekly_aggregates(full)
+    for name, table in read_weekly_aggregates(incremental).items():
+        assert table.equals(read_weekly_aggregates(full)[name]), name
+    users = read_weekly_aggregates(incremental)["users_per_step"].to_pylist()
+    assert [(row["landing"], row["upsell"]) for row in users] == [(2, 0), (2, 1)]
+
+
+def test_lake_matches_table(tmp_path):
+    """
+    This function tests that building and appending to the lake gives the same my_table as the
+    events table, and that a week filter only reads the files of that week.
+    """
+    from testing import FIXTURE_SESSIONS, write_fixture_parquet
+    first, second, lake = str(tmp_path / "first.parquet"), str(tmp_path / "second.parquet"), str(tmp_path / "events")
+    write_fixture_parquet(first, FIXTURE_SESSIONS[:2])
+    write_fixture_parquet(second)
+    conn, table = duckdb.connect(), duckdb.connect()
+    create_lake(conn, path=first, lake=lake)
+    assert append_lake(conn, events_watermark(conn), path=second, lake=lake) == 6
+    assert sorted(os.listdir(lake + "/year=2023")) == ["week=1", "week=2"]
+    create_view(conn)
+    create_my_table(conn)
+    create_table(table, path=second)
+    create_view(table)
+    create_my_table(table)
+    query = "SELECT * FROM my_table ORDER BY session_id"
+    pd.testing.assert_frame_equal(conn.execute(query).fetch_df(), table.execute(query).fetch_df())
+    files = conn.execute("SELECT DISTINCT filename FROM read_parquet(?, hive_partitioning=1, filename=1) WHERE week = 2",
+                         [lake + "/*/*/*.parquet"]).fetchall()
+    assert all("week=2" in f for f, in files)
+    create_table(conn, path=second)
+    assert conn.execute("SELECT count(*) FROM events").fetchone()[0] == 11
+
+
+def test_out_of_core_build(tmp_path):
+    """
+    This function tests that building my_table and the weekly aggregates in chunks gives the same
+    results as building them at once, and that the chunked build runs under a memory limit
+    the single chunk build does not fit in.
+    """
+    import pytest
+    from generator import create_synthetic_events
+    database = str(tmp_path / "data.db")
+    conn = duckdb.connect(database)
+    create_synthetic_events(conn, 200000)
+    create_view(conn)
+    create_my_table(conn)
+    refresh_weekly_aggregates(conn)
+    expected = read_weekly_aggregates(conn)
+    query = "SELECT * FROM my_table ORDER BY session_id, year, week"
+    expected_my_table = conn.execute(query).to_arrow_table()
+    conn.close()
+
+    conn = duckdb.connect(database, config={
+        "memory_limit": "32MB", "threads": 2, "temp_directory": str(tmp_path / "spill")})
+    with pytest.raises(duckdb.OutOfMemoryException):
+        create_my_table(conn)
+    create_my_table(conn, chunks=16)
+    refresh_weekly_aggregates(conn, weeks_per_chunk=1)
+    assert conn.execute(query).to_arrow_table().equals(expected_my_table)
+    for name, table in read_weekly_aggregates(conn).items():
+        assert table.equals(expected[name])
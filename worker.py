@@ -0,0 +1,213 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+_END = object()
+
+
+class Overloaded(Exception):
+    """
+    This exception is raised when a WorkerPool already has as many pending calls as it accepts.
+    """
+
+
+class WorkerPool:
+    """
+    This class runs blocking functions on a bounded pool of threads, so they do not block the
+    event loop. Calls that share a key while one of them is running are coalesced: the function
+    runs once and every caller awaits the same result. New calls are rejected with Overloaded
+    when max_pending calls are already running or queued, and callers stop waiting after a timeout
+    (the call itself keeps its slot until it finishes, since a thread can not be cancelled).
+    All the bookkeeping happens on the event loop thread.
+
+    Args:
+        max_workers (int): Number of threads
+        max_pending (int): Maximum number of calls running or queued
+    """
+    def __init__(self, max_workers: int, max_pending: int):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.max_pending = max_pending
+        self.pending = 0
+        self._in_flight = {}
+
+    def is_running(self, key) -> bool:
+        """
+        This method tells if a call with the given key is running or queued.
+        """
+        return key in self._in_flight
+
+    async def run(self, function, *args, key=None, timeout: float = None):
+        """
+        This method runs function(*args) on the pool and awaits its result.
+
+        Args:
+            function (callable): Blocking function to run
+            *args: Arguments of the function
+            key (hashable, optional): Key identifying identical calls. Defaults to None, never coalesced.
+            timeout (float, optional): Seconds to wait for the result. Defaults to no timeout.
+
+        Returns:
+            The result of the function
+        """
+        future = self._in_flight.get(key) if key is not None else None
+        if future is None:
+            if self.pending >= self.max_pending:
+                raise Overloaded(f"There are already {self.pending} calls pending")
+            self.pending += 1
+            future = asyncio.get_running_loop().run_in_executor(self._executor, function, *args)
+            if key is not None:
+                self._in_flight[key] = future
+            future.add_done_callback(lambda _: self._done(key))
+        return await asyncio.wait_for(asyncio.shield(future), timeout)
+
+    async def stream(self, function, *args, timeout: float = None):
+        """
+        This method runs function(*args), which returns an iterator, on the pool and returns an
+        asynchronous iterator of its items, each one also produced on the pool. The call keeps its
+        slot until the iterator is exhausted or dropped, so slow consumers count in max_pending, and
+        every item must come within the timeout. The first item is produced before returning, so
+        errors are raised to the caller before anything is sent.
+
+        Args:
+            function (callable): Blocking function returning an iterator
+            *args: Arguments of the function
+            timeout (float, optional): Seconds to wait for each item. Defaults to no timeout.
+
+        Returns:
+            async iterator: The items of the iterator
+        """
+        if self.pending >= self.max_pending:
+            raise Overloaded(f"There are already {self.pending} calls pending")
+        self.pending += 1
+        loop = asyncio.get_running_loop()
+        steps = []
+
+        async def step(function, *args):
+            steps.append(loop.run_in_executor(self._executor, function, *args))
+            return await asyncio.wait_for(asyncio.shield(steps[-1]), timeout)
+
+        def finish(iterator) -> None:
+            # The iterator is closed on the pool once its last step is done, then the slot is freed
+            def close(_):
+                closing = loop.run_in_executor(self._executor, getattr(iterator, "close", lambda: None))
+                closing.add_done_callback(lambda _: self._done(None))
+            steps[-1].add_done_callback(close)
+
+        async def items():
+            iterator = None
+            try:
+                iterator = await step(function, *args)
+                while (item := await step(next, iterator, _END)) is not _END:
+                    yield item
+            finally:
+                finish(iterator)
+
+        chunks = items()
+        try:
+            first = await chunks.__anext__()
+        except StopAsyncIteration:
+            first = _END
+
+        async def chained():
+            if first is not _END:
+                yield first
+                async for item in chunks:
+                    yield item
+        return chained()
+
+    def _done(self, key) -> None:
+        self.pending -= 1
+        if key is not None:
+            self._in_flight.pop(key, None)
+
+    def shutdown(self) -> None:
+        """
+        This method stops the threads once the calls already running finish.
+        """
+        self._executor.shutdown(wait=False)
+
+
+def test_identical_calls_run_once():
+    """
+    This function tests that concurrent calls with the same key share one execution.
+    """
+    calls = []
+
+    def slow(value):
+        calls.append(value)
+        time.sleep(0.1)
+        return value
+
+    async def scenario():
+        pool = WorkerPool(max_workers=4, max_pending=10)
+        results = await asyncio.gather(
+            *[pool.run(slow, 1, key="same") for _ in range(5)], pool.run(slow, 2, key="other"))
+        pool.shutdown()
+        return results
+
+    assert asyncio.run(scenario()) == [1, 1, 1, 1, 1, 2]
+    assert sorted(calls) == [1, 2]
+
+
+def test_backpressure_and_timeout():
+    """
+    This function tests that calls over max_pending are rejected and that callers time out.
+    """
+    import pytest
+    release = threading.Event()
+
+    async def scenario():
+        pool = WorkerPool(max_workers=1, max_pending=3)
+        blocked = [asyncio.ensure_future(pool.run(release.wait)) for _ in range(2)]
+        await asyncio.sleep(0)
+        with pytest.raises(asyncio.TimeoutError):
+            await pool.run(release.wait, timeout=0.01)
+        with pytest.raises(Overloaded):
+            await pool.run(release.wait)
+        release.set()
+        await asyncio.gather(*blocked)
+        while pool.pending:
+            await asyncio.sleep(0.01)
+        pool.shutdown()
+
+    asyncio.run(scenario())
+
+
+def test_stream_keeps_its_slot():
+    """
+    This function tests that a stream produces its items on the pool, keeps its slot until it is
+    consumed and closes its iterator, and that errors are raised before the first item.
+    """
+    import pytest
+    threads, closed = set(), []
+
+    def numbers(count):
+        try:
+            for value in range(count):
+                threads.add(threading.current_thread().name)
+                yield value
+            if count == 0:
+                raise ValueError("no numbers")
+        finally:
+            closed.append(count)
+
+    async def scenario():
+        pool = WorkerPool(max_workers=1, max_pending=1)
+        items = await pool.stream(numbers, 3)
+        assert pool.pending == 1
+        with pytest.raises(Overloaded):
+            await pool.stream(numbers, 3)
+        assert [item async for item in items] == [0, 1, 2]
+        while pool.pending:
+            await asyncio.sleep(0.01)
+        with pytest.raises(ValueError):
+            await pool.stream(numbers, 0)
+        while pool.pending:
+            await asyncio.sleep(0.01)
+        pool.shutdown()
+
+    asyncio.run(scenario())
+    assert closed == [3, 0]
+    assert threads and not any(name == threading.current_thread().name for name in threads)